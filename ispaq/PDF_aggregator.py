@@ -1,7 +1,10 @@
+import functools
 import pandas as pd
 import numpy as np
 import os
 
+from obspy import UTCDateTime
+
 try:
     import noise_models
     import utils
@@ -15,6 +18,106 @@ def find_nearest(array, value):
     idx = (np.abs(array - value)).argmin()
     return idx
 
+def histogram_PSDs(frequency, power, hits=None):
+    """
+    Count PSD values in frequency and power bins.
+    :param frequency: Array of PSD frequencies.
+    :param power: Array of PSD power values in dB, rounded to the nearest integer dB for binning.
+    :param hits: Optional array of counts for each value, used when summing stored histograms.
+    :return: tuple (freqs, powers, counts) where counts has shape (len(freqs), len(powers))
+    """
+    frequency = np.asarray(frequency, dtype=float)
+    power = np.asarray(power, dtype=float)
+    valid = np.isfinite(frequency) & np.isfinite(power)
+    frequency = frequency[valid]
+    power = np.rint(power[valid]).astype(int)
+    if hits is not None:
+        hits = np.asarray(hits, dtype=float)[valid]
+
+    if len(power) == 0:
+        return np.array([], dtype=float), np.array([], dtype=int), np.zeros((0, 0), dtype=int)
+
+    freqs, freqInd = np.unique(frequency, return_inverse=True)
+    powers = np.arange(power.min(), power.max() + 1)
+    bins = freqInd.ravel() * len(powers) + (power - powers[0])
+    counts = np.bincount(bins, weights=hits, minlength=len(freqs) * len(powers)).reshape(len(freqs), len(powers))
+    if hits is not None:
+        counts = np.rint(counts).astype(int)
+
+    return freqs, powers, counts
+
+def histogram_to_sparse(freqs, powers, counts):
+    """
+    Convert a frequency-power histogram into a dataframe of its non-empty bins.
+    :return: Dataframe with columns frequency, power, hits
+    """
+    freqInd, powerInd = np.nonzero(counts)
+    return pd.DataFrame({'frequency': freqs[freqInd],
+                         'power': powers[powerInd],
+                         'hits': counts[freqInd, powerInd]})
+
+def write_PSD_histogram(hist, target, day, concierge):
+    """
+    Store the PSD histogram of one SNCL-day so that PDFs can be aggregated
+    without rereading the PSDs.
+    :param hist: Dataframe with columns frequency, power, hits.
+    :param target: SNCLQ of the PSDs.
+    :param day: Day of the PSDs, formatted as YYYY-MM-DD.
+    """
+    logger = concierge.logger
+
+    if concierge.output == 'csv':
+        subFolder = '%s/%s/%s/' % (concierge.psd_dir, target.split('.')[0], target.split('.')[1])
+        if not os.path.isdir(subFolder):
+            logger.info("psd_dir %s does not exist, creating directory" % subFolder)
+            os.makedirs(subFolder)
+        filepath = subFolder + '%s_%s_PSDHistogram.csv' % (target, day)
+        logger.debug('Writing PSD histogram to %s' % filepath)
+        hist[['frequency','power','hits']].to_csv(filepath, index=False)
+
+    elif concierge.output == 'db':
+        logger.debug('Writing PSD histogram for %s %s to %s' % (target, day, concierge.db_name))
+        utils.insert_psd_histogram_database_table(concierge.db_name, target, day, hist)
+
+def histogram_to_PDF(freqs, powers, counts):
+    """
+    Convert a frequency-power histogram into PDF dataframes.
+    :param freqs: Array of frequencies, ascending.
+    :param powers: Array of integer power bins, ascending.
+    :param counts: Array of hits with shape (len(freqs), len(powers)).
+    :return: [pdfDF, modesDF, maxsDF, minsDF]
+
+    pdfDF has one row per non-empty bin with the columns frequency, power, hits,
+    total and percent, sorted by frequency and power. The mode, max and min
+    dataframes have one row per frequency with the columns Frequency and Power.
+    """
+    # Only frequencies with hits
+    total = counts.sum(axis=1)
+    withHits = total > 0
+    freqs = freqs[withHits]
+    counts = counts[withHits]
+    total = total[withHits]
+
+    # Non-empty bins, in frequency then power order
+    freqInd, powerInd = np.nonzero(counts)
+    pdfDF = pd.DataFrame({'frequency': freqs[freqInd],
+                          'power': powers[powerInd],
+                          'hits': counts[freqInd, powerInd],
+                          'total': total[freqInd]})
+    pdfDF['percent'] = pdfDF['hits'] / pdfDF['total'] * 100
+
+    # The mode is the lowest power with the most hits, min and max are the outermost bins with hits
+    nonZero = counts > 0
+    modes = powers[np.argmax(counts, axis=1)]
+    mins = powers[np.argmax(nonZero, axis=1)]
+    maxs = powers[len(powers) - 1 - np.argmax(nonZero[:, ::-1], axis=1)]
+
+    modesDF = pd.DataFrame({'Frequency': freqs, 'Power': modes})
+    maxsDF = pd.DataFrame({'Frequency': freqs, 'Power': maxs})
+    minsDF = pd.DataFrame({'Frequency': freqs, 'Power': mins})
+
+    return pdfDF, modesDF, maxsDF, minsDF
+
 def calculate_PDF(fileDF, sncl, starttime, endtime, concierge):
     # Get the logger from the concierge
     logger = concierge.logger
@@ -25,113 +128,86 @@ def calculate_PDF(fileDF, sncl, starttime, endtime, concierge):
     end = endtime.date
 
 
-    if concierge.output == 'csv':
-        # Convert datetime for dataframe manipulation
-        starttime = starttime.datetime
-        endtime = endtime.datetime
+    # Days whose stored histogram can be used must lie entirely inside the requested span
+    days = [day.strftime("%Y-%m-%d") for day in pd.date_range(start=str(start), end=str(end))]
+    def full_day(day):
+        dayStart = UTCDateTime(day)
+        return (dayStart >= starttime) and (dayStart + 86399 <= endtime)
+
+    # Collect the frequency-power histogram of each day
+    histograms = []
 
+    if concierge.output == 'csv':
         # Subset fileDF to only this sncl
-        snclFiles = fileDF[fileDF['SNCL'] == sncl]['FILE']
-        
-        for snclFile in snclFiles:
-            logger.debug('Collecting PSD values from %s' % (snclFile))
-    
-        psd = pd.concat((pd.read_csv(snclFile, parse_dates=['starttime','endtime']) for snclFile in snclFiles))
-        psd.dropna(inplace=True)
+        snclFiles = fileDF[fileDF['SNCL'] == sncl]['FILE'].tolist()
 
-        # Only include PSDs that are within the time range
-#         psd=psd[(psd['starttime'] >= starttime) & (psd['endtime'] <= endtime)]
-        psd=psd[(psd['starttime'] >= starttime) & (psd['starttime'] < endtime)] # Changed to future-proof as PSDs will span the day-boundary
-            
+        for day in days:
+            psdFiles = utils.prefer_psd_files([f for f in snclFiles if f.endswith(tuple('_%s_%s' % (day, suffix) for suffix in utils.PSD_SUFFIXES))])
+            histFiles = [f for f in snclFiles if f.endswith('_%s_PSDHistogram.csv' % day)]
+
+            if full_day(day) and histFiles:
+                logger.debug('Collecting PSD histogram from %s' % (histFiles[0]))
+                histograms.append(pd.read_csv(histFiles[0]))
+                continue
+
+            if not psdFiles:
+                continue
+
+            for psdFile in psdFiles:
+                logger.debug('Collecting PSD values from %s' % (psdFile))
+
+            psd = utils.read_psd_files(psdFiles)
+            psd.dropna(inplace=True)
+
+            # Only include PSDs that are within the time range
+            psd=psd[(psd['starttime'] >= starttime.datetime) & (psd['starttime'] < endtime.datetime)] # Changed to future-proof as PSDs will span the day-boundary
+
+            hist = histogram_to_sparse(*histogram_PSDs(psd['frequency'], psd['power']))
+            if full_day(day) and not hist.empty:
+                write_PSD_histogram(hist, sncl, day, concierge)
+            histograms.append(hist)
 
     elif concierge.output == 'db':
-        import sqlite3
-        
-        # get the values for the sncl and timerange, load into a dataframe
-        # Read sqlite query results into a pandas DataFrame
-        sqlstarttime = str(starttime).split('.')[0]
-        sqlendtime = str(endtime).split('.')[0]
-        con = sqlite3.connect(concierge.db_name)
-        
-        select_sql = f"SELECT * from psd_corrected WHERE target = '{sncl}'"
-        if not starttime == "":
-            select_sql = f"{select_sql} AND start >= '{sqlstarttime}'"
-        if not endtime == "":
-            select_sql = f"{select_sql} AND end <= '{sqlendtime}'"
-        
-        select_sql = f"{select_sql} AND power != 'nan';"
-        logger.debug(select_sql)
-        
-        try:
-            psd = pd.read_sql_query(select_sql, con)
-            con.close()
-        except Exception as e:
-            logger.warning(f"Unable to access PSDs. ERROR: {e}")
-            return pd.DataFrame(), None, None, None
-    
-    # Initiate dataframe to hold hit values
-    index = pd.MultiIndex(levels=[[],[]], codes=[[],[]], names=[u'frequency', u'power'])
-    pdfDF = pd.DataFrame(columns=['frequency', 'power','hits'], index=index, dtype="object")
-        
-    # Pre-calculate how many hits each frequency-power bin has for the day
-    psd['freqPow'] = list(zip(psd['frequency'], [int(round(i)) for i in psd['power']]))
-    freqPows = psd.freqPow.value_counts(sort=False).keys().tolist()
-    counts = psd.freqPow.value_counts(sort=False).tolist()
-    freqPowCounts = list(zip(freqPows, counts))
-            
-    # Loop over each frequency-power bin, adding the number of daily hits to the running total
-    for freqPow in freqPowCounts:
-        freq = freqPow[0][0]
-        power = freqPow[0][1]
-        count = freqPow[1]
-        
-        if freqPow[0] in pdfDF.index:
-            # We already know of this freq-power combination, add to hit and total counts
-            pdfDF['hits'].loc[[freqPow[0]]] += count
-    
-        else:
-            # New frequency-power combination, add to dataframe
-            newRow = [freq, power, count]
-            ind = len(pdfDF)
-            pdfDF.loc[ind] = newRow
-            pdfDF.rename(index={ind:freqPow[0]}, inplace=True)
+        fullDays = [day for day in days if full_day(day)]
+        storedDays = set()
+        if fullDays:
+            try:
+                stored = utils.retrieve_psd_histograms(concierge.db_name, sncl, fullDays[0], fullDays[-1])
+                storedDays = set(stored['day'])
+                histograms.append(stored[['frequency','power','hits']])
+            except Exception as e:
+                logger.debug("No stored PSD histograms for %s: %s" % (sncl, e))
+
+        for day in days:
+            if day in storedDays:
+                continue
+
+            # Let SQLite bin the PSD values so that only the histogram is read
+            dayStart = UTCDateTime(day)
+            try:
+                hist = utils.retrieve_psd_histogram_from_psds(concierge.db_name, sncl, max(dayStart, starttime), min(dayStart + 86400, endtime))
+            except Exception as e:
+                # A PDF missing some of the days must not be written as if it were complete
+                logger.warning(f"Unable to access PSDs. ERROR: {e}")
+                return pd.DataFrame(), None, None, None
 
+            if full_day(day) and not hist.empty:
+                write_PSD_histogram(hist, sncl, day, concierge)
+            histograms.append(hist)
 
-    if pdfDF.empty:
+    if len(histograms) == 0:
+        histograms.append(pd.DataFrame(columns=['frequency','power','hits']))
+    psd = pd.concat(histograms, ignore_index=True)
+
+    # Count the hits in each frequency-power bin
+    (freqs, powers, counts) = histogram_PSDs(psd['frequency'], psd['power'], psd['hits'])
+
+    if counts.sum() == 0:
         logger.info('No PSDs found for %s, %s to %s' % (sncl, str(starttime).split('T')[0],str(endtime).split('T')[0]))
-        return pdfDF, None, None, None
-    
-    # Sort the dataframe, mostly for plotting purposes
-    pdfDF.sort_values(by=['frequency','power'], inplace=True)
-    
-    # We used (freq, pow) as the index for ease during construction, but can reset them for the rest of the process
-    pdfDF.reset_index(inplace=True,drop=True)
-    
-    # Set up dataframes for the max, min, modes for plotting later
-    modesDF = pd.DataFrame(columns=['Frequency','Power'], dtype="object")
-    minsDF = pd.DataFrame(columns=['Frequency','Power'], dtype="object") 
-    maxsDF = pd.DataFrame(columns=['Frequency','Power'], dtype="object");
-    
+        return pd.DataFrame(columns=['frequency', 'power','hits']), None, None, None
+
+    [pdfDF, modesDF, maxsDF, minsDF] = histogram_to_PDF(freqs, powers, counts)
 
-    # For each *frequency*, sum up the total hits, as well as min, max, mode values
-    for frequency in pdfDF['frequency'].unique():
-        # Sum hits for total column
-        pdfDF.loc[pdfDF['frequency'] == frequency, 'total'] = sum(pdfDF[pdfDF['frequency'] == frequency]['hits'])
-        
-        # Find the min, max, mode
-        powerInd = pdfDF[pdfDF['frequency'] == frequency]['hits'].idxmax()
-        mode = pdfDF.loc[powerInd, 'power']
-        modesDF.loc[len(modesDF)] = [frequency, mode]
-
-        indWithHits = pdfDF['hits'][pdfDF['frequency'] == frequency].dropna().index
-        values = pdfDF['power'][indWithHits].sort_values().reset_index()
-        maxVal = values['power'].iloc[-1]
-        minVal = values['power'][0]
-
-        maxsDF.loc[len(maxsDF)] = [frequency, maxVal]
-        minsDF.loc[len(minsDF)] = [frequency, minVal]  
-    
-    pdfDF['percent'] = pdfDF['hits'] / pdfDF['total'] * 100 
     printDF = pdfDF[['frequency', 'power','hits']]  
     sortedDF = printDF.sort_values(['frequency','power'])
     
@@ -160,12 +236,12 @@ def calculate_PDF(fileDF, sncl, starttime, endtime, concierge):
                   '# start=%s\n'
                   '# end=%s\n'
                   '#\n'
-                  '#\n' % (starttime,endtime))
+                  '#\n' % (starttime.datetime,endtime.datetime))
         
             
             with open(filepath, mode='w') as f:
                 f.write(hdr)
-            utils.write_pdf_df(sortedDF, filepath, 'a', sncl, starttime, endtime, concierge, sigfigs=concierge.sigfigs)
+            utils.write_pdf_df(sortedDF, filepath, 'a', sncl, starttime.datetime, endtime.datetime, concierge, sigfigs=concierge.sigfigs)
         
         elif concierge.output == "db":
             logger.debug('Writing PDF values to %s' % concierge.db_name)
@@ -177,61 +253,92 @@ def calculate_PDF(fileDF, sncl, starttime, endtime, concierge):
 
 
 
-def plot_PDF(sncl, starttime, endtime, pdfDF, modesDF, maxsDF, minsDF, concierge):
+# Plot resources are created once per process and reused for every plot ------
+
+@functools.lru_cache(maxsize=None)
+def get_pyplot():
+    """
+    Import pyplot with the non-interactive Agg backend.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
     import matplotlib.pyplot as plt
+    return plt
+
+@functools.lru_cache(maxsize=None)
+def get_PDF_colormap():
+    """
+    Rainbow colormap for PDF plots, fading to white for the lowest percentages.
+    """
+    plt = get_pyplot()
+
+    # Set up plotting -- color map
+    cmap = plt.get_cmap('gist_rainbow_r', 3000)
+    cmaplist = cmap(np.arange(cmap.N))[100:]  # don't want whole spectrum
+
+    # convert the first nchange to fade from white
+    nchange = 100
+    scaleFactor = (nchange - 1 - np.arange(nchange)) / float(nchange)
+    first = cmaplist[nchange][:3]
+    cmaplist[:nchange, :3] = (1 - first) * scaleFactor[:, np.newaxis] + first
+    cmaplist[:nchange, 3] = 1
+    cmaplist[0] = (1,1,1,1)
+
+    return cmap.from_list('Custom cmap', cmaplist, cmap.N)
+
+@functools.lru_cache(maxsize=None)
+def get_noise_model_indices(freqs, p2, p1):
+    """
+    Plot positions of the NHNM and NLNM.
+    :param freqs: Tuple of plot frequencies, descending.
+    :param p2: Highest plot power, at row 0.
+    :param p1: Lowest plot power, at the last row.
+    :return: tuple of arrays (NHNM rows, NLNM rows, frequency columns)
+    """
+    (nhnm, nlnm) = noise_models.get_model_powers(freqs)
+    # As in noise_models.get_models(), model powers are truncated to whole dB
+    with np.errstate(invalid='ignore'):
+        nhnmInd = p2 - np.trunc(nhnm)
+        nlnmInd = p2 - np.trunc(nlnm)
+    valid = np.isfinite(nhnmInd) & np.isfinite(nlnmInd) & (nhnmInd >= 0) & (nhnmInd <= p2 - p1) & (nlnmInd >= 0) & (nlnmInd <= p2 - p1)
+    freqInd = np.nonzero(valid)[0]
+    return nhnmInd[valid].astype(int), nlnmInd[valid].astype(int), freqInd
+
+
+def plot_PDF(sncl, starttime, endtime, pdfDF, modesDF, maxsDF, minsDF, concierge):
+    plt = get_pyplot()
     
     # Get the logger from the concierge
     logger = concierge.logger
 
     # Powers must span the noise models at a minimum
-    p1 = int(min(pdfDF['power'].unique())); p2 = int(max(pdfDF['power'].unique()))
+    p1 = int(pdfDF['power'].min()); p2 = int(pdfDF['power'].max())
     if p1 > -190:
         p1 = -190
     if p2 < -90:
         p2 = -90
         
     
-    powers = sorted(range(p1,p2+1), reverse=True)
-    freqs = sorted(pdfDF['frequency'].unique(),reverse = True)
-    plotDF = pd.DataFrame(0,index=powers,columns=freqs)
-
-    # Create a new dataframe for plotting: rows are powers, columns are periods, value is percent of hits
-    nonZeroFreqs=[]
-    for power in powers:
-        for freq in freqs:
-            value = pdfDF[(pdfDF['frequency']==freq) & (pdfDF['power']== power)]['percent'].values
-            try:
-                plotDF.loc[power,freq] = value[0]
-                if value[0] != 0:
-                    # Keep track of the frequencies that have hits, for axes limits
-                    nonZeroFreqs.append(freq)
-            except:
-                continue
-    
-    # Matplotlib imshow takes a list (matrix) of values
-    plotList = plotDF.values.tolist()
+    powers = list(range(p2, p1-1, -1))
+    freqsAscending = np.unique(pdfDF['frequency'].values.astype(float))
+    freqs = freqsAscending[::-1].tolist()
+
+    # Plot positions: rows are powers (descending), columns are frequencies (descending)
+    def freq_columns(values):
+        return len(freqs) - 1 - np.searchsorted(freqsAscending, np.asarray(values, dtype=float))
+    def power_rows(values):
+        return p2 - np.asarray(values, dtype=int)
+
+    # Create a matrix for plotting: rows are powers, columns are periods, value is percent of hits
+    percent = pdfDF['percent'].values.astype(float)
+    plotMatrix = np.zeros((len(powers), len(freqs)))
+    plotMatrix[power_rows(pdfDF['power'].values), freq_columns(pdfDF['frequency'].values)] = percent
+
+    # Keep track of the frequencies that have hits, for axes limits
+    nonZeroFreqs = pdfDF['frequency'].values[percent != 0].astype(float)
     
     # Set up plotting -- color map
-    cmap = plt.get_cmap('gist_rainbow_r', 3000)
-    cmaplist = [cmap(i) for i in range(cmap.N)][100::]  # don't want whole spectrum
-    
-    # convert the first nchange to fade from white
-    nchange = 100
-    for i in range(nchange):
-        
-        first = cmaplist[nchange][0]
-        second = cmaplist[nchange][1]
-        third = cmaplist[nchange][2]
-        scaleFactor = (nchange-1-i)/float(nchange)
-        
-        df = ((1-first) * scaleFactor) + first
-        ds = ((1-second)* scaleFactor) + second
-        dt = ((1-third) * scaleFactor) + third
-              
-        cmaplist[i] = (df, ds, dt, 1)
-
-    cmaplist[0] = (1,1,1,1)
-    cmap = cmap.from_list('Custom cmap', cmaplist, cmap.N)
+    cmap = get_PDF_colormap()
 
     # Set up plotting -- axis labeling and ticks
     periodPoints = [0.001, 0.01, 0.1, 1, 10, 100, 1000, 10000]
@@ -241,7 +348,7 @@ def plot_PDF(sncl, starttime, endtime, pdfDF, modesDF, maxsDF, minsDF, concierge
     xticks = [find_nearest(freqs, i) for i in xlabels]
     xlabels = [int(1/i)  if i<=1 else 1/i for i in xlabels]     #convert to period, use decimal only if <1s
 
-    yticks = [powers.index(i) for i in list(filter(lambda x: (x % 10 == 0), powers))]
+    yticks = [p2 - i for i in powers if i % 10 == 0]
     ylabels = [powers[i] for i in yticks]
 
     if concierge.plot_include is None:
@@ -288,60 +395,59 @@ def plot_PDF(sncl, starttime, endtime, pdfDF, modesDF, maxsDF, minsDF, concierge
            
             
     
-    # Set up plotting -- plot
+    # Set up plotting -- plot, reusing one figure for all plots
     height = ylabels[0] - ylabels[-1]
-    plt.figure(figsize=( 12, (.055*height + .5) ))
+    fig = plt.figure(num='ispaq_PDF')
+    fig.clf()
+    fig.set_size_inches(12, (.055*height + .5))
+    ax = fig.add_subplot(111)
     
     # Plot it up
-    plt.imshow(plotList, cmap=cmap,  vmin=0, vmax=30, aspect=.4, interpolation='bilinear')
+    im = ax.imshow(plotMatrix, cmap=cmap,  vmin=0, vmax=30, aspect=.4, interpolation='bilinear')
 
     # Add mode
-    xmodes = [freqs.index(freqPos) for freqPos in modesDF['Frequency'].tolist()]
-    ymodes = [powers.index(freqPos) for freqPos in modesDF['Power'].tolist()]
-    hmode, = plt.plot(xmodes, ymodes, c='k', linewidth=1, label="mode")
+    hmode, = ax.plot(freq_columns(modesDF['Frequency']), power_rows(modesDF['Power']), c='k', linewidth=1, label="mode")
     
     # Add min
-    xmins = [freqs.index(freqPos) for freqPos in minsDF['Frequency'].tolist()]
-    ymins = [powers.index(freqPos) for freqPos in minsDF['Power'].tolist()]
-    hmin, = plt.plot(xmins, ymins, c='r', linewidth=1, label="min")
+    hmin, = ax.plot(freq_columns(minsDF['Frequency']), power_rows(minsDF['Power']), c='r', linewidth=1, label="min")
 
     # Add max
-    xmaxs = [freqs.index(freqPos) for freqPos in maxsDF['Frequency'].tolist()]
-    ymaxs = [powers.index(freqPos) for freqPos in maxsDF['Power'].tolist()]
-    hmax, = plt.plot(xmaxs, ymaxs, c='b', linewidth=1, label="max")
+    hmax, = ax.plot(freq_columns(maxsDF['Frequency']), power_rows(maxsDF['Power']), c='b', linewidth=1, label="max")
     
     # Add noise models
-    [NHNM, NLNM, freqInd] = noise_models.get_models(freqs,powers)
-    plt.plot(freqInd, NHNM, c='dimgrey', linewidth=2)
-    plt.plot(freqInd, NLNM, c='dimgrey', linewidth=2)
+    [NHNM, NLNM, freqInd] = get_noise_model_indices(tuple(freqs), p2, p1)
+    ax.plot(freqInd, NHNM, c='dimgrey', linewidth=2)
+    ax.plot(freqInd, NLNM, c='dimgrey', linewidth=2)
     
     # Adjust grids, labels, limits, titles, etc
-    plt.grid(linestyle=':', linewidth=1)
-    plt.xlabel('Period (s)',size=18)
-    plt.ylabel(r'Power [$10log_{10}(\frac{m^2/s^4}{hz}$)][dB]',size=18)
+    ax.grid(linestyle=':', linewidth=1)
+    ax.set_xlabel('Period (s)',size=18)
+    ax.set_ylabel(r'Power [$10log_{10}(\frac{m^2/s^4}{hz}$)][dB]',size=18)
     
-    plt.xticks(xticks[::-1], xlabels[::-1],size=15)
-    plt.yticks(yticks,ylabels,size=15)
+    ax.set_xticks(xticks[::-1])
+    ax.set_xticklabels(xlabels[::-1],size=15)
+    ax.set_yticks(yticks)
+    ax.set_yticklabels(ylabels,size=15)
 
-    xmin=freqs.index(min(nonZeroFreqs))
-    xmax=freqs.index(max(nonZeroFreqs))
-    plt.xlim(xmax,xmin)
-    plt.ylim(max(yticks)+5,min(yticks)-5)
+    xmin=freq_columns([nonZeroFreqs.min()])[0]
+    xmax=freq_columns([nonZeroFreqs.max()])[0]
+    ax.set_xlim(xmax,xmin)
+    ax.set_ylim(max(yticks)+5,min(yticks)-5)
 
     title_starttime = str(starttime.datetime)
     title_endtime = str(endtime.datetime)
-    plt.title(sncl + '\n'+ title_starttime + " to " + title_endtime, size=18)
+    ax.set_title(sncl + '\n'+ title_starttime + " to " + title_endtime, size=18)
 
     # User has option to include colorbar and/or legend
     if 'colorbar' in concierge.plot_include:
-        cb = plt.colorbar(fraction=.02)
+        cb = fig.colorbar(im, ax=ax, fraction=.02)
         cb.set_label('percent probability',labelpad=-50)
         
     if 'legend' in concierge.plot_include:
-        plt.legend([hmax, hmode, hmin],['max','mode','min'], ncol=3, loc='lower left', framealpha=0.8)
+        ax.legend([hmax, hmode, hmin],['max','mode','min'], ncol=3, loc='lower left', framealpha=0.8)
 
 
-    plt.tight_layout()
+    fig.tight_layout()
     
     # Save to file
     subFolder = '%s/%s/%s/' % (concierge.pdf_dir, sncl.split('.')[0],  sncl.split('.')[1])
@@ -359,7 +465,4 @@ def plot_PDF(sncl, starttime, endtime, pdfDF, modesDF, maxsDF, minsDF, concierge
     filepath = subFolder + filename
     
     logger.info('Saving PDF plot to %s' % (filepath))
-    plt.savefig(filepath)
-
-
-    del(pdfDF)
+    fig.savefig(filepath)
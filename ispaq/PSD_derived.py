@@ -0,0 +1,268 @@
+"""
+ISPAQ PSD-derived metrics calculated from stored corrected PSDs.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import numpy as np
+import pandas as pd
+
+try:
+    import noise_models
+    import utils
+except:
+    from . import noise_models
+    from . import utils
+
+
+# Period band (s) used by dead_channel_gsn
+GSN_LO_PERIOD = 4.0
+GSN_HI_PERIOD = 8.0
+GSN_THRESHOLD = -5.0
+
+# Upper period (s) used by dead_channel_lin
+LIN_HI_PERIOD = 100.0
+
+# Channels reported by IRISMustangMetrics::PSDMetric for each dead channel metric
+LIN_CHANNELS = 'BH|HH|CH|DH|FH|BX|HX'
+GSN_CHANNELS = 'BH|HH|CH|DH|FH|LH|MH|BX|HX'
+
+# Common sampling rates, used when a channel has no local metadata
+STANDARD_SAMPLING_RATES = (0.01, 0.1, 1.0, 2.0, 4.0, 5.0, 8.0, 10.0, 20.0, 25.0, 40.0, 50.0,
+                           80.0, 100.0, 125.0, 200.0, 250.0, 400.0, 500.0, 1000.0)
+
+
+def load_stored_PSDs(concierge, starttime, endtime):
+    """
+    Collect the stored corrected PSDs for all requested SNCLs.
+
+    :param concierge: Data access expediter.
+    :param starttime: Only include PSDs starting at or after this time.
+    :param endtime: Only include PSDs starting before this time.
+    :return: Dataframe with columns target, starttime, endtime, frequency, power, or None
+    """
+    logger = concierge.logger
+
+    days = [day.strftime("%Y-%m-%d") for day in pd.date_range(start=str(starttime.date), end=str((endtime-1).date))]
+    dataframes = []
+
+    for sncl_pattern in concierge.sncl_patterns:
+        if concierge.output == 'csv':
+            # If no quality code is specified, then wildcard it
+            if len(sncl_pattern.split('.')) == 4:
+                sncl_pattern = '%s.?,%s' % (sncl_pattern, sncl_pattern)
+
+            files = utils.prefer_psd_files(utils.find_psd_files(concierge.psd_dir, sncl_pattern, days))
+            if not files:
+                logger.warning('No PSD files found for %s %s' % (sncl_pattern, days[0]))
+                continue
+            for psdFile in files:
+                logger.debug('Collecting PSD values from %s' % (psdFile))
+            dataframes.append(utils.read_psd_files(files))
+
+        elif concierge.output == 'db':
+            db_sncl_pattern = sncl_pattern.replace('*','%').replace('?','_')
+            if len(db_sncl_pattern.split('.')) == 4:
+                db_sncl_pattern = '%s%%' % db_sncl_pattern
+            try:
+                dataframes.append(utils.retrieve_psds(concierge.db_name, db_sncl_pattern, starttime, endtime))
+            except Exception as e:
+                logger.debug(e)
+                logger.warning("Unable to access PSD values for %s %s - %s" % (sncl_pattern, starttime, endtime))
+
+    if len(dataframes) == 0:
+        return None
+
+    psd = pd.concat(dataframes, ignore_index=True)
+    psd = psd.drop_duplicates(['target','starttime','frequency'])
+    psd = psd[(psd['starttime'] >= starttime.datetime) & (psd['starttime'] < endtime.datetime)]
+    psd = psd.dropna(subset=['frequency','power'])
+
+    return psd
+
+
+def infer_sampling_rate(max_frequency):
+    """
+    Infer the sampling rate of a channel from its highest PSD frequency.
+
+    :param max_frequency: Highest frequency of the corrected PSDs.
+    :return: Sampling rate.
+
+    PSD frequencies are 1/8 octave bins up to the Nyquist frequency, so the Nyquist
+    frequency lies between the highest bin and 2^(1/8) times that. The smallest
+    common sampling rate in that range is returned, otherwise its middle.
+    """
+    lo = max_frequency * (1 - 1e-5)
+    hi = max_frequency * 2**0.125
+    for rate in STANDARD_SAMPLING_RATES:
+        if lo <= rate / 2 < hi:
+            return rate
+    return 2 * max_frequency * 2**0.0625
+
+
+def metadata_sampling_rates(concierge, targets, starttime):
+    """
+    Read the sampling rates of channels from the local StationXML file.
+
+    :param concierge: Data access expediter.
+    :param targets: SNCLQ targets of the PSDs.
+    :param starttime: Time at which the channel epochs are selected.
+    :return: Dictionary of sampling rates by target, empty without a local StationXML file.
+    """
+    rates = {}
+    if concierge.station_client is not None or concierge.station_url is None:
+        return rates
+    try:
+        inventory = concierge.read_inventory()
+    except Exception as e:
+        concierge.logger.debug(e)
+        return rates
+    for target in targets:
+        (network, station, location, channel) = target.split('.')[0:4]
+        selected = inventory.select(network=network, station=station, location=location,
+                                    channel=channel, time=starttime)
+        for net in selected:
+            for sta in net:
+                for cha in sta:
+                    if cha.sample_rate:
+                        rates[target] = cha.sample_rate
+    return rates
+
+
+def calculate_derived_metrics(psd, starttime, endtime, sampling_rates=None):
+    """
+    Compare stored corrected PSDs with the Peterson noise models.
+
+    :param psd: Dataframe of corrected PSDs as returned by load_stored_PSDs().
+    :param starttime: Start of the metric window.
+    :param endtime: End of the metric window.
+    :param sampling_rates: Dictionary of sampling rates by target. Targets without a
+        rate use infer_sampling_rate().
+    :return: Dataframe of metrics with columns metricName, value, snclq, starttime,
+        endtime, qualityFlag
+
+    All PSDs for all targets are evaluated at once, as IRISMustangMetrics::PSDMetric does:
+
+    * pct_above_nhnm, pct_below_nlnm -- percentage of PSDs above the NHNM (below the
+      NLNM) at each frequency, averaged over the frequencies below nyquist/1.5 where
+      the models are defined
+    * dead_channel_lin -- standard deviation of the residuals of a linear fit of the
+      mean PSD against log10(period), for periods strictly between 4/sampling_rate
+      and 100 s. Only for BH, HH, CH, DH, FH, BX and HX channels.
+    * dead_channel_gsn -- 1 if the median PSD is on average more than 5 dB below the
+      NLNM between 4 and 8 s, including the nearest period outside each bound as the
+      R index arithmetic does, otherwise 0. Only for sampling rates above 0.999 and
+      BH, HH, CH, DH, FH, LH, MH, BX and HX channels.
+    """
+    frequency = psd['frequency'].values.astype(float)
+    power = psd['power'].values.astype(float)
+
+    # Noise models evaluated once per unique frequency
+    freqs, inverse = np.unique(frequency, return_inverse=True)
+    nhnm, nlnm = noise_models.get_model_powers(freqs)
+    nhnm = nhnm[inverse.ravel()]
+    nlnm = nlnm[inverse.ravel()]
+
+    psd = pd.DataFrame({'target': psd['target'].values,
+                        'frequency': frequency,
+                        'power': power,
+                        'above': np.where(np.isnan(nhnm), np.nan, power > nhnm),
+                        'below': np.where(np.isnan(nlnm), np.nan, power < nlnm),
+                        'nlnm': nlnm})
+
+    # Per target and frequency statistics
+    byFreq = psd.groupby(['target','frequency']).agg(above=('above','mean'),
+                                                    below=('below','mean'),
+                                                    mean=('power','mean'),
+                                                    median=('power','median'),
+                                                    nlnm=('nlnm','first')).reset_index()
+    byTarget = byFreq.groupby('target')
+
+    # Sampling rate and channel of each target
+    targets = byTarget.size().index
+    rates = pd.Series([(sampling_rates or {}).get(target) for target in targets], index=targets, dtype=float)
+    missing = rates.isna()
+    rates[missing] = [infer_sampling_rate(f) for f in byTarget['frequency'].max()[missing]]
+    channels = pd.Series([target.split('.')[3] for target in targets], index=targets)
+    rate = byFreq['target'].map(rates)
+
+    metrics = pd.DataFrame(index=targets)
+
+    # pct_above_nhnm, pct_below_nlnm, without the frequencies affected by the anti-alias filter
+    nyquist = rate / 2
+    belowNyquist = byFreq[byFreq['frequency'] < nyquist / 1.5]
+    metrics['pct_above_nhnm'] = belowNyquist.groupby('target')['above'].mean() * 100
+    metrics['pct_below_nlnm'] = belowNyquist.groupby('target')['below'].mean() * 100
+
+    # dead_channel_lin
+    period = 1.0 / byFreq['frequency']
+    linLoPeriod = 4.0 / rate
+    lin = byFreq.loc[(period > linLoPeriod) & (period < LIN_HI_PERIOD), ['target']].copy()
+    lin['x'] = np.log10(period[lin.index])
+    lin['y'] = byFreq.loc[lin.index, 'mean']
+    byLin = lin.groupby('target')
+    lin['dx'] = lin['x'] - byLin['x'].transform('mean')
+    lin['dy'] = lin['y'] - byLin['y'].transform('mean')
+    lin['dxx'] = lin['dx'] * lin['dx']
+    lin['dxy'] = lin['dx'] * lin['dy']
+    lin['dyy'] = lin['dy'] * lin['dy']
+    sums = lin.groupby('target')[['dxx','dxy','dyy']].sum()
+    counts = lin.groupby('target').size()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sse = (sums['dyy'] - sums['dxy']**2 / sums['dxx'].where(sums['dxx'] > 0)).fillna(0).clip(lower=0)
+        metrics['dead_channel_lin'] = np.sqrt(sse / (counts - 1)).where(counts > 1)
+    metrics.loc[~channels.str.contains(LIN_CHANNELS), 'dead_channel_lin'] = np.nan
+
+    # dead_channel_gsn: PSDMetric slices from the first period below 4 s to the last
+    # period above 8 s, so the nearest bin outside the band is included on each side
+    byFreq['gsnHi'] = byFreq['frequency'].where(period < GSN_LO_PERIOD).groupby(byFreq['target']).transform('min')
+    byFreq['gsnLo'] = byFreq['frequency'].where(period > GSN_HI_PERIOD).groupby(byFreq['target']).transform('max')
+    gsn = byFreq[(byFreq['frequency'] >= byFreq['gsnLo']) & (byFreq['frequency'] <= byFreq['gsnHi'])]
+    deviation = (gsn['median'] - gsn['nlnm']).groupby(gsn['target']).mean()
+    metrics['dead_channel_gsn'] = (deviation < GSN_THRESHOLD).astype(float).where(deviation.notna())
+    metrics.loc[~(channels.str.contains(GSN_CHANNELS) & (rates > 0.999)), 'dead_channel_gsn'] = np.nan
+
+    # Reshape to the GeneralValueMetric layout returned by IRISMustangMetrics
+    metrics.index.name = 'snclq'
+    df = metrics.reset_index().melt(id_vars='snclq', var_name='metricName', value_name='value')
+    df = df.dropna(subset=['value'])
+    df['starttime'] = starttime
+    df['endtime'] = endtime
+    df['qualityFlag'] = -9
+
+    return df[['metricName','value','snclq','starttime','endtime','qualityFlag']].reset_index(drop=True)
+
+
+def PSD_derived_metrics(concierge, starttime, endtime, select=None):
+    """
+    Generate PSD-derived metrics from stored corrected PSDs rather than
+    recalculating the PSDs.
+
+    :param concierge: Data access expediter.
+    :param starttime: Start of the metric window, typically one day.
+    :param endtime: End of the metric window.
+    :param select: Function taking the sorted list of stored targets and returning
+        those to calculate, or None for all of them.
+    :return: Dataframe of PSD metrics or None
+    """
+    logger = concierge.logger
+
+    psd = load_stored_PSDs(concierge, starttime, endtime)
+    if psd is None or psd.empty:
+        logger.info('No stored PSDs found for %s' % str(starttime).split('T')[0])
+        return None
+    if select is not None:
+        psd = psd[psd['target'].isin(select(sorted(psd['target'].unique())))]
+        if psd.empty:
+            return None
+
+    logger.info('Calculating PSD metrics from %d stored PSDs for %d SNCLs on %s' %
+                (psd.drop_duplicates(['target','starttime']).shape[0], psd['target'].nunique(),
+                 str(starttime).split('T')[0]))
+
+    sampling_rates = metadata_sampling_rates(concierge, psd['target'].unique(), starttime)
+    return calculate_derived_metrics(psd, starttime, endtime, sampling_rates)
@@ -19,19 +19,24 @@ from . import utils
 from . import irisseismic
 from . import irismustangmetrics
 from . import PDF_aggregator
+from . import PSD_derived
+from . import completed_units
+from . import database
 
 
 #from astropy.io.ascii.tests.test_connect import files
 
-def PSD_metrics(concierge):
+def PSD_metrics(concierge, sink=None):
     """
     Generate *PSD* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expediter.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
 
     :rtype: pandas dataframe
-    :return: Dataframe of PSD metrics.
+    :return: Dataframe of PSD metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -47,8 +52,9 @@ def PSD_metrics(concierge):
     # function metadata dictionary
     function_metadata = concierge.function_by_logic['PSD']
 
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: utils.select_metrics(df, concierge.metric_names))
     
 
     ####################
@@ -72,60 +78,92 @@ def PSD_metrics(concierge):
         logger.info('Calculating PSD values for %d SNCLs on %s' % (availability.shape[0],str(starttime).split('T')[0]))
 
         for (index, av) in availability.iterrows():
-            logger.info('%03d Calculating PSD values for %s' % (index, av.snclId))
-            
+            if not concierge.assigned(av.snclId, starttime):
+                continue    # calculated by another worker process
 
-            # Get the data ----------------------------------------------
+            # Skip SNCLs whose PSD metrics, corrected PSDs and histograms were written by a previous run
+            remaining = concierge.remaining_functions(function_metadata, av.snclId, starttime)
+            if not any(key in remaining for key in ("PSD","PSDText","PDF")):
+                logger.info('%03d Skipping PSD values for %s, already calculated' % (index, av.snclId))
+                continue
 
-            # NOTE:  Use the requested starttime and endtime
-            try:
-                r_stream = concierge.get_dataselect(av.network, av.station, av.location, av.channel,starttime,endtime, inclusiveEnd=False)
-                if not utils.get_slot(r_stream, 'traces'):
-                    # There is no data, just bypass it
-                    continue
+            # Reuse PSDs calculated from the same data, metadata and software
+            cache_key = concierge.result_key('PSD', av, starttime, endtime, response=True)
+            cached = concierge.cached_results(cache_key, ['PSD']).get('PSD')
+            if cached is not None:
+                logger.info('%03d Using cached PSD values for %s' % (index, av.snclId))
+                (q, df, PSDcorrected, PDF) = cached
+            else:
+                logger.info('%03d Calculating PSD values for %s' % (index, av.snclId))
+
+                # Get the data ----------------------------------------------
+
+                # NOTE:  Use the requested starttime and endtime
                 try:
-                    q = utils.get_slot(r_stream, "quality")
-                except:
-                    q = ""
+                    r_stream = concierge.get_dataselect(av.network, av.station, av.location, av.channel,starttime,endtime, inclusiveEnd=False)
+                    if not utils.get_slot(r_stream, 'traces'):
+                        # There is no data, just bypass it
+                        continue
+                    try:
+                        q = utils.get_slot(r_stream, "quality")
+                    except:
+                        q = ""
                 
 
-            except Exception as e:
-                #logger.debug(e)
-                if str(e).lower().find('no data') > -1:
-                    logger.info('No data available for %s' % (av.snclId))
-                elif str(e).lower().find('multiple epochs') > -1:
-                    logger.info('Skipping %s because multiple metadata epochs found' % (av.snclId))
-                else:
-                    logger.error(e)
-                    #logger.warning('No data available for %s from %s' % (av.snclId, concierge.dataselect_url))
-                continue
+                except Exception as e:
+                    #logger.debug(e)
+                    if str(e).lower().find('no data') > -1:
+                        logger.info('No data available for %s' % (av.snclId))
+                    elif str(e).lower().find('multiple epochs') > -1:
+                        logger.info('Skipping %s because multiple metadata epochs found' % (av.snclId))
+                    else:
+                        logger.error(e)
+                        #logger.warning('No data available for %s from %s' % (av.snclId, concierge.dataselect_url))
+                    continue
 
             # Run the PSD metric ----------------------------------------
             if any(key in function_metadata for key in ("PSD","PSDText")) :
                 try:
-                    try:
-                        sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
-                        evalresp = utils.getSpectra(r_stream, sampling_rate, "PSD", concierge)
-                    except Exception as e:
-                            logger.warning('"PSD_metric" metric calculation failed for %s: %s' % (av.snclId, e))
+                    if cached is None:
+                        try:
+                            sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
+                            evalresp = utils.getSpectra(r_stream, sampling_rate, "PSD", concierge)
+                        except Exception as e:
+                                logger.warning('"PSD_metric" metric calculation failed for %s: %s' % (av.snclId, e))
+                                cache_key = None    # do not cache PSDs without a known response
 
-                    # get corrected PSD
-                    try:
-                        (df, PSDcorrected, PDF) = irismustangmetrics.apply_PSD_metric(concierge, r_stream, evalresp=evalresp)
-                    except Exception as e:
-                        raise
+                        # get corrected PSD
+                        try:
+                            (df, PSDcorrected, PDF) = irismustangmetrics.apply_PSD_metric(concierge, r_stream, evalresp=evalresp)
+                        except Exception as e:
+                            raise
+                        concierge.cache_result(cache_key, 'PSD', (q, df, PSDcorrected, PDF))
 
                     if not df.empty:
                         dataframes.append(df)
 
+                    if any(metric in concierge.metric_names for metric in ("psd_corrected","pdf")):
+                        # Store the day's histogram so that PDFs can be aggregated without rereading the PSDs
+                        if not q == "":
+                            target = '%s.%s' % (av.snclId, q)
+                        else:
+                            target = av.snclId
+                        try:
+                            values = utils.format_numeric_df(PSDcorrected[['freq','power']].copy(), sigfigs=concierge.sigfigs).astype(float)
+                            hist = PDF_aggregator.histogram_to_sparse(*PDF_aggregator.histogram_PSDs(values['freq'], values['power']))
+                            PDF_aggregator.write_PSD_histogram(hist, target, str(starttime.date), concierge)
+                        except Exception as e:
+                            logger.debug(e)
+                            logger.warning('Unable to store the PSD histogram for %s' % target)
+
                     if "psd_corrected" in concierge.metric_names :
                         # Write out the corrected PSDs
                         # Do it this way to have each individual day file properly named with starttime.date
                         subFolder = '%s/%s/%s/' % (concierge.psd_dir, av.network, av.station)
                         if not q == "":
-                            filename = '%s.%s_%s_PSDCorrected.csv' % (av.snclId, q, starttime.date)
+                            filename = '%s.%s_%s_PSDCorrected.%s' % (av.snclId, q, starttime.date, concierge.psd_format)
                         else:
-                            filename = '%s_%s_PSDCorrected.csv' % (av.snclId, starttime.date)
+                            filename = '%s_%s_PSDCorrected.%s' % (av.snclId, starttime.date, concierge.psd_format)
                         filepath = subFolder + filename
                         
                         if concierge.output == 'csv':
@@ -146,7 +184,10 @@ def PSD_metrics(concierge):
                                 
                             PSDcorrected.rename(columns={'freq':'frequency'}, inplace=True)
                             PSDcorrected = PSDcorrected[['target','starttime','endtime','frequency','power']]
-                            utils.write_numeric_df(PSDcorrected, filepath, concierge, sigfigs=concierge.sigfigs)
+                            if concierge.output == 'csv' and concierge.psd_format == 'npz':
+                                utils.write_psd_npz(PSDcorrected, filepath, sigfigs=concierge.sigfigs)
+                            else:
+                                utils.write_numeric_df(PSDcorrected, filepath, concierge, sigfigs=concierge.sigfigs)
                         except Exception as e:
                             logger.debug(e)
                             logger.error('Unable to write %s' % (filepath))
@@ -163,8 +204,44 @@ def PSD_metrics(concierge):
                         logger.error(e)
                     logger.warning('"PSD" metric calculation failed for %s' % (av.snclId))
                     continue
+
+            # Record the functions done with this SNCL-day, see completed_units
+            if sink is not None and completed_units.covers_day(starttime, endtime):
+                for function in ("PSD","PSDText","PDF"):
+                    if function in remaining:
+                        sink.append(concierge.completed_unit(function, av.snclId, starttime))
             
 
+    #########################
+    def do_stored_psd(concierge, starttime, endtime):
+        # PSD metrics from the corrected PSDs stored by an earlier run, see PSD_derived
+        if "PSD" not in function_metadata:
+            return
+        selected = []
+        def select(targets):
+            for snclId in sorted(set('.'.join(target.split('.')[:4]) for target in targets)):
+                if not concierge.assigned(snclId, starttime):
+                    continue    # calculated by another worker process
+                if "PSD" not in concierge.remaining_functions(function_metadata, snclId, starttime):
+                    logger.info('Skipping PSD values for %s, already calculated' % snclId)
+                    continue
+                selected.append(snclId)
+            return [target for target in targets if '.'.join(target.split('.')[:4]) in selected]
+
+        try:
+            df = PSD_derived.PSD_derived_metrics(concierge, starttime, endtime, select)
+        except Exception as e:
+            logger.debug(e)
+            logger.warning('"PSD" metric calculation from stored PSDs failed for %s' % starttime.date)
+            return
+        if df is not None and not df.empty:
+            dataframes.append(df)
+
+        # Record the SNCL-days done, see completed_units
+        if sink is not None and completed_units.covers_day(starttime, endtime):
+            for snclId in selected:
+                sink.append(concierge.completed_unit("PSD", snclId, starttime))
+
     #########################
     def do_pdf(concierge, starttime, endtime):
         
@@ -195,12 +272,7 @@ def PSD_metrics(concierge):
                     
                 for day in daylist:
                     day = day.strftime("%Y-%m-%d")
-                    files = []
-                    for sncl_pat in sncl_pattern.split(','):
-                        fnames = sncl_pat + "_" + str(day) + "_PSDCorrected.csv"
-                        for root, dirnames, filenames in os.walk(concierge.psd_dir):
-                            for filename in fnmatch.filter(filenames, fnames):
-                                files.append(os.path.join(root, filename))
+                    files = utils.find_psd_files(concierge.psd_dir, sncl_pattern, [day], suffixes=utils.PSD_SUFFIXES + ('PSDHistogram.csv',))
                     
                     #files = glob.glob(filename,recursive=True)
                     if files:
@@ -241,6 +313,7 @@ def PSD_metrics(concierge):
                 
             elif concierge.output == 'db':
                 logger.debug("Looking for %s targets in %s PSD table for %s to %s" % (sncl_pattern, concierge.db_name, starttime.date, endtime.date))
+                database.get_writer(concierge.db_name)    # opening the database creates the indexes the queries use
                 db_sncl_pattern = sncl_pattern.replace('*','%').replace('?','_')
                 
                 ## No longer required, since PSDs now have quality codes
@@ -253,15 +326,23 @@ def PSD_metrics(concierge):
                     db_sncl_pattern = ('%s*' % db_sncl_pattern).replace("*","%")
                     logger.info("No quality code specified, wildcarding it")
                 
-                # Retrieve all targets that match
+                # Retrieve all targets that match, from the PSDs and from the stored daily histograms
+                try:
+                    histList = utils.retrieve_psd_histogram_unique_targets(concierge.db_name, db_sncl_pattern, starttime.date, endtime.date)
+                except Exception as e:
+                    histList = []
                 try:
                     snclList = utils.retrieve_psd_unique_targets(concierge.db_name, db_sncl_pattern, starttime, endtime, logger) 
                 except Exception as e:
-                    if "no such table" in str(e):
+                    if histList:
+                        snclList = []
+                    elif "no such table" in str(e):
                         logger.warning("Unable to access table %s in %s" % (str(e).split(":")[1], concierge.db_name))
+                        return "No Table"
                     else:
                         logger.warning("Unable to access PSD values for %s %s - %s" % (sncl_pattern, starttime, endtime))
-                    return "No Table"
+                        return "No Table"
+                snclList = snclList + [sncl for sncl in histList if sncl not in snclList]
                 
                 for (index, sncl) in enumerate(snclList):
                     logger.info('%03d Calculating PDF values for %s' % (index, sncl))
@@ -284,7 +365,9 @@ def PSD_metrics(concierge):
 
     # Loop over days and calculate PSDs and/or PDFs -----------------------
 
-    if (concierge.resp_dir):   # if resp_dir: run evalresp on local RESP file instead of web service
+    if concierge.stored_psds:  # PSD metrics are derived from stored PSDs, no response needed
+        logger.info("Using stored corrected PSDs from '%s'" % (concierge.psd_dir if concierge.output == 'csv' else concierge.db_name))
+    elif (concierge.resp_dir):   # if resp_dir: run evalresp on local RESP file instead of web service
         logger.info("Searching for response files in '%s'" % concierge.resp_dir)
     else:                   # try to connect to irisws/evalresp
         try:
@@ -307,7 +390,7 @@ def PSD_metrics(concierge):
     
     if any(key in function_metadata for key in ("PSD","PSDText")):
 
-        if concierge.station_client is None:
+        if concierge.station_client is None and not concierge.stored_psds:
             try:
                 initialAvailability = concierge.get_availability("PSDs", starttime=start,endtime=end)
             except NoAvailableDataError as e:
@@ -331,7 +414,12 @@ def PSD_metrics(concierge):
             if starttime == end:
                 continue
             
-            do_psd(concierge,starttime, endtime)
+            if not concierge.in_shard(starttime):
+                continue    # days calculated by another worker process
+            if concierge.stored_psds:
+                do_stored_psd(concierge, starttime, endtime)
+            else:
+                do_psd(concierge,starttime, endtime)
                 
 
     if ("pdf" in concierge.metric_names) and ('daily' in concierge.pdf_interval):
@@ -370,6 +458,10 @@ def PSD_metrics(concierge):
         logger.warning('"PSD" metric calculation generated zero metrics')
         return None
 
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
+
     else:
 
         # make a dummy data frame in the case of just creating PDF with no supporting DF statistics
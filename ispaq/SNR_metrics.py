@@ -19,15 +19,17 @@ from . import irisseismic
 from . import irismustangmetrics
 
 
-def SNR_metrics(concierge):
+def SNR_metrics(concierge, sink=None):
     """
     Generate *SNR* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expiditer.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
     
     :rtype: pandas dataframe
-    :return: Dataframe of simple metrics.
+    :return: Dataframe of simple metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -54,8 +56,9 @@ def SNR_metrics(concierge):
         logger.warning('No station metadata found for SNR metrics')
         return None
 
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: utils.select_metrics(df, concierge.metric_names))
 
     # get initial availability for entire time range
     start = concierge.requested_starttime
@@ -83,6 +86,9 @@ def SNR_metrics(concierge):
     
 
     for (index, event) in events.iterrows():
+        if not concierge.assigned(None, event.time):
+            continue    # calculated by another worker process
+
         logger.info('%03d Magnitude %3.1f Time %s event: %s' % (int(index), event.magnitude, event.time.strftime("%Y-%m-%dT%H:%M:%S"), event.eventLocationName))
         
         # Sanity check
@@ -222,6 +228,9 @@ def SNR_metrics(concierge):
     if len(dataframes) == 0:
         logger.warn('"SNR" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
@@ -0,0 +1,70 @@
+"""
+ISPAQ Python interface returning metrics as dataframes.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+
+# ISPAQ modules
+try:
+    from ispaq import build_parser, run_request
+except:
+    from .ispaq import build_parser, run_request
+
+# Command line arguments that are not part of a request
+NOT_PREFERENCES = ('metrics', 'stations', 'starttime', 'endtime', 'queue', 'worker', 'serve',
+                   'log_level', 'append', 'version', 'install_r', 'update_r', 'list_metrics')
+
+
+def compute(metrics, sncls, starttime=None, endtime=None, write=False, logger=None, **prefs):
+    """
+    Calculate metrics and return them as dataframes.
+    :param metrics: Metrics alias defined in the preference file, or one or more
+        metric names as a comma-separated string or a list.
+    :param sncls: Station_SNCLs alias defined in the preference file, or one or more
+        SNCL[Q] patterns as a comma-separated string or a list.
+    :param starttime: Start time in a format understood by obspy.UTCDateTime, see
+        ispaq --help.
+    :param endtime: End time, default=starttime + 1 day.
+    :param write: Also write the metrics to the csv files or database, as ispaq does.
+    :param logger: Logger, default=the 'ispaq.api' logger.
+    :param prefs: Any other ispaq argument with the same name as on the command line,
+        e.g. preferences_file, dataselect_url, station_url, resp_dir, processes or cache_dir.
+    :return: Dictionary of metrics dataframes by business logic, e.g. {'simple': df}.
+        Business logic that calculated no metrics is left out.
+
+    The request is calculated in this process, which keeps R and the ISPAQ modules
+    loaded for the next request. Files other than the metric tables, such as corrected
+    PSDs and PDF plots, are written as usual.
+
+    .. rubric:: Example
+
+    >>> frames = compute('basicStats', 'IU.ANMO.00.BH?', '2010-04-20',
+    ...                  preferences_file='preference_files/default.txt')  #doctest: +SKIP
+    >>> frames['simple'].head()  #doctest: +SKIP
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    args = build_parser().parse_args([])
+    args.metrics = metrics if isinstance(metrics, str) else ','.join(metrics)
+    args.stations = sncls if isinstance(sncls, str) else ','.join(sncls)
+    args.starttime = None if starttime is None else str(starttime)
+    args.endtime = None if endtime is None else str(endtime)
+    for name in prefs:
+        if name in NOT_PREFERENCES or not hasattr(args, name):
+            raise TypeError("compute() got an unexpected keyword argument '%s'" % name)
+        setattr(args, name, prefs[name])
+
+    frames = {}
+    try:
+        run_request(args, logger, frames=frames, write=write)
+    except SystemExit:
+        # ISPAQ logs the reason as a critical message before exiting
+        raise ValueError("Invalid ISPAQ request, see the log messages")
+    return frames
@@ -0,0 +1,111 @@
+"""
+ISPAQ record of the metric functions calculated for each SNCL-day, read by --resume.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import fnmatch
+
+import pandas as pd
+from obspy import UTCDateTime
+
+try:
+    import database
+except:
+    from . import database
+
+
+# Suffix of the .csv file written next to each metrics file
+CSV_SUFFIX = '_completedUnits.csv'
+CSV_COLUMNS = ['function', 'target', 'day']
+
+
+def unit_key(function, snclId, starttime):
+    """
+    Name a metric function calculated for one SNCL-day.
+    :param function: Metric function name, e.g. 'basicStats'.
+    :param snclId: SNCL, with or without quality code.
+    :param starttime: Any time of the day, UTCDateTime.
+    :return: (function, SNCL, YYYY-MM-DD) tuple.
+    """
+    return (function, '.'.join(snclId.split('.')[:4]), starttime.strftime('%Y-%m-%d'))
+
+
+def covers_day(starttime, endtime):
+    """
+    Check whether a time window covers the whole day it starts on.
+    :param starttime: Start of the window, UTCDateTime.
+    :param endtime: End of the window, UTCDateTime.
+    :return: False for windows cut to the requested hours, e.g. a request ending at noon.
+
+    Units are recorded for whole days only, so that extending a request with
+    --resume calculates the rest of a partial day.
+    """
+    day = UTCDateTime(starttime.date)
+    return starttime <= day and endtime >= day + 86400
+
+
+class CompletedUnit(object):
+    """
+    Marker appended to a metric sink once a metric function is done with a SNCL-day.
+
+    :type function: str
+    :param function: Metric function name, e.g. 'basicStats'.
+    :type snclId: str
+    :param snclId: SNCL, with or without quality code.
+    :type starttime: :class:`~obspy.core.utcdatetime.UTCDateTime`
+    :param starttime: Start of the day.
+
+    Sinks pass markers on in the order of the metrics, and the unit is recorded
+    once the metrics appended before it are written. Units are recorded even when
+    the function produced no metrics, e.g. numSpikes for an LH channel, so that
+    a resumed run does not calculate them again.
+    """
+    def __init__(self, function, snclId, starttime):
+        self.key = unit_key(function, snclId, starttime)
+
+
+def csv_path(filepath):
+    """
+    Return the file recording the completed units of a metrics file.
+    :param filepath: Metrics .csv file, e.g. 'csv/example_simpleMetrics.csv'.
+    """
+    return os.path.splitext(filepath)[0] + CSV_SUFFIX
+
+
+def write(keys, concierge, filepath):
+    """
+    Record completed units.
+    :param keys: List of keys returned by unit_key().
+    :param concierge: Data access expediter.
+    :param filepath: Metrics .csv file the units belong to, used for csv output.
+    """
+    if len(keys) == 0:
+        return
+    if concierge.output == 'db':
+        database.get_writer(concierge.db_name).upsert('completed_units', keys)
+    elif concierge.output == 'csv':
+        unitpath = csv_path(filepath)
+        pd.DataFrame(keys, columns=CSV_COLUMNS).to_csv(unitpath, mode='a', index=False,
+                                                       header=not os.path.isfile(unitpath))
+
+
+def retrieve_files(csv_dir):
+    """
+    List the units recorded next to the metrics files in a directory.
+    :param csv_dir: Directory with *Metrics.csv files.
+    :return: Set of keys returned by unit_key().
+    """
+    completed = set()
+    for filename in sorted(fnmatch.filter(os.listdir(csv_dir), '*' + CSV_SUFFIX)):
+        try:
+            df = pd.read_csv(os.path.join(csv_dir, filename), usecols=CSV_COLUMNS, dtype=str, keep_default_na=False)
+        except (ValueError, pd.errors.EmptyDataError):
+            continue
+        completed.update(zip(df.function, df.target, df.day))
+    return completed
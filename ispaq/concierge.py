@@ -17,6 +17,7 @@ import fileinput
 import fnmatch
 import tempfile
 import datetime
+import multiprocessing
 
 import pandas as pd
 import numpy as np
@@ -32,26 +33,56 @@ from obspy import UTCDateTime
 try:
     from user_request import UserRequest
     import irisseismic
+    import irismustangmetrics
     import utils
+    import database
+    import completed_units
+    from result_cache import ResultCache
+    from worker_pool import UnitAssignment
 except:
     from .user_request import UserRequest
     from . import irisseismic
+    from . import irismustangmetrics
     from . import utils
+    from . import database
+    from . import completed_units
+    from .result_cache import ResultCache
+    from .worker_pool import UnitAssignment
 
 
 # Custom exceptions
 
 class NoAvailableDataError(Exception):
     """No matching data are available."""
-    
 
-class Concierge(object):
+
+class SharedSources(object):
+    """
+    Inputs read from the data sources, shared by the Concierges of several requests.
+
+    Requests calculated one after the other in the same process, such as the jobs
+    of a manifest, reuse the parsed StationXML, the list of local data files, the
+    availability of identical requests, the event catalog and instrument responses
+    instead of reading them again. Everything is keyed by its source, so requests
+    with different sources can share the same object.
+    """
+    def __init__(self):
+        self.inventories = {}     # (StationXML file, size, mtime) -> Inventory
+        self.data_files = {}      # dataselect_url -> [(root, file names)]
+        self.availability = {}    # request sources, SNCL patterns and time window -> dataframe
+        self.events = {}          # event_url -> Concierge.event_cache
+        self.responses = {}       # response source, SNCL, time and frequencies -> evalresp dataframe
+
+
+class Concierge(UnitAssignment):
     """
     ISPAQ Data Access Expediter.
 
     :type user_request: :class:`~ispaq.concierge.user_request`
     :param user_request: User request containing the combination of command-line
         arguments and information from the parsed user preferences file.
+    :type shared: :class:`~ispaq.concierge.SharedSources`
+    :param shared: Inputs shared with the Concierges of other requests, or None.
 
     :rtype: :class:`~ispaq.concierge` or ``None``
     :return: ISPAQ Concierge.
@@ -60,7 +91,7 @@ class Concierge(object):
 
     TODO:  include doctest examples
     """
-    def __init__(self, user_request=None, logger=None):
+    def __init__(self, user_request=None, logger=None, shared=None):
         """
         Initializes the ISPAQ data access expediter.
 
@@ -69,6 +100,7 @@ class Concierge(object):
         # Keep the entire UserRequest and logger
         self.user_request = user_request
         self.logger = logger
+        self.shared = shared
         
         # Copy important UserRequest properties to the Concierge for simpler access
         self.requested_starttime = user_request.requested_starttime
@@ -119,8 +151,25 @@ class Concierge(object):
         self.pdf_interval = user_request.pdf_interval
         self.plot_include = user_request.plot_include
         self.sigfigs = user_request.sigfigs
+        self.psd_format = user_request.psd_format
         self.sncl_format = user_request.sncl_format
         self.sds_files = user_request.sds_files
+        self.stored_psds = user_request.stored_psds
+        self.resume = user_request.resume
+        self.cache_dir = user_request.cache_dir
+        self.processes = user_request.processes
+        if self.processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            self.logger.warning("Worker processes are not supported on this platform, calculating metrics serially")
+            self.processes = 1
+        self.shard = user_request.shard
+
+        # Share of the SNCL-days calculated by this process, see assigned()
+        self.worker = None
+        self.unit_counter = 0
+        self.current_unit = None
+        self.on_assigned = None
+        # Function taking the lease of a unit in a distributed run, see work_queue.QueueSink
+        self.claim = None
 
         self.netOrder = int(int(self.sncl_format.index("N"))/2)
         self.staOrder = int(int(self.sncl_format.index("S"))/2)
@@ -315,7 +364,7 @@ class Concierge(object):
                 else:
                     fpattern1 = '%s' % (sncl_pattern + '.[12][0-9][0-9][0-9].[0-9][0-9][0-9]')
                 fpattern2 = '%s' % (fpattern1 + '.[A-Z]')
-                for root, dirnames, fnames in os.walk(self.dataselect_url):
+                for (root, fnames) in self.list_data_files():
                     for fname in fnmatch.filter(fnames, fpattern1) + fnmatch.filter(fnames, fpattern2):
                         matching_files.append(os.path.join(root,fname))
                 if (len(matching_files) == 0):
@@ -382,6 +431,15 @@ class Concierge(object):
         # Filtered availability dataframe is stored for potential reuse
         self.filtered_availability = None
 
+        # Events are stored by get_event() arguments so that the catalog is requested once
+        if shared is None:
+            self.event_cache = {}
+        else:
+            self.event_cache = shared.events.setdefault(self.event_url, {})
+
+        # Instrument responses of earlier requests with the same source, see utils.getSpectra()
+        self.response_cache = None if shared is None else shared.responses
+
         # Add local response files if used
         if user_request.resp_dir is None:                  # use EarthScope evalresp web service
             self.resp_dir = None                           # use EarthScope evalresp web service
@@ -414,7 +472,235 @@ class Concierge(object):
         self.logger.debug("pdf_interval %s", self.pdf_interval)
         self.logger.debug("plot_include %s", self.plot_include)
         self.logger.debug("sigfigs %s", self.sigfigs)
+        self.logger.debug("psd_format %s", self.psd_format)
         self.logger.debug("sncl_format %s", self.sncl_format)
+        self.logger.debug("stored_psds %s", self.stored_psds)
+        self.logger.debug("resume %s", self.resume)
+        self.logger.debug("cache_dir %s", self.cache_dir)
+        self.logger.debug("processes %s", self.processes)
+        self.logger.debug("shard %s", self.shard)
+
+        # Cache of metric results, used for local data only
+        self.result_cache = None
+        if self.cache_dir is not None:
+            if self.dataselect_client is not None:
+                self.logger.info("Metric results are only cached for local data, ignoring cache_dir")
+            else:
+                try:
+                    if not os.path.exists(self.cache_dir):
+                        self.logger.info("cache_dir %s does not exist, creating directory" % self.cache_dir)
+                        os.makedirs(self.cache_dir)
+                    self.result_cache = ResultCache(self.cache_dir, irismustangmetrics.package_versions())
+                except Exception as e:
+                    self.logger.debug(e)
+                    self.logger.warning("Unable to use cache_dir %s, metric results will not be cached" % self.cache_dir)
+
+        # Metrics and units of work written by previous runs, skipped when resuming
+        self.completed = set()          # (metricName, SNCL, start, end)
+        self.completed_starts = set()   # (metricName, SNCL, start)
+        self.completed_units = set()
+        if self.resume:
+            self.load_completed()
+
+    def load_completed(self):
+        """
+        Read the metrics and units of work written by previous runs.
+        """
+        try:
+            if self.output == 'db':
+                rows = database.retrieve_completed(self.db_name)
+                targets = utils.sncl_targets(row[1] for row in rows)
+                self.completed = set((row[0], target) + tuple(row[2:]) for row, target in zip(rows, targets))
+                self.completed_units = database.retrieve_completed_units(self.db_name)
+            else:
+                self.completed = utils.retrieve_completed_files(self.csv_dir, self.psd_dir)
+                self.completed_units = completed_units.retrieve_files(self.csv_dir)
+        except Exception as e:
+            self.logger.debug(e)
+            self.logger.warning("Unable to read previous results, all metrics will be calculated")
+            self.completed = set()
+            self.completed_units = set()
+        self.completed_starts = set(key[:3] for key in self.completed)
+        self.logger.info("Resuming: %d metric results and %d metric function units already written will be skipped" %
+                         (len(self.completed), len(self.completed_units)))
+
+    def is_completed(self, metric, snclId, starttime):
+        """
+        Check whether a metric was written by a previous run.
+        :param metric: Metric name.
+        :param snclId: SNCL, with or without quality code.
+        :param starttime: Start time of the metric, UTCDateTime.
+        :return: True if resuming and the metric is already in the output, whatever its end time.
+        """
+        if not self.completed_starts:
+            return False
+        start = utils.format_times([starttime])[0]
+        return (metric, utils.sncl_targets([snclId])[0], start) in self.completed_starts
+
+    def remaining_functions(self, function_metadata, snclId, starttime):
+        """
+        Select the metric functions that still have to be calculated.
+        :param function_metadata: Dictionary of metric functions, e.g. function_by_logic['simple'],
+            or list of metric names for business logic that calculates metrics one by one.
+        :param snclId: SNCL, with or without quality code.
+        :param starttime: Start of the day, UTCDateTime.
+        :return: Dictionary (or list) of the functions that were not recorded as calculated
+            for this SNCL-day by a previous run, see completed_units.
+
+        Outputs of versions that did not record units are matched by their metrics instead.
+        Once units are recorded, only they are used, as units that cover part of a day,
+        e.g. the last day of a request ending at noon, are not recorded but have metrics.
+        """
+        if not (self.completed or self.completed_units):
+            return function_metadata
+        def remaining(function):
+            if self.completed_units:
+                return completed_units.unit_key(function, snclId, starttime) not in self.completed_units
+            metrics = function_metadata[function]['metrics'] if isinstance(function_metadata, dict) else [function]
+            return not all(self.is_completed(metric, snclId, starttime) for metric in metrics)
+        if isinstance(function_metadata, dict):
+            return dict((function, function_metadata[function]) for function in function_metadata if remaining(function))
+        return [function for function in function_metadata if remaining(function)]
+
+    def completed_unit(self, function, snclId, starttime):
+        """
+        Create the marker appended to a sink once a metric function is done with a SNCL-day.
+        :param function: Metric function name, e.g. 'basicStats'.
+        :param snclId: SNCL, with or without quality code.
+        :param starttime: Start of the day, UTCDateTime.
+        :return: :class:`~ispaq.completed_units.CompletedUnit`
+        """
+        return completed_units.CompletedUnit(function, snclId, starttime)
+
+    def local_data_files(self, network, station, location, channel, starttime, endtime):
+        """
+        Find the local miniSEED files that get_dataselect() reads for a SNCL.
+        :param starttime: Start of the time window, UTCDateTime.
+        :param endtime: End of the time window, UTCDateTime.
+        :return: List of file paths, one or more per day.
+        """
+        _sncl_pattern = self.get_sncl_pattern(network, station, location, channel)
+        nday = int((endtime - .00001).julday - starttime.julday) + 1
+        fpatterns = []
+        for day in range(nday):
+            start = starttime + day * 86400
+            if self.sds_files:
+                fpatterns.append('%s.D.%s' % (_sncl_pattern, start.strftime('%Y.%j')))
+            else:
+                fpatterns.append('%s.%s' % (_sncl_pattern, start.strftime('%Y.%j')))
+
+        matching_files = []
+        for (root, fnames) in self.list_data_files():
+            for fpattern in fpatterns:
+                for fname in fnmatch.filter(fnames, fpattern) + fnmatch.filter(fnames, fpattern + '.[A-Z]'):
+                    matching_files.append(os.path.join(root, fname))
+        return matching_files
+
+    def result_key(self, logic, av, starttime, endtime, response=False):
+        """
+        Fingerprint the inputs of the metrics of one SNCL and time window.
+        :param logic: Business logic name, e.g. 'simple'.
+        :param av: Row of the availability dataframe describing the channel.
+        :param starttime: Start of the time window, UTCDateTime.
+        :param endtime: End of the time window, UTCDateTime.
+        :param response: True if the metrics depend on the instrument response.
+        :return: Key for cached_results() and cache_result(), or None when results are not cached.
+
+        The key covers the miniSEED files, the metadata epoch in av and the RESP files
+        of the channel, so it changes when any of them is corrected. Responses from the
+        evalresp web service are not covered, so metrics that depend on the response
+        are only cached when the channel has a RESP file in resp_dir.
+        """
+        if self.result_cache is None:
+            return None
+        data_files = self.local_data_files(av.network, av.station, av.location, av.channel, starttime, endtime)
+        resp_files = []
+        if self.resp_dir:
+            for name in (".".join(["RESP", av.network, av.station, av.location, av.channel]),
+                         ".".join(["RESP", av.station, av.network, av.location, av.channel])):
+                resp_files.extend(f for f in (os.path.join(self.resp_dir, name), os.path.join(self.resp_dir, name + ".txt")) if os.path.exists(f))
+        if response and len(resp_files) == 0:
+            return None
+        metadata = sorted((column, str(value)) for (column, value) in av.items())
+
+        return self.result_cache.key(logic, av.snclId, str(starttime), str(endtime),
+                                     self.result_cache.file_fingerprint(data_files, self.dataselect_url),
+                                     self.result_cache.file_fingerprint(resp_files),
+                                     metadata, self.station_url, self.resp_dir is not None)
+
+    def cached_results(self, key, functions):
+        """
+        Return the cached results of metric functions.
+        :param key: Key returned by result_key(), or None.
+        :param functions: Metric function names.
+        :return: Dictionary of function name and result for the functions found in the cache.
+        """
+        results = {}
+        if key is not None:
+            for function in functions:
+                result = self.result_cache.get(key, function)
+                if result is not None:
+                    results[function] = result
+        return results
+
+    def cache_result(self, key, function, result):
+        """
+        Store the result of a metric function in the cache.
+        :param key: Key returned by result_key(), or None.
+        :param function: Metric function name.
+        :param result: Result to store, usually a dataframe.
+        """
+        if key is None:
+            return
+        try:
+            self.result_cache.put(key, function, result)
+        except Exception as e:
+            self.logger.debug(e)
+            self.logger.warning("Unable to cache '%s' results in %s" % (function, self.cache_dir))
+
+    def drop_completed(self, df):
+        """
+        Remove metrics written by a previous run.
+        :param df: Dataframe of metrics with columns metricName, snclq, starttime and endtime.
+        :return: Dataframe of the metrics not yet written.
+
+        Metrics with the same start but a different end, e.g. those of a whole day
+        recalculated after a run that ended at noon, are kept.
+        """
+        if not self.completed or df is None or df.empty:
+            return df
+        keys = zip(df.metricName, utils.sncl_targets(df.snclq), utils.format_times(df.starttime),
+                   utils.format_times(df.endtime))
+        keep = [key not in self.completed for key in keys]
+        return df[keep].reset_index(drop=True)
+
+    def read_inventory(self):
+        """
+        Read the local StationXML file, reusing the inventory parsed for an earlier request.
+        :return: obspy Inventory.
+        """
+        stat = os.stat(self.station_url)
+        key = (os.path.abspath(self.station_url), stat.st_size, stat.st_mtime_ns)
+        if self.shared is not None and key in self.shared.inventories:
+            self.logger.debug("Reusing StationXML file %s" % self.station_url)
+            return self.shared.inventories[key]
+        self.logger.info("Reading StationXML file %s" % self.station_url)
+        inventory = obspy.read_inventory(self.station_url, format="STATIONXML")
+        if self.shared is not None:
+            self.shared.inventories[key] = inventory
+        return inventory
+
+    def list_data_files(self):
+        """
+        List the local data files, reusing the list made for an earlier request.
+        :return: List of (directory, file names) in dataselect_url.
+        """
+        if self.shared is not None and self.dataselect_url in self.shared.data_files:
+            return self.shared.data_files[self.dataselect_url]
+        data_files = [(root, fnames) for (root, dirnames, fnames) in os.walk(self.dataselect_url)]
+        if self.shared is not None:
+            self.shared.data_files[self.dataselect_url] = data_files
+        return data_files
 
     def get_sncl_pattern(self, netIn, staIn, locIn, chanIn):  
         snclList = list()
@@ -534,12 +820,18 @@ class Concierge(object):
 
             # Only read/parse if we haven't already done so
 
+            # Requests with the same sources, SNCL patterns and time window build the same dataframe
+            availability_key = (self.station_url, self.dataselect_url, tuple(self.sncl_patterns),
+                                str(starttime or self.requested_starttime), str(endtime or self.requested_endtime),
+                                network, station, location, channel, self.sds_files, self.sncl_format)
+            if self.initial_availability is None and self.shared is not None and availability_key in self.shared.availability:
+                self.initial_availability = self.shared.availability[availability_key].copy()
+
             if self.initial_availability is None:
                 try:
                     # Get list of all sncls we have metadata for
                     if self.station_url is not None:            
-                        self.logger.info("Reading StationXML file %s" % self.station_url)
-                        sncl_inventory = obspy.read_inventory(self.station_url, format="STATIONXML")
+                        sncl_inventory = self.read_inventory()
                         
                 except Exception as e:
                     err_msg = "The StationXML file: '%s' is not valid" % self.station_url
@@ -661,7 +953,7 @@ class Concierge(object):
 
                             matching_files = []
 
-                            for root, dirnames, fnames in os.walk(self.dataselect_url):
+                            for (root, fnames) in self.list_data_files():
                                 for fname in fnmatch.filter(fnames, fpattern1) + fnmatch.filter(fnames, fpattern2):
                                     if(self.sds_files):
                                         position5 = fname.split('.')[5]
@@ -706,6 +998,8 @@ class Concierge(object):
 
                 # Now save the dataframe internally
                 self.initial_availability = df
+                if self.shared is not None:
+                    self.shared.availability[availability_key] = df.copy()
 
         # Container for all of the individual sncl_pattern dataframes generated
         sncl_pattern_dataframes = []
@@ -903,7 +1197,7 @@ class Concierge(object):
                 fpattern2 = '%s' % (fpattern1 + '.[A-Z]')
                 
                 matching_files = []
-                for root, dirnames, fnames in os.walk(self.dataselect_url):
+                for (root, fnames) in self.list_data_files():
                     for fname in fnmatch.filter(fnames, fpattern1) + fnmatch.filter(fnames, fpattern2):
                         if(self.sds_files):
                             position5 = fname.split('.')[5]
@@ -1071,7 +1365,7 @@ class Concierge(object):
                 fpattern2 = '%s' % (fpattern1 + '.[A-Z]')
                 
                 matching_files = []
-                for root, dirnames, fnames in os.walk(self.dataselect_url):
+                for (root, fnames) in self.list_data_files():
                     for fname in fnmatch.filter(fnames, fpattern1) + fnmatch.filter(fnames, fpattern2):
                         matching_files.append(os.path.join(root,fname))
 
@@ -1398,6 +1692,12 @@ class Concierge(object):
         else:
             _endtime = endtime
 
+        # Every business logic and worker process uses the same catalog
+        event_key = (str(_starttime), str(_endtime), minmag, maxmag, magtype, mindepth, maxdepth)
+        if event_key in self.event_cache:
+            events = self.event_cache[event_key]
+            return None if events is None else events.copy()
+
         if self.event_client is None:
             # Read local QuakeML file
             try:
@@ -1468,9 +1768,9 @@ class Concierge(object):
                 raise
 
         if events.shape[0] == 0:
-            return None # TODO:  raise an exception
-        else:
-            return events
+            events = None # TODO:  raise an exception
+        self.event_cache[event_key] = events
+        return None if events is None else events.copy()
 
 
 
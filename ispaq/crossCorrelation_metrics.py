@@ -27,15 +27,17 @@ from . import irisseismic
 from . import irismustangmetrics
 
 
-def crossCorrelation_metrics(concierge):
+def crossCorrelation_metrics(concierge, sink=None):
     """
     Generate *crossCorrelation* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expiditer.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
     
     :rtype: pandas dataframe
-    :return: Dataframe of simple metrics.
+    :return: Dataframe of simple metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -82,8 +84,9 @@ def crossCorrelation_metrics(concierge):
         
     
         
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: utils.select_metrics(df, concierge.metric_names))
 
     #############################################################
     ## Loop through each event.
@@ -92,6 +95,9 @@ def crossCorrelation_metrics(concierge):
     logger.info('Calculating crossCorrelation metrics for %d events' % events.shape[0])
 
     for (index, event) in events.iterrows():
+        if not concierge.assigned(None, event.time):
+            continue    # calculated by another worker process
+
         logger.info('%03d Magnitude %3.1f event: %s %s' % (int(index), event.magnitude, event.eventLocationName, event.time.strftime("%Y-%m-%dT%H:%M:%S")))
 
         # Sanity check
@@ -354,6 +360,9 @@ def crossCorrelation_metrics(concierge):
     if len(dataframes) == 0:
         logger.warning('"cross_correlation" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
@@ -25,15 +25,17 @@ pd.options.mode.chained_assignment = None
 # A value is trying to be set on a copy of a slice from a DataFrame."
 # for line 126: availability.loc[:,'sn_lId'] = sn_lIds 
 
-def crossTalk_metrics(concierge):
+def crossTalk_metrics(concierge, sink=None):
     """
     Generate *crossTalk* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expiditer.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
     
     :rtype: pandas dataframe
-    :return: Dataframe of simple metrics.
+    :return: Dataframe of simple metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -79,8 +81,9 @@ def crossTalk_metrics(concierge):
             return None
         
         
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: utils.select_metrics(df, concierge.metric_names))
 
     #############################################################
     ## Loop through each event.
@@ -90,6 +93,8 @@ def crossTalk_metrics(concierge):
     logger.info('Calculating crossTalk metrics for %d events' % events.shape[0])
 
     for (index, event) in events.iterrows():
+        if not concierge.assigned(None, event.time):
+            continue    # calculated by another worker process
 
         logger.info('%03d Magnitude %3.1f event: %s %s' % (int(index), event.magnitude, event.eventLocationName, event.time.strftime("%Y-%m-%dT%H:%M:%S")))
         
@@ -290,6 +295,9 @@ def crossTalk_metrics(concierge):
     if len(dataframes) == 0:
         logger.warning('"cross_talk" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
@@ -0,0 +1,188 @@
+"""
+ISPAQ daemon keeping R and the ISPAQ modules loaded between requests.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+DEFAULT_ADDRESS = os.path.join(tempfile.gettempdir(), 'ispaq-%d.sock' % os.getuid())
+
+
+class ConnectionHandler(logging.Handler):
+    """
+    Send the log messages of a job to the client that submitted it.
+
+    Worker processes forked by the job inherit the handler, the lock keeps their
+    messages from interleaving on the connection.
+    """
+    def __init__(self, conn, level):
+        logging.Handler.__init__(self, level)
+        self.conn = conn
+        self.send_lock = multiprocessing.get_context('fork').Lock()
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+            with self.send_lock:
+                self.conn.send(('log', message))
+        except Exception:
+            self.handleError(record)
+
+
+def _run_job(conn, run_job, logger):
+    """
+    Calculate one request in a forked copy of the daemon.
+    """
+    try:
+        message = conn.recv_bytes()
+    except EOFError:
+        # Connection checking whether the daemon is running
+        conn.close()
+        return
+
+    handler = None
+    try:
+        job = json.loads(message.decode('utf-8'))
+        handler = ConnectionHandler(conn, getattr(logging, job.get('log_level', 'INFO')))
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s",
+                                               datefmt="%Y-%m-%d %H:%M:%S"))
+        logger.addHandler(handler)
+        result = run_job(job, logger)
+        logger.removeHandler(handler)
+        conn.send(('result', result))
+    except BaseException as e:
+        if handler is not None:
+            logger.removeHandler(handler)
+        conn.send(('error', str(e) or "Request failed, see the log messages above"))
+    finally:
+        conn.close()
+
+
+def serve(address, run_job, logger):
+    """
+    Calculate the requests sent to a local socket until interrupted.
+    :param address: Path of the Unix domain socket.
+    :param run_job: Function called with a job dictionary and the logger that calculates
+        the request and returns a picklable result.
+    :param logger: Logger.
+
+    Each request is calculated in a process forked from the daemon, so that it starts
+    with R and every module already loaded and leaves no state behind. Requests are
+    calculated one at a time; a request can use its own worker processes. The socket
+    is only accessible to the user running the daemon.
+    """
+    if os.path.exists(address):
+        try:
+            Client(address, family='AF_UNIX').close()
+        except (IOError, OSError):
+            # Left behind by a daemon that was killed
+            os.remove(address)
+        else:
+            logger.critical("An ISPAQ daemon is already listening on %s" % address)
+            raise SystemExit
+
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, family='AF_UNIX')
+    finally:
+        os.umask(umask)
+
+    ctx = multiprocessing.get_context('fork')
+    logger.info("ISPAQ daemon listening on %s" % address)
+    try:
+        while True:
+            conn = listener.accept()
+            # Not a daemon, so that the job can fork its own workers
+            process = ctx.Process(target=_run_job, args=(conn, run_job, logger))
+            process.start()
+            conn.close()
+            logger.debug("Calculating request in process %d" % process.pid)
+            process.join()
+            if process.exitcode != 0:
+                logger.error("Request process %d exited with code %s" % (process.pid, process.exitcode))
+    except KeyboardInterrupt:
+        logger.info("ISPAQ daemon stopped")
+    finally:
+        listener.close()
+
+
+def submit(address, job, log=None):
+    """
+    Send a request to a running daemon and wait for its result.
+    :param address: Path of the daemon's Unix domain socket.
+    :param job: Dictionary with 'argv', the ispaq command line arguments, 'cwd', the
+        directory they are relative to, and optionally 'user_request', the JSON
+        representation of a UserRequest, 'log_level' and 'dataframes', True to also
+        return the metrics as dataframes.
+    :param log: Function called with each log message of the request, or None.
+    :return: Result dictionary with 'outputs', the output file or database of each
+        business logic, and 'dataframes' if requested.
+    """
+    conn = Client(address, family='AF_UNIX')
+    try:
+        conn.send_bytes(json.dumps(job).encode('utf-8'))
+        while True:
+            try:
+                (kind, value) = conn.recv()
+            except EOFError:
+                raise RuntimeError("ISPAQ daemon closed the connection")
+            if kind == 'log':
+                if log is not None:
+                    log(value)
+            elif kind == 'error':
+                raise RuntimeError(value)
+            else:
+                return value
+    finally:
+        conn.close()
+
+
+def client_main():
+    """
+    Entry point of ispaq-client, which runs ispaq requests in a running daemon.
+    """
+    parser = argparse.ArgumentParser(description="Calculate an ISPAQ request in a daemon started with 'ispaq --serve'. "
+                                                 "Other arguments are passed on to ispaq.")
+    parser.add_argument('--socket', action='store', default=DEFAULT_ADDRESS,
+                        help='socket of the ISPAQ daemon, default=%s' % DEFAULT_ADDRESS)
+    parser.add_argument('--user-request', action='store', default=None,
+                        help='file containing the JSON representation of a UserRequest to calculate \ninstead of -M, -S and the preference file')
+    parser.add_argument('--log-level', action='store', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+                        help='log level printed to the console, default=INFO')
+    (args, argv) = parser.parse_known_args(sys.argv[1:])
+
+    job = {'argv': argv + ['--log-level', args.log_level],
+           'cwd': os.getcwd(),
+           'log_level': args.log_level}
+    if args.user_request is not None:
+        with open(os.path.expanduser(args.user_request), 'r') as infile:
+            job['user_request'] = infile.read()
+
+    try:
+        result = submit(args.socket, job, log=lambda line: print(line, file=sys.stderr))
+    except (IOError, OSError) as e:
+        print("ERROR: cannot connect to the ISPAQ daemon on %s: %s" % (args.socket, e), file=sys.stderr)
+        raise SystemExit(1)
+    except RuntimeError as e:
+        print("ERROR: %s" % e, file=sys.stderr)
+        raise SystemExit(1)
+
+    for logic in result['outputs']:
+        print("%s\t%s" % (logic, result['outputs'][logic]))
+
+
+if __name__ == '__main__':
+    client_main()
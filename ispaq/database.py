@@ -0,0 +1,524 @@
+"""
+ISPAQ SQLite database writer.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import multiprocessing
+from contextlib import contextmanager
+
+
+# Covering index for PSD selection by target and time, used by the PDF aggregation
+PSD_INDEX_SQL = "CREATE INDEX IF NOT EXISTS psd_corrected_target_start ON psd_corrected (target, start, frequency, power);"
+
+# Table definitions ------------------------------------------------------------
+#
+# Each kind of table is described by its data columns, the columns that identify
+# a row (the UNIQUE constraint used for upserts) and any extra statements run
+# after the table is created. Metric tables that are not listed use 'general'.
+
+TABLES = {
+    'general': {'columns': [('target','text'), ('value','float'), ('start','datetime'), ('end','datetime')],
+                'unique': ['target','start','end']},
+    'polarity_check': {'columns': [('target','text'), ('snclq2','text'), ('value','float'),
+                                   ('start','datetime'), ('end','datetime')],
+                       'unique': ['target','start','end']},
+    'transfer_function': {'columns': [('target','text'), ('gain_ratio','float'), ('phase_diff','float'),
+                                      ('ms_coherence','float'), ('start','datetime'), ('end','datetime')],
+                          'unique': ['target','start','end']},
+    'orientation_check': {'columns': [('target','text'), ('azimuth_R','float'), ('backAzimuth','float'),
+                                      ('azimuth_Y_obs','float'), ('azimuth_X_obs','float'),
+                                      ('azimuth_Y_meta','float'), ('azimuth_X_meta','float'),
+                                      ('max_Czr','float'), ('max_C_zr','float'), ('magnitude','float'),
+                                      ('start','datetime'), ('end','datetime')],
+                          'unique': ['target','start','end']},
+    'psd_corrected': {'columns': [('target','text'), ('frequency','float'), ('power','float'),
+                                  ('start','datetime'), ('end','datetime')],
+                      'unique': ['target','frequency','start'],
+                      'extra': [PSD_INDEX_SQL]},
+    'pdf': {'columns': [('target','text'), ('frequency','float'), ('power','float'), ('hits','float'),
+                        ('start','datetime'), ('end','datetime')],
+            'unique': ['target','frequency','power','start','end']},
+    'psd_histogram': {'columns': [('target','text'), ('day','text'), ('frequency','float'),
+                                  ('power','integer'), ('hits','integer')],
+                      'unique': ['target','day','frequency','power']},
+    'completed_units': {'columns': [('function','text'), ('target','text'), ('day','text')],
+                        'unique': ['function','target','day']},
+}
+
+# UPSERT (INSERT ... ON CONFLICT DO UPDATE) requires SQLite 3.24
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+def table_kind(tablename):
+    """
+    Return the kind of table used to store a metric.
+    :param tablename: Table name, usually the metric name.
+    :return: Key into TABLES.
+    """
+    return tablename if tablename in TABLES else 'general'
+
+
+def create_table_sql(tablename, kind=None):
+    """
+    Return the statements that create a table and its indexes.
+    :param tablename: Table name.
+    :param kind: Key into TABLES, defaults to table_kind(tablename).
+    :return: List of SQL statements.
+    """
+    table = TABLES[kind or table_kind(tablename)]
+    columns = ',\n'.join('%s %s NOT NULL' % column for column in table['columns'])
+    sql = """ CREATE TABLE IF NOT EXISTS %s (
+                %s,
+                lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(%s)
+            ); """ % (tablename, columns, ', '.join(table['unique']))
+    return [sql] + table.get('extra', [])
+
+
+def upsert_sql(tablename, kind=None):
+    """
+    Return the statement that inserts a row or updates the existing row with the same key.
+    :param tablename: Table name.
+    :param kind: Key into TABLES, defaults to table_kind(tablename).
+    :return: SQL statement with one parameter per data column.
+    """
+    table = TABLES[kind or table_kind(tablename)]
+    names = [name for (name, type) in table['columns']]
+    values = ', '.join('?' * len(names))
+
+    if not HAS_UPSERT:
+        return "INSERT or REPLACE INTO %s (%s) VALUES (%s)" % (tablename, ', '.join(names), values)
+
+    updates = ', '.join('%s=excluded.%s' % (name, name) for name in names if name not in table['unique'])
+    return """INSERT INTO %s (%s)
+              VALUES (%s)
+              ON CONFLICT(%s)
+              DO UPDATE SET %s, lddate=excluded.lddate;""" % (tablename, ', '.join(names), values,
+                                                             ', '.join(table['unique']), updates)
+
+
+def retrieve_completed(dbname):
+    """
+    List the metrics already stored in a database.
+    :param dbname: SQLite database file.
+    :return: List of (metricName, target, start, end) tuples.
+
+    Corrected PSDs and daily PSD histograms are listed once per target and day, as
+    metrics 'psd_corrected' and 'pdf' starting at midnight, with end None. Aggregated
+    PDFs are not listed.
+    """
+    if not os.path.isfile(dbname):
+        return []
+    conn = sqlite3.connect(dbname)
+    try:
+        tablenames = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")]
+        completed = []
+        for tablename in tablenames:
+            metric = tablename
+            if tablename in ('pdf', 'completed_units'):
+                continue
+            elif tablename == 'psd_histogram':
+                metric = 'pdf'
+                select_sql = "SELECT DISTINCT target, day || 'T00:00:00', NULL FROM psd_histogram;"
+            elif tablename == 'psd_corrected':
+                select_sql = "SELECT DISTINCT target, substr(start, 1, 10) || 'T00:00:00', NULL FROM psd_corrected;"
+            else:
+                select_sql = 'SELECT DISTINCT target, start, "end" FROM "%s";' % tablename
+            try:
+                completed.extend((metric, target, start, end) for (target, start, end) in conn.execute(select_sql))
+            except sqlite3.Error:
+                continue    # not a metric table
+    finally:
+        conn.close()
+
+    return completed
+
+
+def retrieve_completed_units(dbname):
+    """
+    List the metric functions recorded as calculated for each SNCL-day, see completed_units.
+    :param dbname: SQLite database file.
+    :return: Set of (function, target, day) tuples.
+    """
+    if not os.path.isfile(dbname):
+        return set()
+    conn = sqlite3.connect(dbname)
+    try:
+        return set(conn.execute("SELECT function, target, day FROM completed_units;"))
+    except sqlite3.OperationalError:
+        return set()    # written by a version that did not record units
+    finally:
+        conn.close()
+
+
+# Writer -----------------------------------------------------------------------
+
+class DatabaseWriter(object):
+    """
+    Write metric tables to an SQLite database through a single connection.
+
+    :type dbname: str
+    :param dbname: SQLite database file.
+
+    The database is put in WAL mode so that readers do not block the writer,
+    each table is created once per writer, and rows are written with one
+    ``executemany`` per table inside a single transaction per batch. Indexes
+    missing from tables written by older versions are created when the
+    database is opened, so that readers never need to.
+
+    .. rubric:: Example
+
+    >>> writer = DatabaseWriter(':memory:')
+    >>> with writer.transaction():
+    ...     writer.upsert('sample_mean', [('IU.ANMO.00.BHZ.M', 1.5, '2020-01-01T00:00:00', '2020-01-02T00:00:00')])
+    """
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.conn = sqlite3.connect(dbname, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self.tables = set()
+        self.depth = 0
+        self.create_indexes()
+
+    def create_indexes(self):
+        """
+        Run the extra statements of TABLES, e.g. creating indexes, for the tables that already exist.
+        """
+        existing = set(row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';"))
+        for (kind, table) in TABLES.items():
+            if kind in existing and 'extra' in table:
+                with self.transaction():
+                    for sql in table['extra']:
+                        self.conn.execute(sql)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group writes into one transaction, committed when the outermost block exits
+        and rolled back if it raises.
+        """
+        if self.depth == 0:
+            # Take the write lock up front, so that concurrent writers wait for each other
+            self.conn.execute("BEGIN IMMEDIATE")
+        self.depth += 1
+        try:
+            yield self
+        except:
+            self.depth -= 1
+            if self.depth == 0:
+                self.conn.execute("ROLLBACK")
+                # Tables created in the transaction are gone too
+                self.tables.clear()
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.conn.execute("COMMIT")
+
+    def create_table(self, tablename, kind=None):
+        """
+        Create a table and its indexes, once per writer.
+        :param tablename: Table name.
+        :param kind: Key into TABLES, defaults to table_kind(tablename).
+        """
+        if tablename in self.tables:
+            return
+        for sql in create_table_sql(tablename, kind):
+            self.conn.execute(sql)
+        self.tables.add(tablename)
+
+    def upsert(self, tablename, rows, kind=None):
+        """
+        Insert rows, replacing the values of rows that already exist.
+        :param tablename: Table name.
+        :param rows: Sequence of tuples in the column order given in TABLES.
+        :param kind: Key into TABLES, defaults to table_kind(tablename).
+        """
+        rows = list(rows)
+        with self.transaction():
+            self.create_table(tablename, kind)
+            try:
+                self.conn.executemany(upsert_sql(tablename, kind), rows)
+            except sqlite3.OperationalError:
+                # Tables created by older versions may not have the UNIQUE constraint used by ON CONFLICT
+                table = TABLES[kind or table_kind(tablename)]
+                names = [name for (name, type) in table['columns']]
+                insert_sql = "INSERT or REPLACE INTO %s (%s) VALUES (%s)" % (tablename, ', '.join(names), ', '.join('?' * len(names)))
+                self.conn.executemany(insert_sql, rows)
+
+    def replace_psd_histogram(self, target, day, rows):
+        """
+        Replace the stored PSD histogram of one SNCL-day.
+        :param target: SNCLQ of the PSDs.
+        :param day: Day of the PSDs, formatted as YYYY-MM-DD.
+        :param rows: Sequence of (frequency, power, hits) tuples.
+        """
+        with self.transaction():
+            self.create_table('psd_histogram')
+            self.conn.execute("DELETE FROM psd_histogram WHERE target = ? AND day = ?", (target, day))
+            self.conn.executemany("INSERT INTO psd_histogram (target, day, frequency, power, hits) VALUES (?, ?, ?, ?, ?)",
+                                  ((target, day) + tuple(row) for row in rows))
+
+    def close(self):
+        self.conn.close()
+
+
+# Single writer process -------------------------------------------------------
+#
+# When metrics are calculated in several processes, the rows for a database are
+# sent to one writer process instead of being written by each process.
+
+class QueuedWriter(object):
+    """
+    Send rows to the writer process of a database.
+
+    :type dbname: str
+    :param dbname: SQLite database file.
+    :param messages: multiprocessing Queue read by the writer process.
+
+    Has the interface of DatabaseWriter, so that the functions in utils write
+    through it unchanged. Rows are handed to the queue without waiting for the
+    disk; the writer process groups them into large transactions. Call sync()
+    before reading rows that may still be queued, or to learn whether rows
+    could not be written.
+    """
+    def __init__(self, dbname, messages, ctx):
+        self.dbname = dbname
+        self.messages = messages
+        self.ctx = ctx
+        # Messages sent to, written and failed by the writer process, from all processes
+        self.sent = ctx.Value('Q', 0)
+        self.written = ctx.Value('Q', 0)
+        self.failed = ctx.Value('Q', 0)
+
+    def send(self, message):
+        with self.sent.get_lock():
+            self.sent.value += 1
+        self.messages.put(message)
+
+    @contextmanager
+    def transaction(self):
+        # The writer process groups rows into its own transactions
+        yield self
+
+    def create_table(self, tablename, kind=None):
+        self.send(('create', (tablename, kind), None))
+
+    def upsert(self, tablename, rows, kind=None):
+        rows = list(rows)
+        if rows:
+            self.send(('upsert', (tablename, kind), rows))
+
+    def replace_psd_histogram(self, target, day, rows):
+        self.send(('psd_histogram', (target, day), list(rows)))
+
+    def sync(self):
+        """
+        Wait until every row sent so far, by any process, is in the database or has failed.
+        :return: Number of messages the writer process could not write since it started.
+        """
+        sent = self.sent.value
+        if self.written.value + self.failed.value >= sent:
+            return self.failed.value
+        (receiver, sender) = self.ctx.Pipe(duplex=False)
+        self.messages.put(('sync', sender, None))
+        receiver.recv()
+        return self.failed.value
+
+    def close(self):
+        pass
+
+
+def _write_messages(dbname, messages, written, failed, logger, batch_rows, flush_seconds):
+    """
+    Write the rows sent by QueuedWriters, in batches.
+    """
+    writer = DatabaseWriter(dbname)
+    batch = []    # messages in the order received
+    pending = {'rows': 0, 'since': None}
+
+    def write(batch):
+        # One transaction; the last histogram received for a SNCL-day replaces the others
+        upserts = {}
+        histograms = {}
+        for (kind, key, rows) in batch:
+            if kind == 'create':
+                upserts.setdefault(key, [])
+            elif kind == 'upsert':
+                upserts.setdefault(key, []).extend(rows)
+            elif kind == 'psd_histogram':
+                histograms[key] = rows
+        with writer.transaction():
+            for ((tablename, kind), rows) in upserts.items():
+                writer.upsert(tablename, rows, kind)
+            for ((target, day), rows) in histograms.items():
+                writer.replace_psd_histogram(target, day, rows)
+
+    def flush():
+        if len(batch) == 0:
+            return
+        try:
+            write(batch)
+            count = len(batch)
+        except Exception as e:
+            # Retry table by table, then message by message, so that only the rows
+            # that cannot be written are lost
+            if logger is not None:
+                logger.debug(e)
+            tables = {}
+            for message in batch:
+                tablename = 'psd_histogram' if message[0] == 'psd_histogram' else message[1][0]
+                tables.setdefault(tablename, []).append(message)
+            count = 0
+            for (tablename, table_batch) in tables.items():
+                try:
+                    write(table_batch)
+                    count += len(table_batch)
+                    continue
+                except Exception:
+                    pass
+                for message in table_batch:
+                    try:
+                        write([message])
+                        count += 1
+                    except Exception as e:
+                        if logger is not None:
+                            logger.debug(e)
+                            logger.error("Error writing %d rows of %s to %s" % (len(message[2] or []), tablename, dbname))
+        with written.get_lock():
+            written.value += count
+        with failed.get_lock():
+            failed.value += len(batch) - count
+        del batch[:]
+        pending.update(rows=0, since=None)
+
+    while True:
+        timeout = None if pending['since'] is None else max(0, pending['since'] + flush_seconds - time.time())
+        try:
+            (kind, key, rows) = messages.get(timeout=timeout)
+        except queue.Empty:
+            flush()
+            continue
+
+        if kind == 'sync':
+            flush()
+            key.send(True)
+            key.close()
+            continue
+        if kind == 'stop':
+            flush()
+            break
+
+        batch.append((kind, key, rows))
+        pending['rows'] += len(rows or [])
+        if pending['since'] is None:
+            pending['since'] = time.time()
+        if pending['rows'] >= batch_rows:
+            flush()
+
+    writer.close()
+
+
+# Writer processes by database, started by start_writer()
+_queued = {}
+
+def start_writer(dbname, logger=None, batch_rows=50000, flush_seconds=5):
+    """
+    Start a process that writes all rows for a database, from this process and the processes it forks.
+    :param dbname: SQLite database file.
+    :param logger: Logger for write errors.
+    :param batch_rows: Number of buffered rows that triggers a transaction.
+    :param flush_seconds: Age of the oldest buffered row that triggers a transaction.
+    """
+    path = os.path.abspath(dbname)
+    if path in _queued:
+        return
+    ctx = multiprocessing.get_context('fork')
+    messages = ctx.Queue()
+    queued_writer = QueuedWriter(dbname, messages, ctx)
+    process = ctx.Process(target=_write_messages,
+                          args=(dbname, messages, queued_writer.written, queued_writer.failed, logger,
+                                batch_rows, flush_seconds))
+    process.daemon = True
+    process.start()
+    if not _queued:
+        # Registered after multiprocessing's own exit handler, so that it runs first
+        atexit.register(stop_writers)
+    _queued[path] = (queued_writer, process, os.getpid())
+
+def stop_writers():
+    """
+    Write the remaining rows and stop the writer processes started by this process.
+    """
+    for path in list(_queued):
+        (queued_writer, process, pid) = _queued[path]
+        if pid != os.getpid():
+            continue
+        del _queued[path]
+        queued_writer.messages.put(('stop', None, None))
+        process.join()
+
+def sync(dbname):
+    """
+    Wait until rows queued for a database are written, if it has a writer process.
+    :param dbname: SQLite database file.
+    :return: Number of messages its writer process could not write, see QueuedWriter.sync().
+    """
+    path = os.path.abspath(dbname)
+    if path in _queued:
+        return _queued[path][0].sync()
+    return 0
+
+
+# Writers that take the place of a database in one process, see redirect()
+_redirected = {}
+
+def redirect(dbname, writer):
+    """
+    Send the rows for a database to another writer, in this process only.
+    :param dbname: SQLite database file.
+    :param writer: Object with the interface of DatabaseWriter, or None to write
+        to the database again.
+    """
+    key = (os.getpid(), os.path.abspath(dbname))
+    if writer is None:
+        _redirected.pop(key, None)
+    else:
+        _redirected[key] = writer
+
+
+# One writer per database and process, closed at exit
+_writers = {}
+
+def get_writer(dbname):
+    """
+    Return the writer for a database, creating it on first use.
+    :param dbname: SQLite database file.
+    :return: DatabaseWriter, the QueuedWriter of its writer process, or the writer
+        given to redirect()
+    """
+    path = os.path.abspath(dbname)
+    key = (os.getpid(), path)
+    if key in _redirected:
+        return _redirected[key]
+    if path in _queued:
+        return _queued[path][0]
+    if key not in _writers:
+        _writers[key] = DatabaseWriter(dbname)
+    return _writers[key]
+
+@atexit.register
+def close_writers():
+    for key in list(_writers):
+        if key[0] == os.getpid():
+            _writers.pop(key).close()
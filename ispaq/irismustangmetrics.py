@@ -19,6 +19,7 @@ functions can be called programmatically from python without the user having
 to know anything about the particular metric function they are calling.
 """
 
+import sys
 import math
 import numpy as np
 import pandas as pd
@@ -34,6 +35,16 @@ from rpy2.robjects import numpy2ri
 from rpy2.robjects.packages import importr
 from rpy2.robjects.conversion import localconverter
 
+# ISPAQ modules
+try:
+    import irisseismic
+    from irisseismic import LazyRFunction, metricList2DF, py_dataframe
+    import package_cache
+except:
+    from . import irisseismic
+    from .irisseismic import LazyRFunction, metricList2DF, py_dataframe
+    from . import package_cache
+
 #   R functions called internally     ------------------------------------------
 
 
@@ -41,15 +52,81 @@ from rpy2.robjects.conversion import localconverter
 # NOTE:  R-compatible objects as arguments.
 
 # IRISMustangMetrics helper functions
-_R_metricList2DF = robjects.r('IRISMustangMetrics::metricList2DF')
-_R_getMetricFunctionMetadata = robjects.r('IRISMustangMetrics::getMetricFunctionMetadata')
+_R_getMetricFunctionMetadata = LazyRFunction('IRISMustangMetrics::getMetricFunctionMetadata')
 
 def function_metadata():
+    """
+    Return the metadata of the IRISMustangMetrics metric functions.
+
+    The metadata is read from R once for each installation of the R packages and
+    cached on disk, see :mod:`ispaq.package_cache`.
+    """
+    cache = package_cache.load()
+    if cache is not None:
+        return cache['function_metadata']
+
     r_json = _R_getMetricFunctionMetadata()
     py_json = r_json[0]
     functionMetadata = json.loads(py_json)
+
+    try:
+        package_cache.save(package_descriptions(), package_versions(cached=False), functionMetadata)
+    except Exception:
+        # Without a cache the metadata is read from R again next time
+        pass
     return functionMetadata
 
+def package_descriptions(packages=package_cache.IRIS_packages):
+    """
+    Return the DESCRIPTION files of the installed R packages.
+    :param packages: R package names.
+    :return: Dictionary of package name and file path.
+    """
+    r_paths = robjects.r("function(packages) file.path(find.package(packages), 'DESCRIPTION')")(robjects.StrVector(packages))
+    return dict(zip(packages, list(r_paths)))
+
+def package_versions(packages=package_cache.IRIS_packages, cached=True):
+    """
+    Return the versions of the installed R packages used to calculate metrics.
+    :param packages: R package names.
+    :param cached: Use the versions stored by function_metadata() when the packages
+        have not changed since.
+    :return: Dictionary of package name and version string.
+    """
+    cache = package_cache.load() if cached else None
+    if cache is not None and all(package in cache['versions'] for package in packages):
+        return dict((package, cache['versions'][package]) for package in packages)
+
+    versions = {}
+    for package in packages:
+        versions[package] = robjects.r("as.character(packageVersion('%s'))" % package)[0]
+    return versions
+
+# Metric functions by name, each looked up in R once
+_R_metricFunctions = {}
+
+def _R_metricFunction(function):
+    """
+    Return the R function with the given name, e.g. 'IRISMustangMetrics::PSDMetric'.
+    """
+    if function not in _R_metricFunctions:
+        _R_metricFunctions[function] = robjects.r(function)
+    return _R_metricFunctions[function]
+
+def load_R():
+    """
+    Load the R packages and look up the module level R functions.
+
+    Called before forking the daemon's requests and the worker processes, so
+    that each child starts with the R namespaces and functions already loaded.
+    """
+    for package in ('IRISSeismic', 'IRISMustangMetrics'):
+        irisseismic.load_namespace(package)
+    for module in (irisseismic, sys.modules[__name__]):
+        for value in list(vars(module).values()):
+            if isinstance(value, LazyRFunction):
+                value.resolve()
+
 #     Functions that return GeneralValueMetrics     -----------------------------
 
 
@@ -69,15 +146,12 @@ def apply_simple_metric(av, starttime, endtime, r_stream, metric_function_name,
     else:
         function = 'IRISMustangMetrics::' + metric_function_name + 'Metric'
         
-    R_function = robjects.r(function)
+    R_function = _R_metricFunction(function)
     try:
         r_metriclist = R_function(r_stream, *args, **kwargs)
-        r_dataframe = _R_metricList2DF(r_metriclist)
-        
-        # Convert to a pandas dataframe
-        pandas2ri.activate()
-        df = ro.conversion.rpy2py(r_dataframe)
-        pandas2ri.deactivate()
+
+        # Convert to a pandas dataframe with python UTCDateTime times
+        df = metricList2DF(r_metriclist)
         
     except:
         # The stream being empty will trigger this, so mark percent_Availability=0
@@ -86,9 +160,9 @@ def apply_simple_metric(av, starttime, endtime, r_stream, metric_function_name,
         
         df.loc[len(df.index)] = ['percent_availability',snclq, starttime, endtime, -9, 0 ]
     
-    # Convert columns from R POSIXct to python UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+        # Convert columns to python UTCDateTime
+        df.starttime = df.starttime.apply(UTCDateTime)
+        df.endtime = df.endtime.apply(UTCDateTime)
     
     return df
 
@@ -104,7 +178,7 @@ def apply_sampleRateResp_metric(r_stream,resp_pct,norm_freq,evalresp):
     """
 
     function = 'IRISMustangMetrics::sampleRateRespMetric'
-    R_function = robjects.r(function)
+    R_function = _R_metricFunction(function)
 
     #kwargs is just evalresp, if none is provided then the R code will go to IRIS to get it anyway
     if evalresp is not None:
@@ -115,16 +189,8 @@ def apply_sampleRateResp_metric(r_stream,resp_pct,norm_freq,evalresp):
     else:
         r_metriclist = R_function(r_stream,resp_pct,norm_freq)
 
-    r_dataframe = _R_metricList2DF(r_metriclist)
-
-    # Convert to a pandas dataframe
-    pandas2ri.activate()
-    df = ro.conversion.rpy2py(r_dataframe)
-    pandas2ri.deactivate()
-
-    # Convert columns from R POSIXct to python UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert to a pandas dataframe with python UTCDateTime times
+    df = metricList2DF(r_metriclist)
 
     return df
 
@@ -140,20 +206,12 @@ def apply_sampleRateChannel_metric(r_stream, channel_pct,chan_rate):
     """
     
     function = 'IRISMustangMetrics::sampleRateChannelMetric'
-    R_function = robjects.r(function)
+    R_function = _R_metricFunction(function)
 
     r_metriclist = R_function(r_stream,channel_pct,chan_rate)
-        
-    r_dataframe = _R_metricList2DF(r_metriclist)
 
-    # Convert to a pandas dataframe
-    pandas2ri.activate()
-    df = ro.conversion.rpy2py(r_dataframe)
-    pandas2ri.deactivate()
-    
-    # Convert columns from R POSIXct to python UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert to a pandas dataframe with python UTCDateTime times
+    df = metricList2DF(r_metriclist)
     
     return df
 
@@ -168,21 +226,13 @@ def apply_correlation_metric(r_stream1, r_stream2, metric_function_name, *args,
     """
 
     function = 'IRISMustangMetrics::' + metric_function_name + 'Metric'
-    R_function = robjects.r(function)
-
-    pandas2ri.activate()
-    r_metriclist = R_function(r_stream1, r_stream2, *args, **kwargs) 
-    pandas2ri.deactivate()
-    
-    r_dataframe = _R_metricList2DF(r_metriclist)
+    R_function = _R_metricFunction(function)
 
-    pandas2ri.activate()
-    df = ro.conversion.rpy2py(r_dataframe)
-    pandas2ri.deactivate()
+    with localconverter(ro.default_converter + pandas2ri.converter):
+        r_metriclist = R_function(r_stream1, r_stream2, *args, **kwargs) 
     
-    # Convert columns from R POSIXct to pyton UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert to a pandas dataframe with python UTCDateTime times
+    df = metricList2DF(r_metriclist)
 
     return df
 
@@ -199,7 +249,7 @@ def apply_transferFunction_metric(r_stream1, r_stream2, evalresp1, evalresp2):
     """
     
     
-    R_function = robjects.r('IRISMustangMetrics::transferFunctionMetric')
+    R_function = _R_metricFunction('IRISMustangMetrics::transferFunctionMetric')
     
     # NOTE:  Conversion of dataframes only works if you activate but we don't want conversion
     # NOTE:  to always be automatic so we deactivate() after we're done converting.
@@ -213,15 +263,9 @@ def apply_transferFunction_metric(r_stream1, r_stream2, evalresp1, evalresp2):
     
     # Calculate the metric
     r_metriclist = R_function(r_stream1, r_stream2, r_evalresp1, r_evalresp2)
-    r_dataframe = _R_metricList2DF(r_metriclist)
 
-    pandas2ri.activate()
-    df = ro.conversion.rpy2py(r_dataframe)
-    pandas2ri.deactivate()
-    
-    # Convert columns from R POSIXct to pyton UTCDateTime
-    df.starttime = df.starttime.apply(UTCDateTime)
-    df.endtime = df.endtime.apply(UTCDateTime)
+    # Convert to a pandas dataframe with python UTCDateTime times
+    df = metricList2DF(r_metriclist)
     return df
 
 #     Functions for PSDMetrics     ---------------------------------------------
@@ -235,7 +279,7 @@ def apply_PSD_metric(concierge, r_stream, *args, **kwargs):
     :return: tuple of GeneralValueMetrics, corrected PSD, and PDF
     """
     
-    R_function = robjects.r('IRISMustangMetrics::PSDMetric')
+    R_function = _R_metricFunction('IRISMustangMetrics::PSDMetric')
 
     # look for optional parameter evalresp=pd.DataFrame
     evalresp = None
@@ -257,31 +301,19 @@ def apply_PSD_metric(concierge, r_stream, *args, **kwargs):
     r_metriclist = r_listOfLists[0]
     
     if r_metriclist:
-        r_dataframe = _R_metricList2DF(r_metriclist)
-
-        with localconverter(ro.default_converter + pandas2ri.converter):
-            df = ro.conversion.rpy2py(r_dataframe)
-
-        # Convert columns from R POSIXct to python UTCDateTime
-        df['starttime'] = df['starttime'].apply(UTCDateTime)
-        df['endtime'] = df['endtime'].apply(UTCDateTime)
+        # Convert to a pandas dataframe with python UTCDateTime times
+        df = metricList2DF(r_metriclist)
 
     # PSDMetric returns no PSD derived metrics 
     else:    
         df = pd.DataFrame()
     
-    # correctedPSD is returned as a dataframe
+    # correctedPSD is returned as a dataframe, converted with python UTCDateTime times
     r_correctedPSD = r_listOfLists[2]
-    with localconverter(ro.default_converter + pandas2ri.converter):
-        PSDCorrected = ro.conversion.rpy2py(r_correctedPSD)
-
-    # Convert columns from R POSIXct to python UTCDateTime
-    PSDCorrected.starttime = PSDCorrected.starttime.apply(UTCDateTime)
-    PSDCorrected.endtime = PSDCorrected.endtime.apply(UTCDateTime)
+    PSDCorrected = py_dataframe(r_correctedPSD)
 
     r_PDF = r_listOfLists[3]
-    with localconverter(ro.default_converter + pandas2ri.converter):
-        PDF = ro.conversion.rpy2py(r_PDF)
+    PDF = py_dataframe(r_PDF)
 
     return (df, PSDCorrected, PDF)
 
@@ -32,37 +32,115 @@ ro.r("options(show.error.messages=FALSE)")
 # NOTE:  These functions behave exactly the same as the R versions and require
 # NOTE:  R-compatible objects as arguments.
 
+
+# R packages whose namespace has been loaded in this process
+_loaded_namespaces = set()
+
+
+def load_namespace(package):
+    """
+    Load the namespace of an R package once per process.
+
+    Looking up "package::function" loads the namespace implicitly, but the S4
+    classes of a package, such as the IRISSeismic Trace, are only known to
+    new() once its namespace is loaded.
+
+    :type package: str
+    :param package: R package name, e.g. "IRISSeismic".
+    """
+    if package not in _loaded_namespaces:
+        ro.r('loadNamespace("%s")' % package)
+        _loaded_namespaces.add(package)
+
+
+class LazyRFunction(object):
+    """
+    R function that is looked up when it is first called.
+
+    Looking up "package::function" loads the namespace of the package, so module
+    level functions are resolved on first use rather than when ISPAQ starts.
+
+    :type name: str
+    :param name: R expression naming the function, e.g. "IRISSeismic::slice".
+    :type namespace: str
+    :param namespace: R package whose namespace the function needs, for functions
+        that are not looked up as "package::function".
+    """
+    def __init__(self, name, namespace=None):
+        self.name = name
+        self.namespace = namespace
+        self.function = None
+
+    def resolve(self):
+        """
+        Look up the R function if that has not been done yet.
+        :return: R function.
+        """
+        if self.function is None:
+            if self.namespace is not None:
+                load_namespace(self.namespace)
+            self.function = ro.r(self.name)
+        return self.function
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+
 # from base
-_R_assign = ro.r("base::assign")  # assign a name to an object
-_R_get = ro.r("base::get")  # get an object from a name
-_R_as_integer = ro.r(
-    "base::as.integer"
-)  # conversion of python integers to R integer vectors
-_R_as_POSIXct = ro.r("base::as.POSIXct")  # conversion of ISO datestrings to R POSIXct
-_R_vector = ro.r("base::vector")  # creation of a the list of Traces used in R_Trace
-_R_list = ro.r("base::list")  # creation of the headerList used in R_Trace
-_R_as_logical = ro.r("base::as.logical")
+_R_assign = LazyRFunction("base::assign")  # assign a name to an object
+_R_get = LazyRFunction("base::get")  # get an object from a name
+_R_as_integer = LazyRFunction("base::as.integer")  # conversion of python integers to R integer vectors
+_R_as_POSIXct = LazyRFunction("base::as.POSIXct")  # conversion of ISO datestrings to R POSIXct
+_R_vector = LazyRFunction("base::vector")  # creation of a the list of Traces used in R_Trace
+_R_list = LazyRFunction("base::list")  # creation of the headerList used in R_Trace
+_R_as_logical = LazyRFunction("base::as.logical")
+
+# from methods
+_R_new = LazyRFunction("methods::new")  # creation of metric objects in generalValueMetric
 
 # from IRISSeismic
-_R_initialize = ro.r("IRISSeismic::initialize")  # initialization of various objects
-_R_slice = ro.r("IRISSeismic::slice")
+_R_initialize = LazyRFunction("IRISSeismic::initialize")  # initialization of various objects
+_R_slice = LazyRFunction("IRISSeismic::slice")
 
 # All webservice functions from IRISSeismic
-_R_getAvailability = ro.r("IRISSeismic::getAvailability")  #
-_R_getChannel = ro.r("IRISSeismic::getChannel")  #
-_R_getDataselect = ro.r("IRISSeismic::getDataselect")  #
-_R_getDistaz = ro.r("IRISSeismic::getDistaz")  #
-_R_getEvalresp = ro.r("IRISSeismic::getEvalresp")  #
-_R_getEvent = ro.r("IRISSeismic::getEvent")  #
-_R_getNetwork = ro.r("IRISSeismic::getNetwork")  #
-_R_getRotation = ro.r("IRISSeismic::getRotation")  # TODO:  This returns 3 Streams
-_R_getSNCL = ro.r("IRISSeismic::getSNCL")  #
-_R_getStation = ro.r("IRISSeismic::getStation")  #
-_R_getTraveltime = ro.r("IRISSeismic::getTraveltime")  #
-_R_getUnavailability = ro.r("IRISSeismic::getUnavailability")  #
+_R_getAvailability = LazyRFunction("IRISSeismic::getAvailability")  #
+_R_getChannel = LazyRFunction("IRISSeismic::getChannel")  #
+_R_getDataselect = LazyRFunction("IRISSeismic::getDataselect")  #
+_R_getDistaz = LazyRFunction("IRISSeismic::getDistaz")  #
+_R_getEvalresp = LazyRFunction("IRISSeismic::getEvalresp")  #
+_R_getEvent = LazyRFunction("IRISSeismic::getEvent")  #
+_R_getNetwork = LazyRFunction("IRISSeismic::getNetwork")  #
+_R_getRotation = LazyRFunction("IRISSeismic::getRotation")  # TODO:  This returns 3 Streams
+_R_getSNCL = LazyRFunction("IRISSeismic::getSNCL")  #
+_R_getStation = LazyRFunction("IRISSeismic::getStation")  #
+_R_getTraveltime = LazyRFunction("IRISSeismic::getTraveltime")  #
+_R_getUnavailability = LazyRFunction("IRISSeismic::getUnavailability")  #
+
+# Creation of all Traces of a Stream in one call, see R_Stream
+_R_createTraces = LazyRFunction("""
+function(id, network, station, location, channel, quality, starttime, endtime, npts, sampling_rate,
+         latitude, longitude, elevation, depth, azimuth, dip,
+         Sensor, InstrumentSensitivity, SensitivityFrequency, InputUnits, data) {
+  starttime <- as.POSIXct(starttime, origin="1970-01-01", tz="GMT")
+  endtime <- as.POSIXct(endtime, origin="1970-01-01", tz="GMT")
+  offset <- cumsum(npts) - npts
+  lapply(seq_along(npts), function(i) {
+    headerList <- list(network=network[i], station=station[i], location=location[i],
+                       channel=channel[i], quality=quality[i],
+                       starttime=starttime[i], endtime=endtime[i],
+                       npts=npts[i], sampling_rate=sampling_rate[i],
+                       latitude=latitude, longitude=longitude, elevation=elevation,
+                       depth=depth, azimuth=azimuth, dip=dip)
+    methods::new("Trace", id=id[i], stats=methods::new("TraceHeader", headerList),
+                 Sensor=Sensor, InstrumentSensitivity=InstrumentSensitivity,
+                 SensitivityFrequency=SensitivityFrequency, InputUnits=InputUnits,
+                 data=data[offset[i] + seq_len(npts[i])])
+  })
+}
+""", namespace="IRISSeismic")
 
 # IRISMustangMetrics helper functions
-_R_metricList2DF = ro.r("IRISMustangMetrics::metricList2DF")
+_R_metricList2DF = LazyRFunction("IRISMustangMetrics::metricList2DF")
 
 #     Python --> R conversion functions    -------------------------------------
 
@@ -135,9 +213,20 @@ def R_float(x):
     >>> R_float(np.array([1.5,2.5,3.5])) #doctest: +ELLIPSIS
     <FloatVector - Python:...>
     [1.500000, 2.500000, 3.500000]
+    >>> R_float(np.array([1,2,3], dtype=np.int32)) #doctest: +ELLIPSIS
+    <FloatVector - Python:...>
+    [1.000000, 2.000000, 3.000000]
+
+    .. note::
+
+    A `numpy.ndarray` is cast to a contiguous float64 array in one vectorized
+    operation, e.g. for int32 counts, which rpy2 then copies into the R vector
+    with a single memcpy instead of converting it element by element.
     """
     if x is None:
         return np.NaN
+    elif isinstance(x, np.ndarray):
+        return ro.vectors.FloatVector(np.ascontiguousarray(x, dtype=np.float64))
     else:
         if isinstance(x, float) or isinstance(x, int):
             x = [x]
@@ -224,6 +313,8 @@ def R_TraceHeader(stats, latitude, longitude, elevation, depth, azimuth, dip):
     :return: IRISSeismic TraceHeader object.
     """
 
+    load_namespace("IRISSeismic")
+
     with localconverter(ro.default_converter):
         r_headerList = _R_list(
             network=stats.network,
@@ -271,6 +362,8 @@ def R_Trace(
     :return: IRISSeismic Trace object.
     """
 
+    load_namespace("IRISSeismic")
+
     r_trace = ro.r('new("Trace")')
 
     r_trace = _R_initialize(
@@ -319,68 +412,139 @@ def R_Stream(
     # TODO:  Should we automatically get channelInfo from R getChannels() as in
     # TODO:  IRISSeismic::getDataselect.IrisClient()?
 
+    load_namespace("IRISSeismic")
+
     # Handle missing times
     if requestedStarttime is None:
         requestedStarttime = stream.traces[0].stats.starttime
     if requestedEndtime is None:
         requestedEndtime = stream.traces[-1].stats.endtime
 
-    # Create R list of Trace objects
-    r_listOfTraces = R_list(len(stream.traces))
-
-    for i in range(len(stream.traces)):
-        numpy2ri.activate()
-        r_listOfTraces[i] = R_Trace(
-            stream.traces[i],
+    # The conversion context is set once for the whole stream
+    with localconverter(ro.default_converter + numpy2ri.converter):
+
+        # Create R list of Trace objects from column vectors of the trace headers
+        # and the concatenated samples, so that the cost depends on the number of
+        # samples rather than on the number of traces
+        traces = stream.traces
+        r_listOfTraces = _R_createTraces(
+            R_character([".".join([tr.id, tr.stats.mseed.dataquality]) for tr in traces]),
+            R_character([tr.stats.network for tr in traces]),
+            R_character([tr.stats.station for tr in traces]),
+            R_character([tr.stats.location for tr in traces]),
+            R_character([tr.stats.channel for tr in traces]),
+            R_character([tr.stats.mseed.dataquality for tr in traces]),
+            R_float(np.array([tr.stats.starttime.timestamp for tr in traces], dtype=np.float64)),
+            R_float(np.array([tr.stats.endtime.timestamp for tr in traces], dtype=np.float64)),
+            ro.vectors.IntVector(np.array([tr.stats.npts for tr in traces], dtype=np.int32)),
+            R_float(np.array([tr.stats.sampling_rate for tr in traces], dtype=np.float64)),
+            R_float(latitude),
+            R_float(longitude),
+            R_float(elevation),
+            R_float(depth),
+            R_float(azimuth),
+            R_float(dip),
             sensor,
             scale,
             scalefreq,
             scaleunits,
-            latitude,
-            longitude,
-            elevation,
-            depth,
-            azimuth,
-            dip,
+            R_float(np.concatenate([tr.data for tr in traces], dtype=np.float64) if traces else np.array([])),
         )
-        numpy2ri.deactivate()
-
-    # Create R Stream object
-    r_stream = ro.r('new("Stream")')
-
-    if timing_qual is None:
-        numpy2ri.activate()
-        r_stream = _R_initialize(
-            r_stream,
-            requestedStarttime=R_POSIXct(requestedStarttime),
-            requestedEndtime=R_POSIXct(requestedEndtime),
-            act_flags=R_integer(act_flags),
-            io_flags=R_integer(io_flags),
-            dq_flags=R_integer(dq_flags),
-            traces=r_listOfTraces,
-        )
-        numpy2ri.deactivate()
 
-    else:
+        # Create R Stream object
+        r_stream = ro.r('new("Stream")')
+
+        if timing_qual is None:
+            r_stream = _R_initialize(
+                r_stream,
+                requestedStarttime=R_POSIXct(requestedStarttime),
+                requestedEndtime=R_POSIXct(requestedEndtime),
+                act_flags=R_integer(act_flags),
+                io_flags=R_integer(io_flags),
+                dq_flags=R_integer(dq_flags),
+                traces=r_listOfTraces,
+            )
+
+        else:
+            r_stream = _R_initialize(
+                r_stream,
+                requestedStarttime=R_POSIXct(requestedStarttime),
+                requestedEndtime=R_POSIXct(requestedEndtime),
+                act_flags=R_integer(act_flags),
+                io_flags=R_integer(io_flags),
+                dq_flags=R_integer(dq_flags),
+                timing_qual=timing_qual,
+                traces=r_listOfTraces,
+            )
 
-        numpy2ri.activate()
-        r_stream = _R_initialize(
-            r_stream,
-            requestedStarttime=R_POSIXct(requestedStarttime),
-            requestedEndtime=R_POSIXct(requestedEndtime),
-            act_flags=R_integer(act_flags),
-            io_flags=R_integer(io_flags),
-            dq_flags=R_integer(dq_flags),
-            timing_qual=timing_qual,
-            traces=r_listOfTraces,
-        )
-        numpy2ri.deactivate()
     return r_stream
 
 
 # ------------------------------------------------------------------------------
 
 
+#     R --> Python conversion functions    -------------------------------------
+
+
+def py_UTCDateTime(x):
+    """
+    Creates an array of `UTCDateTime`s from R POSIXct seconds since 1970-01-01.
+    :param x: `numpy.ndarray` of float seconds, NaN for missing times.
+    :return: `numpy.ndarray` of `UTCDateTime`s, None for missing times.
+
+    Each distinct time is converted once, e.g. the start and end times shared by
+    all rows of a metric or PSD dataframe.
+
+    .. rubric:: Example
+
+    >>> list(py_UTCDateTime(np.array([1262304000.0, 1262304000.0, np.nan])))
+    [UTCDateTime(2010, 1, 1, 0, 0), UTCDateTime(2010, 1, 1, 0, 0), None]
+    """
+    (seconds, inverse) = np.unique(x, return_inverse=True)
+    times = np.empty(len(seconds), dtype=object)
+    times[:] = [UTCDateTime(t) if np.isfinite(t) else None for t in seconds]
+    return times[inverse.reshape(-1)]
+
+
+def py_dataframe(r_dataframe):
+    """
+    Creates a pandas dataframe from an R data.frame.
+    :param r_dataframe: R data.frame.
+    :return: pandas dataframe with POSIXct columns converted to `UTCDateTime`s.
+
+    Numeric columns are read from the memory of the R vectors into `numpy.ndarray`s
+    and the dataframe is built column by column, which is much faster than converting
+    the data.frame with pandas2ri and then converting each time with `UTCDateTime`.
+    """
+    columns = {}
+    with localconverter(ro.default_converter):
+        for (name, r_column) in zip(r_dataframe.names, r_dataframe):
+            rclass = tuple(r_column.rclass)
+            if "factor" in rclass:
+                levels = np.array(list(r_column.levels), dtype=object)
+                columns[name] = levels[np.array(r_column.memoryview()) - 1]
+            elif "POSIXct" in rclass:
+                columns[name] = py_UTCDateTime(np.array(r_column.memoryview()))
+            elif isinstance(r_column, ro.vectors.BoolVector):
+                columns[name] = np.array(r_column.memoryview()).astype(bool)
+            elif isinstance(r_column, (ro.vectors.FloatVector, ro.vectors.IntVector)):
+                columns[name] = np.array(r_column.memoryview())
+            else:
+                columns[name] = np.array(list(r_column), dtype=object)
+    return pd.DataFrame(columns, columns=list(r_dataframe.names))
+
+
+def metricList2DF(r_metricList):
+    """
+    Creates a pandas dataframe from an R list of IRISMustangMetrics metrics.
+    :param r_metricList: R list of metric objects.
+    :return: pandas dataframe with one row per metric and `UTCDateTime` start and end times.
+    """
+    with localconverter(ro.default_converter):
+        r_dataframe = _R_metricList2DF(r_metricList)
+    return py_dataframe(r_dataframe)
+
+
 #     Helper functions     ----------------------------------------------------
 
 
@@ -1322,9 +1486,8 @@ def generalValueMetric(
     elementNames = R_character(elementNames)
     elementValues = [str(i) for i in elementValues]
     elementValues = R_character(elementValues)
-    R_function = ro.r("methods::new")
+    R_function = _R_new
 
-    pandas2ri.activate()
     if valueStrings is not None:
         valueStrings = R_character(valueStrings)
         r_metric = R_function(
@@ -1348,10 +1511,7 @@ def generalValueMetric(
             elementValues,
         )
     r_metricList = _R_list(r_metric)
-    r_dataframe = _R_metricList2DF(r_metricList)
-
-    df = ro.conversion.rpy2py(r_dataframe)
-    pandas2ri.deactivate()
+    df = metricList2DF(r_metricList)
     return df
 
 
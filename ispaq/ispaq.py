@@ -14,6 +14,7 @@ import numpy as np
 import subprocess
 from _ast import Try
 from numpy.random import sample
+from . import daemon
 
 __version__ = "3.3.0"
 
@@ -44,23 +45,11 @@ def currentispaq():
     return groups
 
 
-def main():
-
-    # Check our Conda environment ----------------------------------------------
-    # let's check for our primary supporting python modules
-    try:
-        importlib.util.find_spec("rpy2")
-        importlib.util.find_spec("obspy")
-        importlib.util.find_spec("pandas")
-        # imp.find_module('rpy2')
-        # imp.find_module('obspy')
-        # imp.find_module('pandas')
-    except ImportError as e:
-        print("ERROR: please activate your ispaq environment before running: %s" % e)
-        raise SystemExit
-
-    # Parse arguments ----------------------------------------------------------
-
+def build_parser():
+    """
+    Create the parser of the ISPAQ command line arguments.
+    :return: argparse.ArgumentParser
+    """
     epilog_text = 'If no preference file is specified and the default file ./preference_files/default.txt cannot be found:\n--csv_dir, pdf_dir, and psd_dir default to "."\n--sncl_format defaults to "N.S.C.L"\n--sigfigs defaults to "6"\n--pdf_type defaults to "plot,text"\n--pdf_interval defaults to "aggregated"\n--plot_include defaults to "colorbar,legend"'
     parser = argparse.ArgumentParser(
         description=" ".join(["ISPAQ version", __version__]),
@@ -100,6 +89,49 @@ def main():
         required=False,
         help="endtime in ObsPy UTCDateTime format, default=starttime + 1 day; \nif starttime is also not specified then it defaults to the latest data \nfile for local data \nexamples: YYYY-MM-DD, YYYYMMDD, YYYY-DDD, YYYYDDD[THH:MM:SS]",
     )
+    metrics.add_argument(
+        "--stored-psds",
+        action="store_true",
+        default=False,
+        help="calculate pct_above_nhnm, pct_below_nlnm, dead_channel_lin and \ndead_channel_gsn from corrected PSDs already in psd_dir or the \npsd_corrected database table instead of recalculating the PSDs",
+    )
+    metrics.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="skip metrics already in the csv_dir metric files, psd_dir or the \ndatabase for the same SNCL and start time, and append new results",
+    )
+    metrics.add_argument(
+        "--processes",
+        action="store",
+        default=1,
+        help="number of worker processes calculating metrics in parallel, shared by the \nrequested metric groups, which run concurrently; within a group by SNCL-day \nfor simple, PSD and sampleRate metrics and by event for SNR, crossTalk, \ncrossCorrelation and orientationCheck metrics, default=1",
+    )
+    metrics.add_argument(
+        "--shard",
+        action="store",
+        default=None,
+        choices=["day", "week"],
+        help="with --processes, give each worker process whole days or weeks of the \nrequested time span instead of single SNCL-days",
+    )
+    metrics.add_argument(
+        "--manifest",
+        action="store",
+        default=None,
+        help="calculate the requests listed in this JSON file one after the other in \nthis process, reusing metadata, data file lists, events and responses \nbetween requests with the same data sources; replaces -M and -S",
+    )
+    metrics.add_argument(
+        "--queue",
+        action="store",
+        default=None,
+        help="coordinate a distributed run: queue the SNCL-days and events of the \nrequest in this SQLite file on a shared filesystem, calculate them \ntogether with any --worker processes and write the output",
+    )
+    metrics.add_argument(
+        "--worker",
+        action="store",
+        default=None,
+        help="calculate SNCL-days and events queued in this SQLite file by a \n--queue coordinator, on any node; the request is read from the queue",
+    )
 
     prefs = parser.add_argument_group(
         "optional arguments for overriding preference file entries"
@@ -138,6 +170,16 @@ def main():
         required=False,
         help="directory to write/read existing PSD .csv files, if output=csv",
     )
+    prefs.add_argument(
+        "--psd_format",
+        required=False,
+        help="file format of corrected PSDs written to psd_dir, if output=csv. Options: csv, npz",
+    )
+    prefs.add_argument(
+        "--cache_dir",
+        required=False,
+        help="directory to cache metric results calculated from local data, reused while \nthe data, metadata, RESP files and R packages are unchanged",
+    )
     prefs.add_argument(
         "--pdf_dir", required=False, help="directory to write generated PDF files"
     )
@@ -212,6 +254,36 @@ def main():
         default=False,
         help="list names of available metrics and exit",
     )
+    parser.add_argument(
+        "--serve",
+        action="store",
+        nargs="?",
+        const=daemon.DEFAULT_ADDRESS,
+        default=None,
+        help="keep R and ISPAQ loaded and calculate the requests of ispaq-client \nsent to this local socket, default=%s" % daemon.DEFAULT_ADDRESS,
+    )
+
+    return parser
+
+
+def main():
+
+    # Check our Conda environment ----------------------------------------------
+    # let's check for our primary supporting python modules
+    try:
+        importlib.util.find_spec("rpy2")
+        importlib.util.find_spec("obspy")
+        importlib.util.find_spec("pandas")
+        # imp.find_module('rpy2')
+        # imp.find_module('obspy')
+        # imp.find_module('pandas')
+    except ImportError as e:
+        print("ERROR: please activate your ispaq environment before running: %s" % e)
+        raise SystemExit
+
+    # Parse arguments ----------------------------------------------------------
+
+    parser = build_parser()
 
     try:
         args = parser.parse_args(sys.argv[1:])
@@ -251,31 +323,31 @@ def main():
         % (__version__, datetime.datetime.now().strftime("%c"))
     )
 
+    # Load the request of a distributed run -----------------------------------
+
+    if args.worker is not None:
+        from . import work_queue
+        try:
+            args = work_queue.worker_args(args)
+        except Exception as e:
+            logger.debug(e)
+            logger.critical("Cannot read the request from work queue %s" % args.worker)
+            raise SystemExit
+        logger.info("Working on the request queued in %s" % args.worker)
+
     # check that EarthScope CRAN packages are installed
 
     import obspy
     from distutils.version import StrictVersion
     from . import updater
     import rpy2.robjects as ro
-    from rpy2 import rinterface
-    from rpy2.robjects import pandas2ri
-    from rpy2.robjects.packages import importr
-    from rpy2.robjects.conversion import localconverter
 
     IRIS_packages = ["seismicRoll", "IRISSeismic", "IRISMustangMetrics"]
 
-    r_installed = ro.r("installed.packages()")
-
-    with localconverter(ro.default_converter + pandas2ri.converter):
-        installed_names = list(ro.conversion.rpy2py(r_installed.rownames))
-
-        # installed_names = ro.conversion.rpy2py(r_installed.rownames).tolist()
-
     flag = 0
-    for package in IRIS_packages:
-        if package not in installed_names:
-            print("IRIS R package " + package + " is not installed")
-            flag = 1
+    for package in updater.missing_IRIS_packages(IRIS_packages):
+        print("IRIS R package " + package + " is not installed")
+        flag = 1
     if flag == 1:
         print("\nAttempting to install EarthScope R packages from CRAN")
         updater.install_IRIS_packages_missing(IRIS_packages, logger)
@@ -284,7 +356,7 @@ def main():
 
     # We can't use required=True in argpase because folks should be able to type only -U
 
-    if not (args.update_r or args.install_r or args.list_metrics):
+    if not (args.update_r or args.install_r or args.list_metrics or args.serve is not None or args.manifest is not None):
         # metric sets
         if args.metrics is None:
             logger.critical("argument -M/--metrics is required to run metrics")
@@ -297,8 +369,6 @@ def main():
 
     # Handle R package upgrades ------------------------------------------------
 
-    _R_install_packages = ro.r("utils::install.packages")
-
     if args.install_r:
         logger.info("(Re)installing EarthScope R packages from CRAN")
         updater.install_IRIS_packages(IRIS_packages, logger)
@@ -321,6 +391,7 @@ def main():
             subprocess.call(conda_str, shell=True)
             logger.info("(Re)installing EarthScope R packages from CRAN")
             try:
+                _R_install_packages = ro.r("utils::install.packages")
                 for package in IRIS_packages:
                     _R_install_packages(package)
                     logger.info("Installed %s" % (package))
@@ -364,6 +435,99 @@ def main():
             print(line)
         sys.exit(0)
 
+    if StrictVersion(obspy.__version__) < StrictVersion("1.4.0"):
+        print(
+            "Please update ObsPy version "
+            + str(obspy.__version__)
+            + " to version 1.4.0"
+        )
+        message = "Would you like to update obspy now? [y]/n: "
+        answer = raw_input(message).lower()
+        accepted_answer = ["", "yes", "y"]
+        rejected_answer = ["n", "no"]
+        while (answer not in accepted_answer) and (answer not in rejected_answer):
+            print("Invalid choice: " + answer)
+            message = "Would you like to update obspy now? [y]/n: "
+            answer = raw_input(message).lower()
+        if answer in accepted_answer:
+            subprocess.call("conda install -c conda-forge obspy=1.4.0", shell=True)
+        elif answer in rejected_answer:
+            print("Exiting now without updating conda packages.")
+            raise SystemExit
+
+    if args.serve is not None:
+        # Requests are calculated by forked copies of this process, with all modules loaded
+        for module in ("user_request", "concierge", "metric_sink", "worker_pool", "work_queue",
+                       "simple_metrics", "SNR_metrics", "PSD_metrics", "crossTalk_metrics",
+                       "pressureCorrelation_metrics", "crossCorrelation_metrics",
+                       "orientationCheck_metrics", "transferFunction_metrics", "sampleRate_metrics"):
+            importlib.import_module("." + module, __package__)
+        importlib.import_module(".irismustangmetrics", __package__).load_R()
+        daemon.serve(args.serve, run_job, logger)
+        return
+
+    if args.manifest is not None:
+        from . import manifest
+        manifest.run_manifest(args.manifest, args, logger, run_request)
+        return
+
+    run_request(args, logger)
+
+
+def run_job(job, logger):
+    """
+    Calculate a request sent to the daemon by ispaq-client.
+    :param job: Job dictionary, see daemon.submit().
+    :param logger: Logger.
+    :return: Dictionary with 'outputs', the output file or database of each business
+        logic, and 'dataframes', the metrics of each business logic, if job['dataframes'].
+    """
+    import io
+    import contextlib
+
+    os.chdir(job["cwd"])
+
+    # Usage and argument errors are returned to the client instead of printed by the daemon
+    messages = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(messages), contextlib.redirect_stderr(messages):
+            args = build_parser().parse_args(job["argv"])
+    except SystemExit:
+        raise RuntimeError(messages.getvalue().strip())
+
+    user_request = None
+    if job.get("user_request") is not None:
+        from .user_request import UserRequest
+        try:
+            user_request = UserRequest(json_representation=job["user_request"], logger=logger)
+        except Exception as e:
+            logger.debug(e)
+            raise RuntimeError("Failed to create UserRequest object from its JSON representation")
+    elif args.metrics is None:
+        raise RuntimeError("argument -M/--metrics is required to run metrics")
+    elif args.stations is None:
+        raise RuntimeError("argument -S/--stations is required to run metrics")
+
+    frames = {} if job.get("dataframes") else None
+    result = {"outputs": run_request(args, logger, user_request=user_request, frames=frames)}
+    if frames is not None:
+        result["dataframes"] = frames
+    return result
+
+
+def run_request(args, logger, user_request=None, frames=None, write=True, shared=None):
+    """
+    Calculate the metrics of one request.
+    :param args: Parsed command line arguments.
+    :param logger: Logger.
+    :param user_request: UserRequest, or None to create it from args.
+    :param frames: Dictionary receiving the metrics dataframe of each business logic,
+        or None. Business logic groups are then calculated one after the other.
+    :param write: Write the metrics to the csv files or database.
+    :param shared: SharedSources with the inputs of earlier requests, or None.
+    :return: Dictionary of output files or database, by business logic.
+    """
+
     # Load additional modules --------------------------------------------------
 
     # These are loaded here so that asking for --version or --help is not bogged down
@@ -375,6 +539,10 @@ def main():
     from . import irisseismic
     from . import irismustangmetrics
     from . import utils
+    from . import database
+    from .metric_sink import MetricSink
+    from . import worker_pool
+    from . import work_queue
 
     # Specific ISPAQ business logic
     from .simple_metrics import simple_metrics
@@ -387,26 +555,6 @@ def main():
     from .transferFunction_metrics import transferFunction_metrics
     from .sampleRate_metrics import sampleRate_metrics
 
-    if StrictVersion(obspy.__version__) < StrictVersion("1.4.0"):
-        print(
-            "Please update ObsPy version "
-            + str(obspy.__version__)
-            + " to version 1.4.0"
-        )
-        message = "Would you like to update obspy now? [y]/n: "
-        answer = raw_input(message).lower()
-        accepted_answer = ["", "yes", "y"]
-        rejected_answer = ["n", "no"]
-        while (answer not in accepted_answer) and (answer not in rejected_answer):
-            print("Invalid choice: " + answer)
-            message = "Would you like to update obspy now? [y]/n: "
-            answer = raw_input(message).lower()
-        if answer in accepted_answer:
-            subprocess.call("conda install -c conda-forge obspy=1.4.0", shell=True)
-        elif answer in rejected_answer:
-            print("Exiting now without updating conda packages.")
-            raise SystemExit
-
     # Create UserRequest object ------------------------------------------------
     #
     # The UserRequest class is in charge of parsing arguments issued on the
@@ -414,13 +562,14 @@ def main():
     # of properties that capture the totality of what the user wants in a single
     # invocation of the ISPAQ top level script.
 
-    logger.debug("Creating UserRequest ...")
-    try:
-        user_request = UserRequest(args, logger=logger)
-    except Exception as e:
-        logger.debug(e)
-        logger.critical("Failed to create UserRequest object")
-        raise SystemExit
+    if user_request is None:
+        logger.debug("Creating UserRequest ...")
+        try:
+            user_request = UserRequest(args, logger=logger)
+        except Exception as e:
+            logger.debug(e)
+            logger.critical("Failed to create UserRequest object")
+            raise SystemExit
 
     # Create Concierge (aka Expediter) -----------------------------------------
     #
@@ -432,280 +581,129 @@ def main():
 
     logger.debug("Creating Concierge ...")
     try:
-        concierge = Concierge(user_request=user_request, logger=logger)
+        concierge = Concierge(user_request=user_request, logger=logger, shared=shared)
     except Exception as e:
         logger.debug(e)
         logger.critical("Failed to create Concierge object")
         raise SystemExit
 
-    # Generate Simple Metrics --------------------------------------------------
-
-    if "simple" in concierge.logic_types:
-        logger.debug("Inside simple business logic ...")
-        try:
-            df = simple_metrics(concierge)
-            if df is None:
-                logger.info("No simple metrics were calculated")
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_simpleMetrics.csv"
-                    if concierge.output == "csv":
-                        logger.info("Writing simple metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info("Writing simple metrics to %s" % concierge.db_name)
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'simple' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'simple' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'simple' metrics")
-
-    if "sampleRate" in concierge.logic_types:
-        logger.debug("Inside sampleRate business logic ...")
-        try:
-            df = sampleRate_metrics(concierge)
-            if df is None:
-                logger.info("No sampleRate metrics were calculated")
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_sampleRateMetrics.csv"
-                    if concierge.output == "csv":
-                        logger.info("Writing sampleRate metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info(
-                            "Writing sampleRate metrics to %s" % concierge.db_name
-                        )
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'sampleRate' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'sampleRate' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'sampleRate' metrics")
-
-    # Generate SNR Metrics -----------------------------------------------------
-
-    if "SNR" in concierge.logic_types:
-        logger.debug("Inside SNR business logic ...")
-        try:
-            df = SNR_metrics(concierge)
-            if df is None:
-                logger.info("No SNR metrics were calculated")
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_SNRMetrics.csv"
-
-                    if concierge.output == "csv":
-                        logger.info("Writing SNR metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info("Writing SNR metrics to %s" % concierge.db_name)
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'SNR' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'SNR' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'SNR' metrics")
-
-    # Generate PSD Metrics -----------------------------------------------------
-
-    if "PSD" in concierge.logic_types:
-        logger.debug("Inside PSD business logic ...")
-        try:
-            df = PSD_metrics(concierge)
-            if "PSD" not in concierge.function_by_logic["PSD"]:
-                pass
-            elif df is None:
-                logger.info("No PSD metrics were calculated")
-            else:
-                try:
-                    # Write out the metrics
-                    filepath = concierge.output_file_base + "_PSDMetrics.csv"
-                    if concierge.output == "csv":
-                        logger.info("Writing PSD metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info("Writing PSD metrics to %s" % concierge.db_name)
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'PSD' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'PSD' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'PSD' metrics")
-
-    # Generate Cross Talk Metrics ----------------------------------------------
-
-    if "crossTalk" in concierge.logic_types:
-        logger.debug("Inside crossTalk business logic ...")
-        try:
-            df = crossTalk_metrics(concierge)
-            if df is None:
-                logger.info("No crossTalk metrics were calculated")
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_crossTalkMetrics.csv"
-                    if concierge.output == "csv":
-                        logger.info("Writing crossTalk metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info(
-                            "Writing crossTalk metrics to %s" % concierge.db_name
-                        )
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'crossTalk' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'crossTalk' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'crossTalk' metrics")
+    # Rows for the database are written by a single process when metrics are
+    # calculated in several, so that no process waits for the disk
+    if concierge.output == "db" and concierge.processes > 1 and write:
+        database.start_writer(concierge.db_name, logger)
 
-    # Generate Pressure Correlation Metrics ----------------------------------------------
+    # Generate metrics ---------------------------------------------------------
+    #
+    # Each business logic group writes its own output file or database tables and
+    # only reads the inputs it shares with the other groups, so groups run
+    # concurrently when more than one process is available.
+
+    # Business logic that numbers its units of work with Concierge.assigned()
+    unit_logic = {
+        "simple": simple_metrics,
+        "sampleRate": sampleRate_metrics,
+        "SNR": SNR_metrics,
+        "PSD": PSD_metrics,
+        "crossTalk": crossTalk_metrics,
+        "crossCorrelation": crossCorrelation_metrics,
+        "orientationCheck": orientationCheck_metrics,
+    }
+    # Workers calculate the PSDs, the PDFs are then calculated from all of them
+    unit_setup = {"PSD": worker_pool.skip_pdfs}
 
-    if "pressureCorrelation" in concierge.logic_types:
-        logger.debug("Inside pressureCorrelation business logic ...")
-        try:
-            df = pressureCorrelation_metrics(concierge)
-            if df is None:
-                logger.info("No pressureCorrelation metrics were calculated")
+    def calculate_units(logic, plan=False):
+        def calculate(concierge, sink):
+            if args.queue is not None:
+                work_queue.write_results(args.queue, logic, sink)
             else:
-                try:
-                    filepath = (
-                        concierge.output_file_base + "_pressureCorrelationMetrics.csv"
-                    )
-                    if concierge.output == "csv":
-                        logger.info(
-                            "Writing pressureCorrelation metrics to %s" % filepath
-                        )
-                    elif concierge.output == "db":
-                        logger.info(
-                            "Writing pressureCorrelation metrics to %s"
-                            % concierge.db_name
-                        )
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'pressureCorrelation' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'pressureCorrelation' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'pressureCorrelation' metrics")
-
-    # Generate Cross Correlation Metrics ---------------------------------------
+                worker_pool.run_metrics(concierge, unit_logic[logic], sink, setup=unit_setup.get(logic), plan=plan)
+        return calculate
+
+    def calculate_PSD(concierge, sink):
+        if concierge.stored_psds or (concierge.processes == 1 and args.queue is None):
+            PSD_metrics(concierge, sink=sink)
+            return
+        calculate_units("PSD")(concierge, sink)
+        pdf_concierge = worker_pool.pdfs_only(concierge)
+        if pdf_concierge is not None:
+            PSD_metrics(pdf_concierge, sink=sink)
+
+    # Output file suffix and function calculating the metrics into a sink, by business logic
+    metric_groups = {
+        "simple": ("_simpleMetrics.csv", calculate_units("simple")),
+        "sampleRate": ("_sampleRateMetrics.csv", calculate_units("sampleRate")),
+        "SNR": ("_SNRMetrics.csv", calculate_units("SNR", plan=True)),
+        "PSD": ("_PSDMetrics.csv", calculate_PSD),
+        "crossTalk": ("_crossTalkMetrics.csv", calculate_units("crossTalk", plan=True)),
+        "pressureCorrelation": ("_pressureCorrelationMetrics.csv", pressureCorrelation_metrics),
+        "crossCorrelation": ("_crossCorrelationMetrics.csv", calculate_units("crossCorrelation", plan=True)),
+        "orientationCheck": ("_orientationCheckMetrics.csv", calculate_units("orientationCheck", plan=True)),
+        "transferFunction": ("_transferMetrics.csv", transferFunction_metrics),
+    }
 
-    if "crossCorrelation" in concierge.logic_types:
-        logger.debug("Inside crossCorrelation business logic ...")
+    def run_group(concierge, logic):
+        (suffix, calculate) = metric_groups[logic]
+        logger.debug("Inside %s business logic ..." % logic)
         try:
-            df = crossCorrelation_metrics(concierge)
-            if df is None:
-                logger.info("No crossCorrelation metrics were calculated")
-            else:
-                try:
-                    filepath = (
-                        concierge.output_file_base + "_crossCorrelationMetrics.csv"
-                    )
-                    if concierge.output == "csv":
-                        logger.info("Writing crossCorrelation metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info(
-                            "Writing crossCorrelation metrics to %s" % concierge.db_name
-                        )
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'crossCorrelation' metric results")
+            filepath = concierge.output_file_base + suffix if write else None
+            with MetricSink(concierge, logic, filepath, keep=frames is not None) as sink:
+                calculate(concierge, sink=sink)
+            if frames is not None and sink.rows > 0:
+                frames[logic] = sink.dataframe()
+            if sink.rows == 0 and (logic != "PSD" or "PSD" in concierge.function_by_logic["PSD"]):
+                logger.info("No %s metrics were calculated" % logic)
         except NoAvailableDataError as e:
-            logger.info("No data available for 'crossCorrelation' metrics")
+            logger.info("No data available for '%s' metrics" % logic)
         except Exception as e:
             logger.debug(e)
-            logger.error("Error calculating 'crossCorrelation' metrics")
+            logger.error("Error calculating '%s' metrics" % logic)
 
-    # Generate Orientation Check Metrics ---------------------------------------
+    logic_types = [logic for logic in metric_groups if logic in concierge.logic_types]
 
-    if "orientationCheck" in concierge.logic_types:
-        logger.debug("Inside orientationCheck business logic ...")
+    # Distributed run: calculate the queued units of work together with the other workers
+    if args.queue is not None or args.worker is not None:
+        distributed = dict((logic, unit_logic[logic]) for logic in logic_types
+                           if logic in unit_logic and not (logic == "PSD" and concierge.stored_psds))
         try:
-            df = orientationCheck_metrics(concierge)
-            if df is None:
-                logger.info("No orientationCheck metrics were calculated")
-            else:
-                try:
-                    filepath = (
-                        concierge.output_file_base + "_orientationCheckMetrics.csv"
-                    )
-                    if concierge.output == "csv":
-                        logger.info("Writing orientationCheck metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info(
-                            "Writing orientationCheck metrics to %s" % concierge.db_name
-                        )
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'orientationCheck' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'orientationCheck' metrics")
+            if args.queue is not None:
+                request = {"args": dict(vars(args), starttime=str(concierge.requested_starttime),
+                                        endtime=str(concierge.requested_endtime)),
+                           "cwd": os.getcwd()}
+                for name in ("queue", "worker", "log_level", "append", "processes"):
+                    request["args"].pop(name)
+                work_queue.distribute(concierge, args.queue, request, distributed, unit_setup)
+            work_queue.run_workers(concierge, args.queue or args.worker, distributed, unit_setup)
         except Exception as e:
             logger.debug(e)
-            logger.error("Error calculating 'orientationCheck' metrics")
-
-    # Generate Transfer Function Metrics ---------------------------------------
+            logger.critical("Failed to use work queue %s" % (args.queue or args.worker))
+            raise SystemExit
+        if args.worker is not None:
+            database.stop_writers()
+            logger.info("ALL FINISHED!")
+            return {}
+
+    if frames is not None:
+        # Dataframes are kept by this process
+        for logic in logic_types:
+            run_group(concierge, logic)
+    else:
+        worker_pool.run_groups(concierge, logic_types, run_group)
+    database.stop_writers()
 
-    if "transferFunction" in concierge.logic_types:
-        logger.debug("Inside transferFunction business logic ...")
-        try:
-            df = transferFunction_metrics(concierge)
-            if df is None:
-                logger.info("No transferFunction metrics were calculated")
-            else:
-                try:
-                    filepath = concierge.output_file_base + "_transferMetrics.csv"
-                    if concierge.output == "csv":
-                        logger.info("Writing transfer metrics to %s" % filepath)
-                    elif concierge.output == "db":
-                        logger.info(
-                            "Writing transferFunction metrics to %s" % concierge.db_name
-                        )
-                    utils.write_simple_df(
-                        df, filepath, concierge, sigfigs=concierge.sigfigs
-                    )
-                except Exception as e:
-                    logger.debug(e)
-                    logger.error("Error writing 'transferFunction' metric results")
-        except NoAvailableDataError as e:
-            logger.info("No data available for 'transferFunction' metrics")
-        except Exception as e:
-            logger.debug(e)
-            logger.error("Error calculating 'transferFunction' metrics")
+    if concierge.result_cache is not None:
+        logger.info("Reused %d cached metric results from %s" % (concierge.result_cache.hits, concierge.cache_dir))
 
     logger.info("ALL FINISHED!")
 
+    # Output of each business logic group
+    outputs = {}
+    for logic in logic_types:
+        if write and concierge.output == "db":
+            outputs[logic] = concierge.db_name
+        elif write and os.path.isfile(concierge.output_file_base + metric_groups[logic][0]):
+            outputs[logic] = concierge.output_file_base + metric_groups[logic][0]
+    return outputs
+
 
 # ------------------------------------------------------------------------------
 
@@ -0,0 +1,134 @@
+"""
+ISPAQ batch of requests calculated in one process.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import copy
+import json
+
+# ISPAQ modules
+try:
+    from user_request import UserRequest
+    from concierge import SharedSources
+    from api import NOT_PREFERENCES
+except:
+    from .user_request import UserRequest
+    from .concierge import SharedSources
+    from .api import NOT_PREFERENCES
+
+
+def load_manifest(filename):
+    """
+    Read the jobs of a manifest file.
+    :param filename: JSON file holding a list of jobs, or an object with a 'jobs' list.
+    :return: List of jobs.
+
+    Each job is one of
+     * an object with 'metrics' and 'stations', as -M and -S, optional 'starttime'
+       and 'endtime', and optional 'overrides' holding any other command line
+       argument by name, e.g. {"dataselect_url": "IRIS", "processes": 4}
+     * the JSON representation of a UserRequest, as written by UserRequest.json_dump()
+     * the name of a file holding such a JSON representation
+
+    .. rubric:: Example
+
+    >>> load_manifest('nightly.json')  #doctest: +SKIP
+    [{'metrics': 'basicStats', 'stations': 'IU.ANMO.00.BH?', 'starttime': '2020-01-01'}]
+    """
+    with open(os.path.expanduser(filename), 'r') as infile:
+        manifest = json.load(infile)
+    if isinstance(manifest, dict):
+        manifest = manifest['jobs']
+    if not isinstance(manifest, list):
+        raise ValueError("manifest %s is not a list of jobs" % filename)
+    return manifest
+
+
+def job_request(job, args, logger):
+    """
+    Create the arguments and UserRequest of a manifest job.
+    :param job: Job from load_manifest().
+    :param args: Command line arguments of the manifest run, the defaults of every job.
+    :param logger: Logger.
+    :return: Tuple of (arguments, UserRequest).
+    """
+    job_args = copy.copy(args)
+    job_args.manifest = None
+
+    if isinstance(job, str) or 'requested_metric_set' in job:
+        user_request = UserRequest(json_representation=job if isinstance(job, str) else json.dumps(job),
+                                   logger=logger)
+        job_args.metrics = user_request.requested_metric_set
+        job_args.stations = user_request.requested_sncl_set
+        return (job_args, user_request)
+
+    for name in ('metrics', 'stations'):
+        if name not in job:
+            raise ValueError("manifest job is missing '%s'" % name)
+        value = job[name]
+        setattr(job_args, name, value if isinstance(value, str) else ','.join(value))
+    job_args.starttime = job.get('starttime')
+    job_args.endtime = job.get('endtime')
+    overrides = job.get('overrides', {})
+    for name in overrides:
+        if name in NOT_PREFERENCES or not hasattr(job_args, name):
+            raise ValueError("manifest job cannot override '%s'" % name)
+        setattr(job_args, name, overrides[name])
+
+    return (job_args, UserRequest(job_args, logger=logger))
+
+
+def run_manifest(filename, args, logger, run_request):
+    """
+    Calculate the jobs of a manifest one after the other in this process.
+    :param filename: Manifest file, see load_manifest().
+    :param args: Command line arguments of the manifest run, the defaults of every job.
+    :param logger: Logger.
+    :param run_request: Function calculating one request, see ispaq.run_request().
+
+    R and the ISPAQ modules are loaded once for all jobs. Jobs reading the same
+    data, station, event and response sources are calculated together and share a
+    :class:`~ispaq.concierge.SharedSources`, so that the StationXML file is parsed,
+    data directories are listed and events and responses are requested only once
+    per group. A job that fails is logged and the next one is started.
+    """
+    try:
+        jobs = load_manifest(filename)
+    except Exception as e:
+        logger.debug(e)
+        logger.critical("Cannot read manifest %s" % filename)
+        raise SystemExit
+
+    # Jobs by data sources, in the order the sources first appear
+    groups = {}
+    for (number, job) in enumerate(jobs, 1):
+        try:
+            (job_args, user_request) = job_request(job, args, logger)
+        except (Exception, SystemExit) as e:
+            logger.debug(e)
+            logger.error("Failed to create the UserRequest of manifest job %d" % number)
+            continue
+        sources = (user_request.dataselect_url, user_request.station_url,
+                   user_request.event_url, user_request.resp_dir)
+        groups.setdefault(sources, []).append((number, job_args, user_request))
+
+    finished = 0
+    for sources in groups:
+        shared = SharedSources()
+        for (number, job_args, user_request) in groups[sources]:
+            logger.info("Calculating manifest job %d of %d: metrics %s, stations %s"
+                        % (number, len(jobs), job_args.metrics, job_args.stations))
+            try:
+                run_request(job_args, logger, user_request=user_request, shared=shared)
+                finished += 1
+            except (Exception, SystemExit) as e:
+                logger.debug(e)
+                logger.error("Error calculating manifest job %d" % number)
+
+    logger.info("Finished %d of %d manifest jobs" % (finished, len(jobs)))
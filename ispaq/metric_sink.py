@@ -0,0 +1,197 @@
+"""
+ISPAQ incremental metric writer.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import time
+
+import pandas as pd
+
+try:
+    import utils
+    import database
+    import completed_units
+except:
+    from . import utils
+    from . import database
+    from . import completed_units
+
+
+class MetricSink(object):
+    """
+    Write metric dataframes to csv or db output while they are being generated.
+
+    :type concierge: :class:`~ispaq.concierge.Concierge`
+    :param concierge: Data access expediter.
+    :type name: str
+    :param name: Business logic name used in log messages, e.g. 'simple'.
+    :type filepath: str
+    :param filepath: csv file to write when concierge.output is 'csv', or None to
+        write nothing.
+    :type batch_rows: int
+    :param batch_rows: Number of buffered rows that triggers a write.
+    :type flush_seconds: float
+    :param flush_seconds: Age of the oldest buffered dataframe that triggers a write.
+    :type keep: bool
+    :param keep: Also keep the metrics in memory, see dataframe().
+
+    Business logic appends the dataframe of each SNCL-day as it is calculated.
+    Dataframes are buffered and written in batches, so memory use does not grow
+    with the length of the requested time span and everything up to the last
+    batch is kept if the run is interrupted. When resuming, metrics already
+    written by a previous run are dropped and new rows are appended to filepath.
+    :class:`~ispaq.completed_units.CompletedUnit` markers are recorded once the
+    metrics appended before them are written.
+
+    .. rubric:: Example
+
+    >>> with MetricSink(concierge, 'simple', 'simpleMetrics.csv') as sink:  #doctest: +SKIP
+    ...     simple_metrics(concierge, sink=sink)
+    """
+    def __init__(self, concierge, name, filepath, batch_rows=10000, flush_seconds=10, keep=False):
+        self.concierge = concierge
+        self.logger = concierge.logger
+        self.name = name
+        self.filepath = filepath
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.frames = [] if keep else None
+
+        self.transform = None
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_units = []
+        self.pending_since = None
+        self.count = 0       # dataframes appended
+        self.rows = 0        # rows written
+        self.columns = None  # csv columns written so far
+        self.failed = 0      # messages the database writer process could not write, see database.sync()
+
+        # Add to the results of the previous run when resuming
+        if concierge.resume and concierge.output == 'csv' and filepath is not None and os.path.isfile(filepath):
+            try:
+                self.columns = list(pd.read_csv(filepath, nrows=0).columns)
+            except pd.errors.EmptyDataError:
+                self.columns = None
+
+    def start(self, transform=None):
+        """
+        Set the function applied to each batch before it is written.
+        :param transform: Function taking and returning a metrics dataframe, e.g.
+            to keep only the requested metrics, or None.
+        :return: The sink, so that it can replace the list of dataframes.
+        """
+        self.transform = transform
+        return self
+
+    def append(self, df):
+        """
+        Add the metrics of one SNCL-day, writing the buffer when it is full or old.
+        :param df: Dataframe of metrics, or CompletedUnit marker.
+        """
+        if isinstance(df, completed_units.CompletedUnit):
+            self.pending_units.append(df.key)
+        else:
+            self.count += 1
+            if df is None or df.empty:
+                return
+            self.pending.append(df)
+            self.pending_rows += df.shape[0]
+        if self.pending_since is None:
+            self.pending_since = time.time()
+
+        if (self.pending_rows >= self.batch_rows or len(self.pending_units) >= self.batch_rows or
+                time.time() - self.pending_since >= self.flush_seconds):
+            self.flush()
+
+    def __len__(self):
+        return self.count
+
+    def flush(self):
+        """
+        Write all buffered metrics, then record the units they complete.
+        """
+        pending = self.pending
+        units = self.pending_units
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_units = []
+        self.pending_since = None
+
+        written = self.write(pd.concat(pending, ignore_index=True)) if pending else True
+        if written and units and self.filepath is not None and self.concierge.output == 'db':
+            # Rows may still be queued for the writer process, which can fail to write them
+            failed = database.sync(self.concierge.db_name)
+            if failed > self.failed:
+                self.logger.error("Some rows could not be written to %s, not recording the completed '%s' metric functions"
+                                  % (self.concierge.db_name, self.name))
+                self.failed = failed
+                written = False
+        if written and units and self.filepath is not None:
+            try:
+                completed_units.write(units, self.concierge, self.filepath)
+            except Exception as e:
+                self.logger.debug(e)
+                self.logger.error("Error recording the completed '%s' metric functions" % self.name)
+
+    def write(self, result):
+        """
+        Write a batch of metrics.
+        :param result: Dataframe of metrics.
+        :return: False if the metrics could not be written.
+        """
+        if self.transform is not None:
+            result = self.transform(result)
+        result = self.concierge.drop_completed(result)
+        if result is None or result.empty:
+            return True
+
+        if self.frames is not None:
+            self.frames.append(result)
+        if self.filepath is None:
+            self.rows += result.shape[0]
+            return True
+
+        try:
+            if self.rows == 0:
+                if self.concierge.output == 'csv':
+                    self.logger.info("Writing %s metrics to %s" % (self.name, self.filepath))
+                elif self.concierge.output == 'db':
+                    self.logger.info("Writing %s metrics to %s" % (self.name, self.concierge.db_name))
+            self.columns = utils.write_simple_df(result, self.filepath, self.concierge, sigfigs=self.concierge.sigfigs,
+                                                 append=self.columns is not None, columns=self.columns)
+            self.rows += result.shape[0]
+        except Exception as e:
+            self.logger.debug(e)
+            self.logger.error("Error writing '%s' metric results" % self.name)
+            return False
+        return True
+
+    def dataframe(self):
+        """
+        Return the metrics kept in memory.
+        :return: Dataframe of all metrics written so far, or None if there are none.
+        """
+        if not self.frames:
+            return None
+        return pd.concat(self.frames, ignore_index=True)
+
+    def close(self):
+        """
+        Write any remaining metrics.
+        """
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Keep what has been calculated, even when the business logic fails
+        self.close()
+        return False
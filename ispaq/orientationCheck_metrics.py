@@ -23,15 +23,17 @@ import rpy2.robjects as ro
 from rpy2.robjects import numpy2ri
 
 
-def orientationCheck_metrics(concierge):
+def orientationCheck_metrics(concierge, sink=None):
     """
     Generate *orientationCheck* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expiditer.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
     
     :rtype: pandas dataframe
-    :return: Dataframe of simple metrics.
+    :return: Dataframe of simple metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -79,8 +81,9 @@ def orientationCheck_metrics(concierge):
         logger.info('No events found for orientationCheck metrics.')
         return None
         
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start()
 
     #############################################################
     ## Loop through each event.
@@ -90,6 +93,8 @@ def orientationCheck_metrics(concierge):
 
 
     for (index, event) in events.iterrows():
+        if not concierge.assigned(None, event.time):
+            continue    # calculated by another worker process
 
         logger.info('Magnitude %3.1f event: %s %sT%s:%s:%sZ' % (event.magnitude, event.eventLocationName, event.time.date, str(event.time.hour).zfill(2), str(event.time.minute).zfill(2), str(event.time.second).zfill(2)))
         
@@ -377,6 +382,9 @@ def orientationCheck_metrics(concierge):
     if len(dataframes) == 0:
         logger.warning('"orientation_check" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         result.reset_index(drop=True, inplace=True)
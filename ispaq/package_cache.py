@@ -0,0 +1,99 @@
+"""
+ISPAQ cache of information read from the installed R packages.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+
+# R packages ISPAQ depends on
+IRIS_packages = ('seismicRoll', 'IRISSeismic', 'IRISMustangMetrics')
+
+
+def cache_path():
+    """
+    Return the cache file of this Python environment.
+
+    Each conda environment has its own R library, so the file name includes a
+    hash of the environment prefix and of the R library search path variables.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    environment = '\0'.join([sys.prefix, os.environ.get('R_LIBS', ''), os.environ.get('R_LIBS_USER', ''),
+                             os.environ.get('R_LIBS_SITE', '')])
+    digest = hashlib.sha256(environment.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_home, 'ispaq', 'R_packages_%s.json' % digest)
+
+
+def _stamp(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load():
+    """
+    Return the cached information if the R packages have not changed since it was stored.
+    :return: Dictionary with 'versions' and 'function_metadata', or None.
+
+    The DESCRIPTION file of every package must still have the size and
+    modification time it had when the cache was written, so installing,
+    updating or removing a package invalidates the cache.
+    """
+    try:
+        with open(cache_path(), 'r') as infile:
+            cache = json.load(infile)
+        for package in IRIS_packages:
+            description = cache['packages'][package]
+            if _stamp(description['path']) != description['stamp']:
+                return None
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+    return {'versions': dict((package, cache['packages'][package]['version']) for package in IRIS_packages),
+            'function_metadata': cache['function_metadata']}
+
+
+def save(descriptions, versions, function_metadata):
+    """
+    Store information read from the R packages.
+    :param descriptions: Dictionary of the DESCRIPTION file of each package.
+    :param versions: Dictionary of the version string of each package.
+    :param function_metadata: Result of IRISMustangMetrics::getMetricFunctionMetadata.
+    """
+    cache = {'packages': dict((package, {'path': descriptions[package],
+                                         'stamp': _stamp(descriptions[package]),
+                                         'version': versions[package]})
+                              for package in IRIS_packages),
+             'function_metadata': function_metadata}
+    filepath = cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Write to a temporary file first so that readers never see a partial cache
+        (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(cache, outfile)
+            os.replace(tmppath, filepath)
+        except:
+            os.remove(tmppath)
+            raise
+    except (IOError, OSError):
+        # The cache is only an optimization
+        pass
+
+
+def clear():
+    """
+    Remove the cache, e.g. after installing or updating R packages.
+    """
+    try:
+        os.remove(cache_path())
+    except (IOError, OSError):
+        pass
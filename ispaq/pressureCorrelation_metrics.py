@@ -17,12 +17,14 @@ from . import irisseismic
 from . import irismustangmetrics
 
 
-def pressureCorrelation_metrics(concierge):
+def pressureCorrelation_metrics(concierge, sink=None):
     """
     Generate *pressureCorrelation* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expiditer.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
     
     :rtype: pandas dataframe (TODO: change this)
     :return: Dataframe of pressureCorrelation metrics. (TODO: change this)
@@ -34,8 +36,9 @@ def pressureCorrelation_metrics(concierge):
     # Get the logger from the concierge
     logger = concierge.logger
     
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: df.assign(metricName='pressure_effects'))
 
     # Default parameters from IRISMustangUtils::generateMetrics_crossTalk
     channelFilter = "LH."
@@ -188,6 +191,9 @@ def pressureCorrelation_metrics(concierge):
     if len(dataframes) == 0:
         logger.warning('"pressure_correlation" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True) 
         # Change metricName to "pressure_effects"
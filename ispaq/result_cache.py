@@ -0,0 +1,182 @@
+"""
+ISPAQ cache of metric results keyed by their input data.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import glob
+import pickle
+import sqlite3
+import hashlib
+import tempfile
+
+
+# Modules whose code or hard coded parameters change metric results; utils.py
+# calculates the spectra of the SNR and sample rate metrics
+CALCULATION_MODULES = ['*_metrics.py', 'PSD_derived.py', 'irisseismic.py', 'irismustangmetrics.py',
+                       'noise_models.py', 'evalresp.py', 'utils.py']
+
+def calculation_modules():
+    """
+    Return the ISPAQ source files that metric results depend on.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return sorted(set(filepath for pattern in CALCULATION_MODULES
+                      for filepath in glob.glob(os.path.join(directory, pattern))))
+
+
+class ResultCache(object):
+    """
+    Store metric results under a fingerprint of everything they were calculated from.
+
+    :type cache_dir: str
+    :param cache_dir: Directory holding the cached results.
+    :type versions: dict
+    :param versions: Versions of the software used to calculate the results, e.g.
+        the installed R packages.
+
+    A key combines the SNCL, time window, the size and content hash of each input
+    file, the metadata epoch of the channel and the versions of the R packages and
+    of the ISPAQ modules that calculate metrics. Changing any of them gives a new
+    key, so results calculated from old inputs are never returned. Results are
+    stored per metric function, so that functions can be added to a request
+    without recalculating the ones already cached.
+
+    Content hashes are stored in cache_dir by path, size and modification time,
+    so that later runs only read the files that changed.
+
+    .. rubric:: Example
+
+    >>> cache = ResultCache('/tmp/ispaq_cache', {'IRISMustangMetrics': '2.4.6'})  #doctest: +SKIP
+    >>> key = cache.key('simple', 'IU.ANMO.00.BHZ', '2020-01-01', ['IU.ANMO.00.BHZ.2020.001'])  #doctest: +SKIP
+    >>> cache.put(key, 'basicStats', df)  #doctest: +SKIP
+    >>> cache.get(key, 'basicStats')  #doctest: +SKIP
+    """
+    def __init__(self, cache_dir, versions=None):
+        self.cache_dir = cache_dir
+        self.file_hashes = {}
+        self.conn = None
+        self.pid = None
+
+        # Results depend on the R packages and on the parameters hard coded in the business logic
+        source = hashlib.sha256()
+        for filepath in calculation_modules():
+            source.update(self.file_hash(filepath).encode())
+        self.version = repr((sorted((versions or {}).items()), source.hexdigest()))
+
+        self.hits = 0
+        self.misses = 0
+
+    def hash_db(self):
+        # One connection per process, as connections must not be used across fork()
+        if self.pid != os.getpid():
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, exist_ok=True)
+            self.conn = sqlite3.connect(os.path.join(self.cache_dir, 'file_hashes.sqlite'), timeout=60,
+                                        isolation_level=None)
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS file_hashes (
+                                   path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)""")
+            self.pid = os.getpid()
+        return self.conn
+
+    def file_hash(self, filepath):
+        """
+        Return the content hash of a file, reading each version of the file only once.
+        :param filepath: File to hash.
+        :return: Hexadecimal SHA-256 digest.
+        """
+        stat = os.stat(filepath)
+        version = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        if version in self.file_hashes:
+            return self.file_hashes[version]
+
+        try:
+            row = self.hash_db().execute("SELECT hash FROM file_hashes WHERE path = ? AND size = ? AND mtime = ?",
+                                         version).fetchone()
+        except sqlite3.Error:
+            row = None
+        if row is None:
+            digest = hashlib.sha256()
+            with open(filepath, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            row = (digest.hexdigest(),)
+            try:
+                self.hash_db().execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                                       version + row)
+            except sqlite3.Error:
+                pass
+        self.file_hashes[version] = row[0]
+        return row[0]
+
+    def file_fingerprint(self, filepaths, root=None):
+        """
+        Describe input files by name, size and content hash.
+        :param filepaths: Files to describe.
+        :param root: Directory that names are made relative to.
+        :return: List of (name, size, hash) tuples.
+
+        Modification times are left out, so that touching or copying a file does
+        not invalidate the results calculated from it.
+        """
+        fingerprint = []
+        for filepath in sorted(filepaths):
+            name = os.path.relpath(filepath, root) if root else os.path.basename(filepath)
+            fingerprint.append((name, os.path.getsize(filepath), self.file_hash(filepath)))
+        return fingerprint
+
+    def key(self, *inputs):
+        """
+        Combine the inputs of a calculation into a cache key.
+        :param inputs: Values with a stable repr(), e.g. strings, numbers and lists of them.
+        :return: Hexadecimal SHA-256 digest.
+        """
+        digest = hashlib.sha256(self.version.encode())
+        for value in inputs:
+            digest.update(repr(value).encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path(self, key, function):
+        return os.path.join(self.cache_dir, key[:2], '%s_%s.pkl' % (key, function))
+
+    def get(self, key, function):
+        """
+        Return the cached result of a metric function.
+        :param key: Key returned by key().
+        :param function: Metric function name, e.g. 'basicStats'.
+        :return: The stored result, or None if there is none.
+        """
+        try:
+            with open(self.path(key, function), 'rb') as f:
+                result = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, function, result):
+        """
+        Store the result of a metric function.
+        :param key: Key returned by key().
+        :param function: Metric function name, e.g. 'basicStats'.
+        :param result: Picklable result, usually a dataframe.
+        """
+        filepath = self.path(key, function)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # Write to a temporary file first so that readers never see a partial result
+        (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath, filepath)
+        except:
+            os.remove(tmppath)
+            raise
@@ -23,15 +23,17 @@ from obspy.clients.fdsn import Client
 from obspy import UTCDateTime
 from .concierge import NoAvailableDataError
 
-def sampleRate_metrics(concierge):
+def sampleRate_metrics(concierge, sink=None):
     """
     Generate *sampleRate* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expediter.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
 
     :rtype: pandas dataframe
-    :return: Dataframe of sampleRate metrics.
+    :return: Dataframe of sampleRate metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -47,8 +49,14 @@ def sampleRate_metrics(concierge):
     # function metadata dictionary
     function_metadata = concierge.function_by_logic['sampleRate']
 
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: utils.select_metrics(df, concierge.metric_names))
+
+    def completed(metric, snclId, starttime):
+        # Record a metric as done with a SNCL-day, after its values, see completed_units
+        if sink is not None:
+            sink.append(concierge.completed_unit(metric, snclId, starttime))
     
     start = concierge.requested_starttime
     end = concierge.requested_endtime
@@ -72,6 +80,9 @@ def sampleRate_metrics(concierge):
         if starttime == end:
             continue
 
+        if not concierge.in_shard(starttime):
+            continue    # days calculated by another worker process
+
         try:
             availability = concierge.get_availability("sample_rates", starttime=starttime, endtime=endtime)
         except NoAvailableDataError as e:
@@ -92,6 +103,30 @@ def sampleRate_metrics(concierge):
         logger.info('Calculating sampleRate values for %d SNCLs on %s' % (availability.shape[0],str(starttime).split('T')[0]))
 
         for (index, av) in availability.iterrows():
+            if not concierge.assigned(av.snclId, starttime):
+                continue    # calculated by another worker process
+
+            # Skip metrics written by a previous run
+            remaining = concierge.remaining_functions([metric for metric in ['sample_rate_resp','sample_rate_channel']
+                                                       if metric in concierge.metric_names], av.snclId, starttime)
+            if len(remaining) == 0:
+                logger.info('%03d Skipping sampleRate values for %s, already calculated' % (index, av.snclId))
+                continue
+
+            # Reuse results calculated from the same data, metadata and software
+            cache_key = concierge.result_key('sampleRate', av, starttime, endtime)
+            resp_key = concierge.result_key('sampleRate', av, starttime, endtime, response=True)
+            cached = concierge.cached_results(cache_key, [metric for metric in remaining if metric != 'sample_rate_resp'])
+            cached.update(concierge.cached_results(resp_key, [metric for metric in remaining if metric == 'sample_rate_resp']))
+            for metric in cached:
+                if not cached[metric].empty:
+                    dataframes.append(cached[metric])
+                completed(metric, av.snclId, starttime)
+            remaining = [metric for metric in remaining if metric not in cached]
+            if len(remaining) == 0:
+                logger.info('%03d Using cached sampleRate values for %s' % (index, av.snclId))
+                continue
+
             logger.info('%03d Calculating sampleRate values for %s' % (index, av.snclId))
 
             # Get the data ----------------------------------------------
@@ -110,7 +145,7 @@ def sampleRate_metrics(concierge):
 
             # Run the sampleRate metrics ----------------------------------------
 
-            if 'sample_rate_resp' in concierge.metric_names:
+            if 'sample_rate_resp' in remaining:
                 try:
                     evalresp = None
                     sampling_rate = utils.get_slot(r_stream, 'sampling_rate')
@@ -129,6 +164,8 @@ def sampleRate_metrics(concierge):
 
                     if not df1.empty:
                         dataframes.append(df1)
+                    concierge.cache_result(resp_key, 'sample_rate_resp', df1)
+                    completed('sample_rate_resp', av.snclId, starttime)
                 
                 except Exception as e:
                     if str(e).lower().find('could not resolve host: service.earthscope.org') > -1:
@@ -139,7 +176,7 @@ def sampleRate_metrics(concierge):
                     logger.warning('sampleRateResp metric calculation failed for %s' % (av.snclId))
                     continue
             
-            if 'sample_rate_channel' in concierge.metric_names:
+            if 'sample_rate_channel' in remaining:
                 try:
                     chan_rate = av.samplerate     # metadata sample rate
                     channel_pct = 1  # % deviation allowed between metadata sample rate and miniseed sample rate
@@ -148,6 +185,8 @@ def sampleRate_metrics(concierge):
 
                     if not df2.empty:
                         dataframes.append(df2)
+                    concierge.cache_result(cache_key, 'sample_rate_channel', df2)
+                    completed('sample_rate_channel', av.snclId, starttime)
 
                 except Exception as e:
                     logger.error(e)
@@ -159,6 +198,10 @@ def sampleRate_metrics(concierge):
         logger.warning('"sampleRate" metric calculation generated zero metrics')
         return None
 
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
+
     else:
         # Create a boolean mask for filtering the dataframe
         def valid_metric(x):
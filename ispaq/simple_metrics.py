@@ -22,15 +22,17 @@ from . import utils
 from . import irisseismic
 from . import irismustangmetrics
 
-def simple_metrics(concierge):
+def simple_metrics(concierge, sink=None):
     """
     Generate *simple* metrics.
 
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expediter.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
 
     :rtype: pandas dataframe
-    :return: Dataframe of simple metrics.
+    :return: Dataframe of simple metrics, or None if written to the sink.
 
     .. rubric:: Example
 
@@ -42,8 +44,14 @@ def simple_metrics(concierge):
     # Default parameters from IRISMustangUtils::generateMetrics_simple
     channelFilter = '.*'
 
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start(lambda df: utils.select_metrics(df, concierge.metric_names))
+
+    def completed(function, snclId, starttime):
+        # Record a metric function as done with a SNCL-day, after its metrics, see completed_units
+        if sink is not None:
+            sink.append(concierge.completed_unit(function, snclId, starttime))
 
     # ----- All UN-available SNCLs ----------------------------------------------
 
@@ -88,6 +96,9 @@ def simple_metrics(concierge):
         if starttime == end:
             continue
 
+        if not concierge.in_shard(starttime):
+            continue    # days calculated by another worker process
+
         try:
             availability = concierge.get_availability("simple", starttime=starttime, endtime=endtime)
         except NoAvailableDataError as e:
@@ -111,6 +122,26 @@ def simple_metrics(concierge):
         logger.info('Calculating simple metrics for %d SNCLs on %s' % (availability.shape[0], str(starttime).split('T')[0]))
 
         for (index, av) in availability.iterrows():
+            if not concierge.assigned(av.snclId, starttime):
+                continue    # calculated by another worker process
+
+            # Skip metrics written by a previous run
+            remaining = concierge.remaining_functions(function_metadata, av.snclId, starttime)
+            if len(remaining) == 0:
+                logger.info('%03d Skipping simple metrics for %s, already calculated' % (index, av.snclId))
+                continue
+
+            # Reuse results calculated from the same data, metadata and software
+            cache_key = concierge.result_key('simple', av, starttime, endtime)
+            cached = concierge.cached_results(cache_key, remaining)
+            for function in cached:
+                if not cached[function].empty:
+                    dataframes.append(cached[function])
+                completed(function, av.snclId, starttime)
+            remaining = dict((function, remaining[function]) for function in remaining if function not in cached)
+            if len(remaining) == 0:
+                logger.info('%03d Using cached simple metrics for %s' % (index, av.snclId))
+                continue
 
             logger.info('%03d Calculating simple metrics for %s' % (index, av.snclId))
 
@@ -141,31 +172,37 @@ def simple_metrics(concierge):
 
             # Run the Gaps metric ----------------------------------------
 
-            if 'gaps' in function_metadata:
+            if 'gaps' in remaining:
                 try:
                     df = irismustangmetrics.apply_simple_metric(av, starttime, endtime, r_stream, 'gaps')
                     dataframes.append(df)
+                    concierge.cache_result(cache_key, 'gaps', df)
+                    completed('gaps', av.snclId, starttime)
                 except Exception as e:
                     logger.warning('"gaps" metric calculation failed for %s: %s' % (av.snclId, e))
             
             # Run the State-of-Health metric -----------------------------
-            if 'stateOfHealth' in function_metadata:
+            if 'stateOfHealth' in remaining:
                 try:
                     df = irismustangmetrics.apply_simple_metric(av, starttime, endtime, r_stream, 'stateOfHealth')
                     # for local miniSEED data, remove invalid state of health metrics
                     if concierge.dataselect_client is None and (StrictVersion(obspy.__version__) < StrictVersion("1.1.0")):
                         df = df[~df.metricName.isin(["calibration_signal","clock_locked","event_begin","event_end","event_in_progess","timing_correction","timing_quality"])]
                     dataframes.append(df)
+                    concierge.cache_result(cache_key, 'stateOfHealth', df)
+                    completed('stateOfHealth', av.snclId, starttime)
                 except Exception as e:
                     logger.warning('"stateOfHealth" metric calculation failed for %s: %s' % (av.snclId, e))
                     
             
             # Run the Basic Stats metric ---------------------------------
 
-            if 'basicStats' in function_metadata:  
+            if 'basicStats' in remaining:  
                 try:
                     df = irismustangmetrics.apply_simple_metric(av, starttime, endtime, r_stream, 'basicStats')
                     dataframes.append(df)
+                    concierge.cache_result(cache_key, 'basicStats', df)
+                    completed('basicStats', av.snclId, starttime)
                 except Exception as e:
                     logger.warning('"basicStats" metric calculation failed for %s: %s' % (av.snclId, e))
                     
@@ -178,7 +215,7 @@ def simple_metrics(concierge):
             # NOTE:  An increment that translates to 0.2-0.5 secs seems to be a good compromise
             # NOTE:  between performance and accuracy.
 
-            if 'STALTA' in function_metadata:
+            if 'STALTA' in remaining:
                 if av.channel.startswith(('BH','HH','CH','DH','EH','SH','LH','MH','DP','SP','LP','EP','EL','HL','LL','BL','SL','BX','HX')):
                     try:
                         r_stream_stalta = concierge.get_dataselect(av.network, av.station, av.location, av.channel, starttime, endtime, inclusiveEnd=False)
@@ -200,17 +237,21 @@ def simple_metrics(concierge):
                     try:
                         df = irismustangmetrics.apply_simple_metric(av, starttime, endtime, r_stream_stalta, 'STALTA', staSecs=3, ltaSecs=30, increment=increment, algorithm='classic_LR')
                         dataframes.append(df)
+                        concierge.cache_result(cache_key, 'STALTA', df)
+                        completed('STALTA', av.snclId, starttime)
                     except Exception as e:
                         logger.warning('"STALTA" metric calculation failed for for %s: %s' % (av.snclId, e))
                 else:
                     logger.info('Skipping %s because channel not valid for "max_stalta" metric' % av.snclId)
+                    concierge.cache_result(cache_key, 'STALTA', pd.DataFrame())
+                    completed('STALTA', av.snclId, starttime)
                     
                     
             # Run the numSpikes metric --------------------------------------
 
             # NOTE:  Appropriate values for spikesMetric arguments are determined empirically
                     
-            if 'numSpikes' in function_metadata:
+            if 'numSpikes' in remaining:
                 # Limit this metric to BH. and HH. channels
                 if av.channel.startswith(('BH','HH','BX','HX')):
                     windowSize = 41
@@ -219,15 +260,19 @@ def simple_metrics(concierge):
                     try:
                         df = irismustangmetrics.apply_simple_metric(av, starttime, endtime, r_stream, 'numSpikes', windowSize, thresholdMin, fixedThreshold=True)
                         dataframes.append(df)
+                        concierge.cache_result(cache_key, 'numSpikes', df)
+                        completed('numSpikes', av.snclId, starttime)
                     except Exception as e:
                         logger.warning('"numSpikes" metric calculation failed for %s: %s' % (av.snclId, e))            
                 else:
                     logger.info('Skipping %s because channel not valid for "num_spikes" metric' % av.snclId)
+                    concierge.cache_result(cache_key, 'numSpikes', pd.DataFrame())
+                    completed('numSpikes', av.snclId, starttime)
                         
                         
                         
             # Run the maxRange metric --------------------------------------           
-            if 'maxRange' in function_metadata:
+            if 'maxRange' in remaining:
                 if av.channel.startswith(('B','C','D','E','F','G','H','L','M','S')):
                     windowSize = 300
                     increment = 150
@@ -235,10 +280,14 @@ def simple_metrics(concierge):
                     try:
                         df = irismustangmetrics.apply_simple_metric(av, starttime, endtime, r_stream, 'maxRange', windowSize, increment)
                         dataframes.append(df)
+                        concierge.cache_result(cache_key, 'maxRange', df)
+                        completed('maxRange', av.snclId, starttime)
                     except Exception as e:
                         logger.warning('"maxRange" metric calculation failed for for %s: %s' % (av.snclId, e))
                 else:
-                    logger.info('Skipping %s because channel not valid for "max_range" metric' % av.snclId)       
+                    logger.info('Skipping %s because channel not valid for "max_range" metric' % av.snclId)
+                    concierge.cache_result(cache_key, 'maxRange', pd.DataFrame())
+                    completed('maxRange', av.snclId, starttime)
                     
 
     # Concatenate and filter dataframes before returning -----------------------
@@ -250,6 +299,9 @@ def simple_metrics(concierge):
     if len(dataframes) == 0:
         logger.warning('"simple" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True)    
         mask = result.metricName.apply(valid_metric)
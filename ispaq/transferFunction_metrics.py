@@ -29,15 +29,17 @@ from rpy2.robjects.conversion import localconverter
 
 
 
-def transferFunction_metrics(concierge):
+def transferFunction_metrics(concierge, sink=None):
     """
     Generate *transfer* metrics.
     
     :type concierge: :class:`~ispaq.concierge.Concierge`
     :param concierge: Data access expiditer.
+    :type sink: :class:`~ispaq.metric_sink.MetricSink`
+    :param sink: Optional sink that writes the metrics as they are generated.
     
     :rtype: pandas dataframe
-    :return: Dataframe of simple metrics.
+    :return: Dataframe of simple metrics, or None if written to the sink.
     
     .. rubric:: Example
     
@@ -65,8 +67,9 @@ def transferFunction_metrics(concierge):
             logger.error("Could not connect to 'https:/service.earthscope.org/irisws/evalresp/1'") 
             return None
         
-    # Container for all of the metrics dataframes generated
-    dataframes = []
+    # Container for all of the metrics dataframes generated, or the sink that
+    # writes them as they are generated
+    dataframes = [] if sink is None else sink.start()
     
     # loop over days
     start = concierge.requested_starttime
@@ -593,6 +596,9 @@ def transferFunction_metrics(concierge):
     if len(dataframes) == 0:
         logger.warning('"transfer_function" metric calculation generated zero metrics')
         return None
+    elif sink is not None:
+        # Metrics have already been written by the sink
+        return None
     else:
         result = pd.concat(dataframes, ignore_index=True)
         result.reset_index(drop=True, inplace=True)
@@ -19,6 +19,12 @@ import rpy2.robjects as ro
 from rpy2.robjects.packages import importr
 from rpy2.robjects.conversion import localconverter
 
+# ISPAQ modules
+try:
+    import package_cache
+except:
+    from . import package_cache
+
 
 
 warnings.filterwarnings("ignore", category=RuntimeWarning)
@@ -42,6 +48,7 @@ _R_install_packages = ro.r('utils::install.packages')
 #IRIS_packages = ['seismicRoll','IRISSeismic','IRISMustangMetrics']
 
 def install_IRIS_packages(IRIS_packages,logger):
+    package_cache.clear()
     for package in IRIS_packages:
         try:
             _R_install_packages(package,repos="https://cloud.r-project.org")
@@ -49,22 +56,28 @@ def install_IRIS_packages(IRIS_packages,logger):
         except Exception as e:
             logger.error('Unable to install %s: %s' % (package,e))     
 
-def install_IRIS_packages_missing(IRIS_packages,logger):
-    # Get version information for locally installed and CRAN available IRIS_packages
-    
-    r_installed = ro.r("installed.packages()")
-    r_installed_names = r_installed.rownames
-    pandas2ri.activate()
-    installed_names = ro.conversion.rpy2py(r_installed_names).tolist()
+def missing_IRIS_packages(IRIS_packages):
+    """
+    Return the IRIS R packages that are not installed.
 
-    for package in IRIS_packages:
-        if package not in installed_names:
-            try:
-                _R_install_packages(package,repos="https://cloud.r-project.org")
-                logger.info('Installed %s' % (package))
-            except Exception as e:
-                logger.error('Unable to install %s: %s' % (package,e))
-    pandas2ri.deactivate()
+    Only the directories of these packages are looked up, which is much faster
+    than listing every installed package with installed.packages(). No R call is
+    needed while the packages match the package cache.
+    """
+    if set(IRIS_packages) <= set(package_cache.IRIS_packages) and package_cache.load() is not None:
+        return []
+    r_found = ro.r("function(packages) basename(find.package(packages, quiet=TRUE))")(ro.StrVector(IRIS_packages))
+    found = list(r_found)
+    return [package for package in IRIS_packages if package not in found]
+
+def install_IRIS_packages_missing(IRIS_packages,logger):
+    package_cache.clear()
+    for package in missing_IRIS_packages(IRIS_packages):
+        try:
+            _R_install_packages(package,repos="https://cloud.r-project.org")
+            logger.info('Installed %s' % (package))
+        except Exception as e:
+            logger.error('Unable to install %s: %s' % (package,e))
 
 
 def get_IRIS_package_versions(IRIS_packages,logger):
@@ -106,6 +119,7 @@ def update_IRIS_packages(IRIS_packages,logger):
     """
     Automatically upate IRIS R packages used in ISPAQ.    
     """
+    package_cache.clear()
     df = get_IRIS_package_versions(IRIS_packages,logger)
     packages_to_upgrade = df.package[df.upgrade].tolist()
     
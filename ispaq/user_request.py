@@ -102,10 +102,17 @@ class UserRequest(object):
                                 'csv_dir': '.',
                                 'psd_dir': '.',
                                 'sigfigs': 6,
-                                'sncl_format': 'N.S.L.C'}
+                                'sncl_format': 'N.S.L.C',
+                                'psd_format': 'csv'}
             self.pdf_preferences = {'pdf_type': 'plot, text',
                                     'pdf_interval': 'aggregated',
                                     'plot_include':'colorbar, legend'}
+            self.stored_psds = False
+            self.psd_format = 'csv'
+            self.resume = False
+            self.cache_dir = None
+            self.processes = 1
+            self.shard = None
 
         #     Initialize from JSON     ----------------------------------------
         
@@ -148,6 +155,48 @@ class UserRequest(object):
             if 'sds_files' in json_dict:
                 self.sds_files = json_dict['sds_files']
 
+            self.stored_psds = False
+            if 'stored_psds' in json_dict:
+                self.stored_psds = json_dict['stored_psds']
+
+            self.psd_format = 'csv'
+            if 'psd_format' in json_dict:
+                self.psd_format = json_dict['psd_format']
+
+            self.resume = False
+            if 'resume' in json_dict:
+                self.resume = json_dict['resume']
+
+            self.cache_dir = None
+            if 'cache_dir' in json_dict:
+                self.cache_dir = json_dict['cache_dir']
+
+            self.processes = 1
+            if 'processes' in json_dict:
+                self.processes = json_dict['processes']
+
+            self.shard = None
+            if 'shard' in json_dict:
+                self.shard = json_dict['shard']
+
+            # Output preferences, with the defaults of a missing preferences file
+            output_defaults = {'output': 'csv',
+                               'db_name': 'ispaq.db',
+                               'csv_dir': '.',
+                               'psd_dir': '.',
+                               'pdf_dir': '.',
+                               'pdf_type': 'plot, text',
+                               'pdf_interval': 'aggregated',
+                               'plot_include': 'legend, colorbar',
+                               'sigfigs': 6,
+                               'sncl_format': 'N.S.L.C',
+                               'sds_files': False}
+            for name in output_defaults:
+                if not hasattr(self, name):
+                    setattr(self, name, json_dict.get(name, output_defaults[name]))
+            for name in ('csv_dir', 'psd_dir', 'pdf_dir'):
+                setattr(self, name, os.path.abspath(os.path.expanduser(getattr(self, name))))
+
         #     Initialize from arguments       ---------------------------------
 
         else:
@@ -167,7 +216,13 @@ class UserRequest(object):
             self.csv_dir = args.csv_dir
             self.sncl_format = args.sncl_format
             self.sigfigs = args.sigfigs
+            self.psd_format = args.psd_format
+            self.cache_dir = args.cache_dir
             self.sds_files = args.sds_files
+            self.stored_psds = args.stored_psds
+            self.resume = args.resume
+            self.processes = args.processes
+            self.shard = args.shard
             
             self.pdf_type = args.pdf_type
             self.pdf_interval = args.pdf_interval
@@ -374,6 +429,34 @@ class UserRequest(object):
                 else:
                     self.sncl_format = "N.S.L.C"
 
+            if self.psd_format is None:
+                if 'psd_format' in preferences:
+                    self.psd_format = preferences['psd_format']
+                else:
+                    self.psd_format = 'csv'
+
+            if self.psd_format not in ['csv','npz']:
+                logger.critical('psd_format %s is not valid, options: csv, npz' % self.psd_format)
+                raise SystemExit
+
+            if self.cache_dir is None:
+                if 'cache_dir' in preferences and preferences['cache_dir'] is not None:
+                    self.cache_dir = os.path.abspath(os.path.expanduser(preferences['cache_dir']))
+            else:
+                self.cache_dir = os.path.abspath(os.path.expanduser(self.cache_dir))
+
+            try:
+                self.processes = int(self.processes)
+                if self.processes < 1:
+                    raise ValueError
+            except ValueError:
+                logger.critical('processes %s is not valid, must be a positive integer' % self.processes)
+                raise SystemExit
+
+            if self.shard is not None and self.shard not in ('day', 'week'):
+                logger.critical('shard %s is not valid, options: day, week' % self.shard)
+                raise SystemExit
+
             sncl_expr = re.compile('[SNCL]\.[SNCL]\.[SNCL]\.[SNCL]')
             if (not re.match(sncl_expr, self.sncl_format)):
                 logger.critical('sncl_format %s is not valid' % self.sncl_format)
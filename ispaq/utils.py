@@ -15,6 +15,7 @@ import pandas as pd
 import sqlite3
 from sqlite3 import Error
 import datetime
+import fnmatch
 
 from obspy import UTCDateTime
 
@@ -22,9 +23,11 @@ from obspy import UTCDateTime
 try:
     import irisseismic
     import evalresp as evresp
+    import database
 except:
     from . import irisseismic
     from . import evalresp as evresp
+    from . import database
 
 class EvalrespException(Exception):
     pass
@@ -32,271 +35,351 @@ class EvalrespException(Exception):
 
 # Utility functions ------------------------------------------------------------
 
-def initialize_general_database_table(dbname, tablename, concierge):
-    conn = sqlite3.connect(dbname)
-    create_table_sql = """ CREATE TABLE IF NOT EXISTS """ + tablename + """ (
-                            target text  NOT NULL,
-                            value float NOT NULL,
-                            start datetime  NOT NULL,
-                            end datetime NOT NULL,
-                            lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            UNIQUE(target, start, end)
-                        ); """
+# Power rounded to the nearest integer dB with ties to even, matching the rounding of PDF_aggregator.histogram_PSDs
+PSD_ROUND_POWER_SQL = """(CASE WHEN ABS(power - ROUND(power)) = 0.5 AND CAST(ROUND(power) AS INTEGER) % 2 != 0
+                            THEN CAST(ROUND(power) AS INTEGER) - (CASE WHEN power > 0 THEN 1 ELSE -1 END)
+                            ELSE CAST(ROUND(power) AS INTEGER) END)"""
+
+# File name endings of the corrected PSD files written by PSD_metrics
+PSD_SUFFIXES = ('PSDCorrected.csv','PSDCorrected.npz')
+
+def like_to_glob(sncl_pattern):
+    # Case sensitive GLOB patterns can use the target indexes, LIKE patterns cannot. SNCL
+    # codes are stored in upper case, so upper-casing keeps LIKE's case-insensitive matching.
+    return sncl_pattern.upper().replace('%','*').replace('_','?')
 
+def initialize_general_database_table(dbname, tablename, concierge):
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
+        database.get_writer(dbname).create_table(tablename, 'general')
     except Error as e:
         concierge.logger.error(e)
-    conn.close()
 
 def initialize_polcheck_database_table(dbname, concierge):
-    conn = sqlite3.connect(dbname)
-    create_table_sql = """ CREATE TABLE IF NOT EXISTS polarity_check (
-                            target text  NOT NULL,
-                            snclq2 text NOT NULL,
-                            value float NOT NULL,
-                            start datetime  NOT NULL,
-                            end datetime NOT NULL,
-                            lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            UNIQUE(target, start, end)
-                        ); """
-
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
+        database.get_writer(dbname).create_table('polarity_check')
     except Error as e:
         concierge.logger.error(e)
-    conn.close()
 
 def initialize_trfunc_database_table(dbname, concierge):
-    conn = sqlite3.connect(dbname)
-    create_table_sql = """ CREATE TABLE IF NOT EXISTS transfer_function (
-                            target text  NOT NULL,
-                            gain_ratio float NOT NULL,
-                            phase_diff float NOT NULL,
-                            ms_coherence float NOT NULL,
-                            start datetime  NOT NULL,
-                            end datetime NOT NULL,
-                            lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            UNIQUE(target, start, end)
-                        ); """
-
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
+        database.get_writer(dbname).create_table('transfer_function')
     except Error as e:
         concierge.logger.error(e)
-    conn.close()
     
 def initialize_orcheck_database_table(dbname, concierge):
-    conn = sqlite3.connect(dbname)
-    create_table_sql = """ CREATE TABLE IF NOT EXISTS orientation_check (
-                            target text  NOT NULL,
-                            azimuth_R float NOT NULL,
-                            backAzimuth float NOT NULL,
-                            azimuth_Y_obs float NOT NULL,
-                            azimuth_X_obs float NOT NULL,
-                            azimuth_Y_meta float NOT NULL,
-                            azimuth_X_meta float NOT NULL,
-                            max_Czr float NOT NULL,
-                            max_C_zr float NOT NULL,
-                            magnitude float NOT NULL,
-                            start datetime  NOT NULL,
-                            end datetime NOT NULL,
-                            lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            UNIQUE(target, start, end)
-                        ); """
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
+        database.get_writer(dbname).create_table('orientation_check')
     except Error as e:
         concierge.logger.error(e)
-    conn.close()
    
 def initialize_psd_database_table(dbname, concierge):
-    conn = sqlite3.connect(dbname)
-    create_table_sql = """ CREATE TABLE IF NOT EXISTS psd_corrected (
-                            target text  NOT NULL,
-                            frequency float NOT NULL,
-                            power float NOT NULL,
-                            start datetime  NOT NULL,
-                            end datetime NOT NULL,
-                            lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            UNIQUE(target, frequency, start)
-                        ); """
-
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
+        database.get_writer(dbname).create_table('psd_corrected')
     except Error as e:
         concierge.logger.error(e)
-    conn.close()
     
 def initialize_pdf_database_table(dbname, concierge):
-    conn = sqlite3.connect(dbname)
-    create_table_sql = """ CREATE TABLE IF NOT EXISTS pdf (
-                            target text  NOT NULL,
-                            frequency float NOT NULL,
-                            power float NOT NULL,
-                            hits float NOT NULL,
-                            start datetime  NOT NULL,
-                            end datetime NOT NULL,
-                            lddate datetime DATETIME DEFAULT CURRENT_TIMESTAMP,
-                            UNIQUE(target, frequency, power, start, end)
-                        ); """
+    try:
+        database.get_writer(dbname).create_table('pdf')
+    except Error as e:
+        concierge.logger.error(e)
 
+def initialize_psd_histogram_database_table(dbname, concierge):
     try:
-        c = conn.cursor()
-        c.execute(create_table_sql)
+        database.get_writer(dbname).create_table('psd_histogram')
     except Error as e:
         concierge.logger.error(e)
-    conn.close()
 
 
 def insert_general_database_table(dbname, tablename, row):
-    conn = sqlite3.connect(dbname)
-    insert_sql = f'''INSERT INTO {tablename} (target, value, start, end)
-  VALUES (?, ?, ?, ?) 
-  ON CONFLICT(target, start, end) 
-  DO UPDATE SET value=excluded.value, lddate=excluded.lddate;
-  '''
-
-    newRow = (row['target'], row['value'], row['start'],  row['end']);
-    
-    cur = conn.cursor()
-    try:
-        cur.execute(insert_sql, newRow)
-    except:
-        insert_sql = "INSERT or REPLACE INTO "  + tablename + " (target, value, start, end) VALUES (?, ?, ?, ?)"
-        cur.execute(insert_sql, newRow)
-             
-    conn.commit()
-    conn.close()
+    newRow = (row['target'], row['value'], row['start'], row['end'])
+    database.get_writer(dbname).upsert(tablename, [newRow], 'general')
 
 def insert_polcheck_database_table(dbname, row):
-    conn = sqlite3.connect(dbname)
-    insert_sql = f'''INSERT INTO polarity_check (target, snclq2, value, start, end)
-  VALUES (?, ?, ?, ?, ?) 
-  ON CONFLICT(target, start, end) 
-  DO UPDATE SET snclq2=excluded.snclq2, value=excluded.value, lddate=excluded.lddate;
-  '''
-    newRow = (row['target'], row['snclq2'], row['value'], row['start'],  row['end']);
-    
-    cur = conn.cursor()
-    try:
-        cur.execute(insert_sql, newRow)
-    except:
-        insert_sql = "INSERT or REPLACE INTO polarity_check (target, snclq2, value, start, end) VALUES (?, ?, ?, ?, ?)"
-        cur.execute(insert_sql, newRow)
-    conn.commit()
-    conn.close()
+    newRow = (row['target'], row['snclq2'], row['value'], row['start'], row['end'])
+    database.get_writer(dbname).upsert('polarity_check', [newRow])
     
 def insert_trfunc_database_table(dbname, row):
-    conn = sqlite3.connect(dbname)
-    insert_sql = f'''INSERT INTO transfer_function (target, gain_ratio, phase_diff, ms_coherence, start, end)
-  VALUES (?, ?, ?, ?, ?, ?) 
-  ON CONFLICT(target, start, end) 
-  DO UPDATE SET gain_ratio=excluded.gain_ratio, phase_diff=excluded.phase_diff, ms_coherence=excluded.ms_coherence, lddate=excluded.lddate;
-  '''
-    newRow = (row['target'], row['gain_ratio'], row['phase_diff'], row['ms_coherence'], row['start'],  row['end']);
-    
-    cur = conn.cursor()
-    try:
-        cur.execute(insert_sql, newRow)
-    except:
-        insert_sql = "INSERT or REPLACE INTO transfer_function (target, gain_ratio, phase_diff, ms_coherence, start, end) VALUES (?, ?, ?, ?, ?, ?)"
-        cur.execute(insert_sql, newRow)
-    conn.commit()
-    conn.close()
+    newRow = (row['target'], row['gain_ratio'], row['phase_diff'], row['ms_coherence'], row['start'], row['end'])
+    database.get_writer(dbname).upsert('transfer_function', [newRow])
     
 def insert_orcheck_database_table(dbname, row):
-    conn = sqlite3.connect(dbname)
-    insert_sql = f'''INSERT INTO orientation_check (target, azimuth_R, backAzimuth, azimuth_Y_obs, azimuth_X_obs, azimuth_Y_meta,
-                     azimuth_X_meta, max_Czr, max_C_zr, magnitude, start, end)
-  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) 
-  ON CONFLICT(target, start, end) 
-  DO UPDATE SET azimuth_R=excluded.azimuth_R, backAzimuth=excluded.backAzimuth, azimuth_Y_obs=excluded.azimuth_Y_obs,
-  azimuth_X_obs=excluded.azimuth_X_obs, azimuth_X_meta=excluded.azimuth_X_meta, max_Czr=excluded.max_Czr, max_C_zr=excluded.max_C_zr,
-  magnitude=excluded.magnitude, lddate=excluded.lddate;
-  '''
-    newRow = (row['target'], row['azimuth_R'], row['backAzimuth'], row['azimuth_Y_obs'], row['azimuth_X_obs'], row['azimuth_Y_meta'], row['azimuth_X_meta'], row['max_Czr'], row['max_C_zr'], row['magnitude'], row['start'], row['end'])
-    
-    cur = conn.cursor()
-    try:
-        cur.execute(insert_sql, newRow)
-    except:
-        insert_sql = """INSERT or REPLACE INTO orientation_check (target, azimuth_R, backAzimuth, azimuth_Y_obs, azimuth_X_obs, azimuth_Y_meta,
-                     azimuth_X_meta, max_Czr, max_C_zr, magnitude, start, end) 
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-        cur.execute(insert_sql, newRow)
-    conn.commit()
-    conn.close()
+    newRow = (row['target'], row['azimuth_R'], row['backAzimuth'], row['azimuth_Y_obs'], row['azimuth_X_obs'], row['azimuth_Y_meta'],
+              row['azimuth_X_meta'], row['max_Czr'], row['max_C_zr'], row['magnitude'], row['start'], row['end'])
+    database.get_writer(dbname).upsert('orientation_check', [newRow])
        
 def insert_psd_database_table(dbname, row):
-    conn = sqlite3.connect(dbname)
-    insert_sql = f'''INSERT INTO psd_corrected (target, frequency, power, start, end)
-  VALUES (?, ?, ?, ?, ?) 
-  ON CONFLICT(target, frequency, start, end) 
-  DO UPDATE SET power=excluded.power, lddate=excluded.lddate;
-  '''
-    newRow = (row['target'], row['frequency'], row['power'], row['starttime'],  row['endtime']);
-
-    cur = conn.cursor()
-    
-    try:
-        cur.execute(insert_sql, newRow)
-        
-    except:
-        insert_sql = "INSERT or REPLACE INTO psd_corrected (target, frequency, power, start, end) VALUES (?, ?, ?, ?, ?)"
-        cur.execute(insert_sql, newRow)
-    conn.commit()
-    conn.close()
+    newRow = (row['target'], row['frequency'], row['power'], row['starttime'], row['endtime'])
+    database.get_writer(dbname).upsert('psd_corrected', [newRow])
  
 def insert_pdf_database_table(dbname, row, target, starttime, endtime):
-    conn = sqlite3.connect(dbname)
-    insert_sql = f'''INSERT INTO pdf (target, frequency, power, hits, start, end)
-  VALUES (?, ?, ?, ?, ?,?) 
-  ON CONFLICT(target, frequency, power, start, end) 
-  DO UPDATE SET hits=excluded.hits, lddate=excluded.lddate;
-  '''
-    newRow = (target, row['frequency'],row['power'], row['hits'], starttime, endtime)
-     
-    cur = conn.cursor()
-    try:
-        cur.execute(insert_sql, newRow)
-    except:
-        insert_sql = "INSERT or REPLACE INTO pdf (target, frequency, power, hits, start, end) VALUES (?, ?, ?, ?, ?, ?)"
-        cur.execute(insert_sql, newRow)
-    conn.commit()
-    conn.close()
-     
+    newRow = (target, row['frequency'], row['power'], row['hits'], starttime, endtime)
+    database.get_writer(dbname).upsert('pdf', [newRow])
+
+def insert_psd_histogram_database_table(dbname, target, day, df):
+    # A day's histogram is always replaced as a whole
+    rows = zip(df['frequency'].tolist(), df['power'].tolist(), df['hits'].tolist())
+    database.get_writer(dbname).replace_psd_histogram(target, day, rows)
 
- 
 def retrieve_psd_unique_targets(dbname, sncl_pattern, starttime, endtime, logger):
 
+    database.sync(dbname)    # rows may still be queued for the writer process
     conn = sqlite3.connect(dbname)
-    select_sql = "SELECT DISTINCT target from psd_corrected WHERE target like '" + sncl_pattern +"'"
+    select_sql = "SELECT DISTINCT target FROM psd_corrected WHERE target GLOB ?"
+    params = [like_to_glob(sncl_pattern)]
     if not starttime == "":
-        select_sql = select_sql + " AND start >= '" + str(starttime).split('.')[0] + "'"
+        select_sql = select_sql + " AND start >= ?"
+        params.append(str(starttime).split('.')[0])
     if not endtime == "":
-        select_sql = select_sql + " AND end <= '" + str(endtime).split('.')[0] + "'"
-        
+        select_sql = select_sql + " AND end <= ?"
+        params.append(str(endtime).split('.')[0])
+
     select_sql = select_sql + ";"
-    
-    cur = conn.cursor()
-    cur.execute(select_sql)
-    records = [ str(i).strip('()').strip(',').strip("'") for i in cur.fetchall()]
-    
+
+    try:
+        cur = conn.cursor()
+        cur.execute(select_sql, params)
+        records = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
     return records
-    
-def write_simple_df(df, filepath, concierge, sigfigs=6):
+
+def retrieve_psd_histogram_from_psds(dbname, target, starttime, endtime):
+    """
+    Count the PSD values of one target in frequency and power bins inside SQLite.
+    :param dbname: SQLite database file.
+    :param target: SNCLQ of the PSDs.
+    :param starttime: Only include PSDs starting at or after this time.
+    :param endtime: Only include PSDs starting before this time.
+    :return: Dataframe with columns frequency, power, hits
+    """
+    database.sync(dbname)    # rows may still be queued for the writer process
+    conn = sqlite3.connect(dbname)
+    select_sql = f"""SELECT frequency, {PSD_ROUND_POWER_SQL} AS power, COUNT(*) AS hits FROM psd_corrected
+                     WHERE target = ? AND start >= ? AND start < ? AND power != 'nan'
+                     GROUP BY frequency, {PSD_ROUND_POWER_SQL};"""
+    params = (target, str(starttime).split('.')[0], str(endtime).split('.')[0])
+    try:
+        hist = pd.read_sql_query(select_sql, conn, params=params)
+    finally:
+        conn.close()
+
+    return hist
+
+def retrieve_psds(dbname, sncl_pattern, starttime, endtime):
+    """
+    Read corrected PSDs from the psd_corrected table into a dataframe.
+    :param dbname: SQLite database file.
+    :param sncl_pattern: SQL 'LIKE' pattern for the target.
+    :param starttime: Only include PSDs starting at or after this time.
+    :param endtime: Only include PSDs starting before this time.
+    :return: Dataframe with columns target, starttime, endtime, frequency, power
+    """
+    database.sync(dbname)    # rows may still be queued for the writer process
+    conn = sqlite3.connect(dbname)
+    select_sql = """SELECT target, start AS starttime, end AS endtime, frequency, power FROM psd_corrected
+                    WHERE target GLOB ? AND start >= ? AND start < ? AND power != 'nan';"""
+    params = (like_to_glob(sncl_pattern), str(starttime).split('.')[0], str(endtime).split('.')[0])
+    try:
+        psd = pd.read_sql_query(select_sql, conn, params=params, parse_dates=['starttime','endtime'])
+    finally:
+        conn.close()
+
+    return psd
+
+def retrieve_psd_histograms(dbname, target, startday, endday):
+    """
+    Read stored daily PSD histograms from the psd_histogram table.
+    :param dbname: SQLite database file.
+    :param target: SNCLQ of the histograms.
+    :param startday: First day, formatted as YYYY-MM-DD.
+    :param endday: Last day, formatted as YYYY-MM-DD.
+    :return: Dataframe with columns day, frequency, power, hits
+    """
+    database.sync(dbname)    # rows may still be queued for the writer process
+    conn = sqlite3.connect(dbname)
+    select_sql = "SELECT day, frequency, power, hits FROM psd_histogram WHERE target = ? AND day >= ? AND day <= ?;"
+    try:
+        hist = pd.read_sql_query(select_sql, conn, params=(target, str(startday), str(endday)))
+    finally:
+        conn.close()
+
+    return hist
+
+def retrieve_psd_histogram_unique_targets(dbname, sncl_pattern, startday, endday):
+    """
+    List the targets with stored daily PSD histograms.
+    :param dbname: SQLite database file.
+    :param sncl_pattern: SQL 'LIKE' pattern for the target.
+    :param startday: First day, formatted as YYYY-MM-DD.
+    :param endday: Last day, formatted as YYYY-MM-DD.
+    :return: List of targets
+    """
+    database.sync(dbname)    # rows may still be queued for the writer process
+    conn = sqlite3.connect(dbname)
+    select_sql = "SELECT DISTINCT target FROM psd_histogram WHERE target GLOB ? AND day >= ? AND day <= ?;"
+    try:
+        cur = conn.cursor()
+        cur.execute(select_sql, (like_to_glob(sncl_pattern), str(startday), str(endday)))
+        records = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+    return records
+
+def find_psd_files(psd_dir, sncl_pattern, days, suffixes=PSD_SUFFIXES):
+    """
+    Find corrected PSD files in psd_dir.
+    :param psd_dir: Directory to search, including subdirectories.
+    :param sncl_pattern: One or more comma-separated SNCL[Q] patterns, wildcards allowed.
+    :param days: List of days formatted as YYYY-MM-DD.
+    :param suffixes: File name endings to look for, e.g. 'PSDCorrected.csv', 'PSDCorrected.npz'
+        or 'PSDHistogram.csv'.
+    :return: List of matching file paths.
+    """
+    fnames = [sncl_pat + "_" + str(day) + "_" + suffix for day in days for sncl_pat in sncl_pattern.split(',') for suffix in suffixes]
+    files = []
+    for root, dirnames, filenames in os.walk(psd_dir):
+        for fname in fnames:
+            for filename in fnmatch.filter(filenames, fname):
+                files.append(os.path.join(root, filename))
+
+    return files
+
+def read_psd_files(files):
+    """
+    Read corrected PSD .csv or .npz files into a single dataframe.
+    :param files: List of files written by PSD_metrics.
+    :return: Dataframe with columns target, starttime, endtime, frequency, power
+    """
+    def read_psd_file(psdFile):
+        if psdFile.endswith('.npz'):
+            return read_psd_npz(psdFile)
+        return pd.read_csv(psdFile, parse_dates=['starttime','endtime'])
+
+    return pd.concat((read_psd_file(psdFile) for psdFile in files), ignore_index=True)
+
+def prefer_psd_files(files):
+    """
+    Drop .csv PSD files that have a .npz counterpart for the same SNCL[Q] and day.
+    :param files: List of corrected PSD files.
+    :return: List of files with at most one file per SNCL[Q] and day.
+    """
+    npz = set(f[:-len('.npz')] for f in files if f.endswith('.npz'))
+    return [f for f in files if not (f.endswith('.csv') and f[:-len('.csv')] in npz)]
+
+def write_psd_npz(df, filepath, sigfigs=6):
+    """
+    Write corrected PSDs for one SNCL[Q] to a binary .npz file.
+    :param df: PSD dataframe with columns target, starttime, endtime, frequency, power.
+    :param filepath: File to be created, ending in .npz.
+    :param sigfigs: Number of significant figures to use.
+    :return: status
+
+    The file holds a single frequency axis shared by all PSD segments and a
+    segment x frequency matrix of power values, NaN where a segment has no value
+    at that frequency. Times are stored as whole seconds, as in the .csv files.
+    """
+    # Same values as written to the .csv files
+    pretty_df = format_numeric_df(df[['starttime','endtime','frequency','power']].copy(), sigfigs=sigfigs)
+    starttime = pretty_df['starttime'].values.astype('datetime64[s]').astype(np.int64)
+    endtime = pretty_df['endtime'].values.astype('datetime64[s]').astype(np.int64)
+
+    frequency, col = np.unique(pretty_df['frequency'].astype(float).values, return_inverse=True)
+    segments, row = np.unique(np.stack([starttime, endtime], axis=1), axis=0, return_inverse=True)
+
+    power = np.full((segments.shape[0], frequency.shape[0]), np.nan)
+    power[row.ravel(), col.ravel()] = pretty_df['power'].astype(float).values
+
+    np.savez(filepath,
+             target=np.array(df['target'].iloc[0]),
+             frequency=frequency,
+             starttime=segments[:,0].astype('datetime64[s]'),
+             endtime=segments[:,1].astype('datetime64[s]'),
+             power=power)
+    # No return value
+
+def read_psd_npz(filepath):
+    """
+    Read a corrected PSD .npz file written by write_psd_npz().
+    :param filepath: File to read.
+    :return: Dataframe with columns target, starttime, endtime, frequency, power
+    """
+    with np.load(filepath) as npz:
+        power = npz['power']
+        row, col = np.nonzero(~np.isnan(power))
+        df = pd.DataFrame({'target': str(npz['target']),
+                           'starttime': npz['starttime'][row].astype('datetime64[ns]'),
+                           'endtime': npz['endtime'][row].astype('datetime64[ns]'),
+                           'frequency': npz['frequency'][col],
+                           'power': power[row, col]})
+    return df
+
+def select_metrics(df, metric_names):
+    """
+    Keep only the requested metrics.
+    :param df: Dataframe of metrics with a metricName column.
+    :param metric_names: List of requested metric names.
+    :return: Dataframe of the requested metrics.
+    """
+    df = df[df.metricName.isin(metric_names)]
+    return df.reset_index(drop=True)
+
+def sncl_targets(targets):
+    """
+    Remove the quality code from SNCLQ targets.
+    :param targets: Iterable of targets such as 'IU.ANMO.00.BHZ.M' or, for metrics
+        of two channels, 'IU.ANMO.00.BHZ.M:IU.ANMO.10.BHZ.M'.
+    :return: List of targets such as 'IU.ANMO.00.BHZ'.
+    """
+    def strip(target):
+        return ':'.join('.'.join(part.split('.')[:4]) for part in str(target).split(':'))
+
+    targets = list(targets)
+    stripped = dict((target, strip(target)) for target in set(targets))
+    return [stripped[target] for target in targets]
+
+def retrieve_completed_files(csv_dir, psd_dir):
+    """
+    List the metrics already written to .csv files by previous runs.
+    :param csv_dir: Directory with *Metrics.csv files.
+    :param psd_dir: Directory with corrected PSD files, including subdirectories.
+    :return: Set of (metricName, SNCL, start, end) tuples, times formatted as YYYY-MM-DDTHH:MM:SS.
+
+    Corrected PSD and PSD histogram files are listed as metrics 'psd_corrected' and 'pdf'
+    starting at midnight of their day, with end None.
+    """
+    completed = set()
+    for filename in sorted(fnmatch.filter(os.listdir(csv_dir), '*Metrics.csv')):
+        try:
+            df = pd.read_csv(os.path.join(csv_dir, filename), usecols=['target','start','end','metricName'],
+                             dtype=str, keep_default_na=False)
+        except (ValueError, pd.errors.EmptyDataError):
+            continue    # not a metrics file
+        completed.update(zip(df.metricName, sncl_targets(df.target), df.start, df.end))
+
+    for root, dirnames, filenames in os.walk(psd_dir):
+        for (metric, suffix) in [('psd_corrected', suffix) for suffix in PSD_SUFFIXES] + [('pdf', 'PSDHistogram.csv')]:
+            for filename in fnmatch.filter(filenames, '*_' + suffix):
+                # <target>_<YYYY-MM-DD>_<suffix>
+                target, day = filename[:-len(suffix)-1].rsplit('_', 1)
+                completed.add((metric, sncl_targets([target])[0], day + 'T00:00:00', None))
+
+    return completed
+
+def write_simple_df(df, filepath, concierge, sigfigs=6, append=False, columns=None):
     """
     Write a pretty dataframe with appropriate significant figures to a .csv file.
     :param df: Dataframe of simpleMetrics.
     :param filepath: File to be created.
     :param sigfigs: Number of significant figures to use.
-    :return: status
+    :param append: Append to a .csv file previously written by this function.
+    :param columns: Columns of the file being appended to.
+    :return: List of the .csv columns
+
+    When appending, rows are written in the existing column order. If the new rows
+    have columns the file does not, the file is rewritten with the combined columns.
     """
     
     output = concierge.output
@@ -305,48 +388,166 @@ def write_simple_df(df, filepath, concierge, sigfigs=6):
     
     if df is None:
         raise("Dataframe of simple metrics does not exist.")
-    # Sometimes 'starttime' and 'endtime' get converted from UTCDateTime to float and need to be
-    # converted back. Nothing happens if this column is already of type UTCDateTime.
-    df.starttime = df.starttime.apply(UTCDateTime, precision=0) # no milliseconds
-    df.endtime = df.endtime.apply(UTCDateTime, precision=0) # no milliseconds
-    df = df.replace('NULL',np.nan)
+    # Sometimes 'starttime' and 'endtime' get converted from UTCDateTime to float, format_times()
+    # accepts either. They are left out of the 'NULL' replacement, which would compare every UTCDateTime.
+    valueColumns = [column for column in df.columns if column not in ('starttime','endtime')]
+    df[valueColumns] = df[valueColumns].replace('NULL',np.nan)
     #df.loc[~df['metricName'].str.match('timing_quality') & df['value'].str.match('NULL'),'value'] = np.nan
 
     # Get pretty values
     pretty_df = format_simple_df(df, sigfigs=sigfigs)
     pretty_df = pretty_df.rename(index=str,columns={'snclq':'target','starttime':'start','endtime':'end'})
     # Reorder columns, putting non-standard columns at the end and omitting 'qualityFlag'
-    columns = ['target','start','end','metricName']
+    standard_columns = ['target','start','end','metricName']
     original_columns = pretty_df.columns
-    extra_columns = sorted(list( set(original_columns).difference(set(columns)) ))
+    extra_columns = sorted(list( set(original_columns).difference(set(standard_columns)) ))
     extra_columns.remove('qualityFlag')
 #     if "time" in extra_columns:
 #         extra_columns.remove('time')
 
-    columns.extend(extra_columns)
-    
     pretty_df.drop_duplicates(inplace=True)
     
     # Write out to database or .csv file
     if output == 'csv':
-        pretty_df[columns].to_csv(filepath, index=False)
+        if not append:
+            columns = standard_columns + extra_columns
+            pretty_df[columns].to_csv(filepath, index=False)
+        elif set(extra_columns).issubset(columns):
+            pretty_df.reindex(columns=columns).to_csv(filepath, mode='a', header=False, index=False)
+        else:
+            existing_df = pd.read_csv(filepath, dtype=str, keep_default_na=False)
+            columns = standard_columns + sorted(set(columns[len(standard_columns):]).union(extra_columns))
+            pd.concat([existing_df, pretty_df], ignore_index=True).reindex(columns=columns).to_csv(filepath, index=False)
     elif output == 'db':
-        for a,row in pretty_df.iterrows():
-            tablename = row['metricName']
-
-            if tablename == 'transfer_function':
-                initialize_trfunc_database_table(dbname, concierge)
-                insert_trfunc_database_table(dbname, row)
-            elif tablename == 'orientation_check':
-                initialize_orcheck_database_table(dbname, concierge)
-                insert_orcheck_database_table(dbname, row)
-            elif tablename == 'polarity_check':
-                initialize_polcheck_database_table(dbname, concierge)
-                insert_polcheck_database_table(dbname, row)
-            else:
-                initialize_general_database_table(dbname, tablename, concierge)
-                insert_general_database_table(dbname, tablename, row)
-    # No return value
+        # One table per metric, all written in a single transaction
+        writer = database.get_writer(dbname)
+        with writer.transaction():
+            for tablename, metricDF in pretty_df.groupby('metricName', sort=False):
+                names = [name for (name, type) in database.TABLES[database.table_kind(tablename)]['columns']]
+                writer.upsert(tablename, metricDF[names].itertuples(index=False, name=None))
+
+    return columns
+
+def format_sigfigs(values, sigfigs=6):
+    """
+    Format numbers with the given number of significant figures.
+    :param values: Array or Series of floats.
+    :param sigfigs: Number of significant figures to use.
+    :return: Numpy array of strings, identical to format(x, '.<sigfigs>g') for each value.
+
+    The values are rounded to integer mantissas and decimal exponents in NumPy and
+    the '%g' strings are assembled as character matrices, without a Python format per
+    value. Zeros, NaN, infinities, values with extreme exponents and values too close
+    to a rounding tie to round reliably in floating point are formatted one by one.
+    """
+    values = np.ascontiguousarray(values, dtype=np.float64).ravel()
+    formatted = np.empty(len(values), dtype=object)
+    s = int(sigfigs)
+
+    magnitude = np.abs(values)
+    regular = np.isfinite(values) & (magnitude > 1e-300) & (magnitude < 1e300)
+    if not 1 <= s <= 15:
+        regular[:] = False
+    rows = np.flatnonzero(regular)
+    a = magnitude[rows]
+
+    # Decimal exponent of each value rounded to s digits. log10 can be off by one
+    # next to powers of ten and rounding can carry into an extra digit.
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        exponent = np.floor(np.log10(a)).astype(np.int64)
+        scaled = a * 10.0 ** (s - 1 - exponent)
+        tie = np.zeros(len(rows), dtype=bool)
+        for _ in range(2):
+            tie |= np.abs(scaled - np.floor(scaled) - 0.5) <= 1e-14 * scaled
+            mantissa = np.rint(scaled)
+            adjust = (mantissa >= 10 ** s).astype(np.int64) - (mantissa < 10 ** (s - 1)).astype(np.int64)
+            if not adjust.any():
+                break
+            exponent += adjust
+            scaled = a * 10.0 ** (s - 1 - exponent)
+        mantissa = np.rint(scaled)
+        tie |= np.abs(scaled - np.floor(scaled) - 0.5) <= 1e-14 * scaled
+
+    # Values whose rounding cannot be decided in floating point are formatted exactly
+    exact = tie | ~(mantissa < 10 ** s) | (mantissa < 10 ** (s - 1))
+    regular[rows[exact]] = False
+    keep = ~exact
+    (rows, exponent, mantissa) = (rows[keep], exponent[keep], mantissa[keep].astype(np.int64))
+
+    format_string = "%." + str(s) + "g"
+    formatted[~regular] = [format_string % x for x in values[~regular].tolist()]
+    if len(rows) == 0:
+        return formatted
+
+    # Digits of the mantissas and the number left after dropping trailing zeros
+    digits = (mantissa[:, None] // 10 ** np.arange(s - 1, -1, -1, dtype=np.int64)) % 10
+    ndigits = s - np.argmax(digits[:, ::-1] != 0, axis=1)
+    digits = (digits + ord('0')).astype(np.uint32)
+    negative = values[rows] < 0
+
+    # Values with the same sign, exponent and number of digits share one layout,
+    # e.g. all PSD powers like -123.45, and are assembled together
+    width = s + 8
+    chars = np.zeros((len(rows), width), dtype=np.uint32)
+    layout = ((exponent - exponent.min()) * (s + 1) + ndigits) * 2 + negative
+    (layouts, first, inverse) = np.unique(layout, return_index=True, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind='stable')
+    bounds = np.cumsum(np.bincount(inverse.ravel(), minlength=len(layouts)))[:-1]
+    for (index, group) in zip(first, np.split(order, bounds)):
+        template = _sigfigs_template(int(exponent[index]), int(ndigits[index]), bool(negative[index]), s)
+        source = np.array([c if isinstance(c, int) else 0 for c in template], dtype=np.intp)
+        literal = np.array([isinstance(c, str) for c in template])
+        group_chars = digits[group][:, source]
+        group_chars[:, literal] = [ord(c) for c in template if isinstance(c, str)]
+        chars[group, :len(template)] = group_chars
+
+    formatted[rows] = chars.view('U%d' % width).ravel().astype(object)
+    return formatted
+
+def _sigfigs_template(exponent, ndigits, negative, sigfigs):
+    """
+    Return the '%g' layout of a number as a list of digit positions and literal characters.
+    :param exponent: Decimal exponent of the rounded number.
+    :param ndigits: Number of significant digits left after dropping trailing zeros.
+    :param negative: True for negative numbers.
+    :param sigfigs: Number of significant figures.
+    :return: List of ints, positions in the mantissa digits, and single character strings.
+    """
+    template = ['-'] if negative else []
+    if -4 <= exponent < sigfigs:
+        if exponent >= 0:
+            # e.g. 123.45
+            template += list(range(exponent + 1))
+            if ndigits > exponent + 1:
+                template += ['.'] + list(range(exponent + 1, ndigits))
+        else:
+            # e.g. 0.0012345
+            template += ['0', '.'] + ['0'] * (-exponent - 1) + list(range(ndigits))
+    else:
+        # e.g. 1.2345e-05
+        template += [0]
+        if ndigits > 1:
+            template += ['.'] + list(range(1, ndigits))
+        template += list('e%+03d' % exponent)
+    return template
+
+def format_times(values):
+    """
+    Format times as YYYY-MM-DDTHH:MM:SS.
+    :param values: Array or Series of datetime64, UTCDateTime or anything UTCDateTime accepts.
+    :return: Numpy array of strings.
+
+    Times are rounded to the nearest second, ties to even, as UTCDateTime(x, precision=0)
+    does before strftime().
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        ns = values.astype('datetime64[ns]').astype(np.int64)
+    else:
+        ns = np.array([x.ns if isinstance(x, UTCDateTime) else UTCDateTime(x).ns for x in values], dtype=np.int64)
+    seconds, remainder = np.divmod(ns, 10**9)
+    seconds += (remainder > 5 * 10**8) | ((remainder == 5 * 10**8) & (seconds % 2 == 1))
+    return np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s').astype(object)
 
 def format_simple_df(df, sigfigs=6):
     """
@@ -363,17 +564,13 @@ def format_simple_df(df, sigfigs=6):
     
     if 'value' in df.columns:
         # convert values to float
-        df.value = df.value.astype(float)
-        format_string = "." + str(sigfigs) + "g"
-        df.value = df.value.apply(lambda x: format(x, format_string))
+        df.value = format_sigfigs(df.value.astype(float), sigfigs)
         df.value = df.value.astype(str)
         df.loc[df['metricName'].str.match('timing_quality') & df['value'].str.match('nan'),'value'] = 'NULL'
     if 'starttime' in df.columns:
-        df.starttime = df.starttime.apply(UTCDateTime, precision=0) # no milliseconds
-        df.starttime = df.starttime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+        df.starttime = format_times(df.starttime) # no milliseconds
     if 'endtime' in df.columns:
-        df.endtime = df.endtime.apply(UTCDateTime, precision=0) # no milliseconds
-        df.endtime = df.endtime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+        df.endtime = format_times(df.endtime) # no milliseconds
     if 'qualityFlag' in df.columns:
         
         df.qualityFlag = df.qualityFlag.astype(int)
@@ -399,10 +596,8 @@ def write_numeric_df(df, filepath, concierge, sigfigs=6):
     if output == 'csv':
         pretty_df.to_csv(filepath, index=False)
     elif output == 'db':
-
-        initialize_psd_database_table(dbname, concierge)
-        for ind,row in pretty_df.iterrows():
-            insert_psd_database_table(dbname, row)
+        rows = pretty_df[['target','frequency','power','starttime','endtime']].itertuples(index=False, name=None)
+        database.get_writer(dbname).upsert('psd_corrected', rows)
     # No return value
 
 def write_pdf_df(df, filepath, iappend, sncl, starttime, endtime, concierge, sigfigs=6):
@@ -428,9 +623,9 @@ def write_pdf_df(df, filepath, iappend, sncl, starttime, endtime, concierge, sig
         else:
             pretty_df.to_csv(filepath, index=False)
     elif output == 'db':
-        initialize_pdf_database_table(dbname, concierge)
-        for ind,row in pretty_df.iterrows():
-            insert_pdf_database_table(dbname, row, sncl, str(starttime), str(endtime))
+        rows = ((sncl, frequency, power, hits, str(starttime), str(endtime))
+                for (frequency, power, hits) in pretty_df[['frequency','power','hits']].itertuples(index=False, name=None))
+        database.get_writer(dbname).upsert('pdf', rows)
     # No return value
 
 def format_numeric_df(df, sigfigs=6):
@@ -446,19 +641,15 @@ def format_numeric_df(df, sigfigs=6):
     * Convert 'starttime' and 'endtime' to python 'date' objects.
     """
 
-    format_string = "." + str(sigfigs) + "g"
     for column in df.columns:
         if column == 'starttime':
-            df.starttime = df.starttime.apply(UTCDateTime, precision=0) # no milliseconds
-            df.starttime = df.starttime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+            df.starttime = format_times(df.starttime) # no milliseconds
         elif column == 'endtime':
-            df.endtime = df.endtime.apply(UTCDateTime, precision=0) # no milliseconds
-            df.endtime = df.endtime.apply(lambda x: x.strftime("%Y-%m-%dT%H:%M:%S"))
+            df.endtime = format_times(df.endtime) # no milliseconds
         elif column == 'target':
             pass # 'target' is the SNCL Id
         else:
-            df[column] = df[column].astype(float)
-            df[column] = df[column].apply(lambda x: format(x, format_string))
+            df[column] = format_sigfigs(df[column].astype(float), sigfigs)
             df[column] = df[column].astype(str)
             
     return df   
@@ -630,6 +821,12 @@ def getSpectra(st, sampling_rate, metric, concierge):
     location = get_slot(st,'location')
     channel = get_slot(st,'channel')
     starttime = get_slot(st,'starttime')
+
+    # Responses of earlier requests with the same source are reused
+    response_key = (metric, concierge.resp_dir, concierge.station_url, network, station, location, channel,
+                    str(starttime), minfreq, maxfreq, nfreq)
+    if concierge.response_cache is not None and response_key in concierge.response_cache:
+        return concierge.response_cache[response_key].copy()
   
     # REC - invoke evalresp either programmatically from a RESP file or by invoking the web service 
 
@@ -670,6 +867,8 @@ def getSpectra(st, sampling_rate, metric, concierge):
                                        minfreq=minfreq, maxfreq=maxfreq, nfreq=nfreq, units=units.lower(), output=output.lower())
         except Exception as e:
             raise
+    if concierge.response_cache is not None:
+        concierge.response_cache[response_key] = evalResp.copy()
     return(evalResp)
 
 def getSampleRateSpectra(r_stream,sampling_rate,norm_freq, concierge):
@@ -693,6 +892,12 @@ def getSampleRateSpectra(r_stream,sampling_rate,norm_freq, concierge):
     channel = get_slot(r_stream,'channel')
     starttime = get_slot(r_stream,'starttime')
 
+    # Responses of earlier requests with the same source are reused
+    response_key = ('sampleRate', concierge.resp_dir, concierge.dataselect_url, network, station, location, channel,
+                    str(starttime), minfreq, maxfreq, nfreq)
+    if concierge.response_cache is not None and response_key in concierge.response_cache:
+        return concierge.response_cache[response_key].copy()
+
     evalResp = None
     respDir = concierge.resp_dir
 
@@ -726,6 +931,8 @@ def getSampleRateSpectra(r_stream,sampling_rate,norm_freq, concierge):
                                        minfreq, maxfreq, nfreq, units.lower(), output.lower())
         except Exception as e:
             raise
+    if concierge.response_cache is not None:
+        concierge.response_cache[response_key] = evalResp.copy()
     return(evalResp)
 
     
@@ -0,0 +1,550 @@
+"""
+ISPAQ work queue for distributing metrics over worker processes on several nodes.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import copy
+import json
+import time
+import uuid
+import pickle
+import socket
+import sqlite3
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+try:
+    import database
+    from completed_units import CompletedUnit
+except:
+    from . import database
+    from .completed_units import CompletedUnit
+
+
+# A claimed unit is given to another worker when its lease is not renewed in time
+LEASE_SECONDS = 300
+HEARTBEAT_SECONDS = 30
+# Seconds between passes of a worker waiting for the units of other workers
+POLL_SECONDS = 10
+# Claims of a unit before it is marked as failed
+MAX_ATTEMPTS = 3
+
+QUEUE_SQL = [
+    """ CREATE TABLE IF NOT EXISTS request (
+            name text PRIMARY KEY,
+            value text NOT NULL
+        ); """,
+    """ CREATE TABLE IF NOT EXISTS units (
+            logic text NOT NULL,
+            unit text NOT NULL,
+            seq integer NOT NULL,
+            state text NOT NULL DEFAULT 'pending',
+            worker text,
+            expires float,
+            attempts integer NOT NULL DEFAULT 0,
+            PRIMARY KEY(logic, unit)
+        ); """,
+    """ CREATE TABLE IF NOT EXISTS results (
+            logic text NOT NULL,
+            unit text NOT NULL,
+            part integer NOT NULL,
+            data blob NOT NULL,
+            PRIMARY KEY(logic, unit, part)
+        ); """,
+]
+
+
+class WorkQueue(object):
+    """
+    Lease table of the units of work of a distributed run, stored in an SQLite database.
+
+    :type dbname: str
+    :param dbname: SQLite database file, on a filesystem shared by all nodes.
+
+    Units are the SNCL-days or events of a business logic group, in the order of a
+    serial run. A worker claims a unit by taking its lease, renews the lease while
+    it calculates the unit and stores the metrics together with marking the unit
+    done, in one transaction. Units whose lease expires, e.g. because their worker
+    or node was lost, are claimed again by another worker; metrics of a unit are
+    only stored by the worker holding its lease, so none are lost or stored twice.
+
+    .. rubric:: Example
+
+    >>> queue = WorkQueue(':memory:')
+    >>> queue.add_units('simple', ['IU.ANMO.00.BHZ|2020-01-01T00:00:00|0'])
+    >>> queue.claim('simple', 'IU.ANMO.00.BHZ|2020-01-01T00:00:00|0', 'worker1')
+    True
+    >>> queue.complete('simple', 'IU.ANMO.00.BHZ|2020-01-01T00:00:00|0', 'worker1', [])
+    True
+    """
+    def __init__(self, dbname):
+        self.dbname = dbname
+        # The default rollback journal, as WAL does not work on network filesystems
+        self.conn = sqlite3.connect(dbname, timeout=60, isolation_level=None)
+        for sql in QUEUE_SQL:
+            self.conn.execute(sql)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run statements in one transaction holding the write lock.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def store_request(self, request):
+        """
+        Store the request calculated by the workers.
+        :param request: JSON serializable dictionary.
+        :return: False if the queue already holds a different request.
+        """
+        value = json.dumps(request, sort_keys=True)
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM request WHERE name = 'request'").fetchone()
+            if row is not None:
+                return row[0] == value
+            conn.execute("INSERT INTO request (name, value) VALUES ('request', ?)", (value,))
+        return True
+
+    def load_request(self):
+        """
+        Return the request stored by the coordinator.
+        :return: Dictionary, or None if no request has been stored yet.
+        """
+        row = self.conn.execute("SELECT value FROM request WHERE name = 'request'").fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def add_units(self, logic, units):
+        """
+        Queue the units of a business logic group, keeping units already in the queue.
+        :param logic: Business logic name, e.g. 'simple'.
+        :param units: Unit keys in the order of a serial run.
+        """
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO units (logic, unit, seq) VALUES (?, ?, ?)",
+                             ((logic, unit, seq) for (seq, unit) in enumerate(units)))
+
+    def claim(self, logic, unit, worker):
+        """
+        Take the lease of a unit that is pending or whose lease has expired.
+        :return: True if worker now holds the lease.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            cursor = conn.execute("""UPDATE units SET state = 'claimed', worker = ?, expires = ?, attempts = attempts + 1
+                                     WHERE logic = ? AND unit = ? AND attempts < ?
+                                     AND (state = 'pending' OR (state = 'claimed' AND expires < ?))""",
+                                  (worker, now + LEASE_SECONDS, logic, unit, MAX_ATTEMPTS, now))
+        return cursor.rowcount == 1
+
+    def renew(self, worker):
+        """
+        Extend the leases held by a worker.
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE units SET expires = ? WHERE state = 'claimed' AND worker = ?",
+                         (time.time() + LEASE_SECONDS, worker))
+
+    def complete(self, logic, unit, worker, dataframes):
+        """
+        Store the metrics of a unit and mark it done, if worker still holds its lease.
+        :param dataframes: Metrics dataframes of the unit and database rows stored by its QueueWriter.
+        :return: False if the lease was taken by another worker and the metrics were dropped.
+        """
+        data = [pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL) for df in dataframes]
+        with self.transaction() as conn:
+            cursor = conn.execute("UPDATE units SET state = 'done', expires = NULL WHERE logic = ? AND unit = ? AND state = 'claimed' AND worker = ?",
+                                  (logic, unit, worker))
+            if cursor.rowcount != 1:
+                return False
+            conn.execute("DELETE FROM results WHERE logic = ? AND unit = ?", (logic, unit))
+            conn.executemany("INSERT INTO results (logic, unit, part, data) VALUES (?, ?, ?, ?)",
+                             ((logic, unit, part, blob) for (part, blob) in enumerate(data)))
+        return True
+
+    def release(self, logic, unit, worker):
+        """
+        Give up the lease of a unit that failed, marking it failed after MAX_ATTEMPTS claims.
+        """
+        with self.transaction() as conn:
+            conn.execute("""UPDATE units SET state = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END, expires = NULL
+                            WHERE logic = ? AND unit = ? AND state = 'claimed' AND worker = ?""",
+                         (MAX_ATTEMPTS, logic, unit, worker))
+
+    def unfinished(self, logic=None):
+        """
+        Count the units that are pending or being calculated.
+        :param logic: Business logic name, or None for all groups.
+        """
+        sql = """SELECT count(*) FROM units
+                 WHERE ((state = 'pending' AND attempts < ?) OR (state = 'claimed' AND (expires >= ? OR attempts < ?)))"""
+        parameters = [MAX_ATTEMPTS, time.time(), MAX_ATTEMPTS]
+        if logic is not None:
+            sql += " AND logic = ?"
+            parameters.append(logic)
+        return self.conn.execute(sql, parameters).fetchone()[0]
+
+    def claimable(self, logic):
+        """
+        Count the units of a group that are pending or whose lease has expired.
+        :param logic: Business logic name.
+        """
+        return self.conn.execute("""SELECT count(*) FROM units WHERE logic = ? AND attempts < ?
+                                    AND (state = 'pending' OR (state = 'claimed' AND expires < ?))""",
+                                 (logic, MAX_ATTEMPTS, time.time())).fetchone()[0]
+
+    def failed(self, logic):
+        """
+        List the units of a group that will not be calculated.
+        """
+        return [row[0] for row in self.conn.execute("SELECT unit FROM units WHERE logic = ? AND state != 'done' ORDER BY seq",
+                                                    (logic,))]
+
+    def results(self, logic):
+        """
+        Yield the stored metrics of a group in the order of a serial run.
+        """
+        cursor = self.conn.execute("""SELECT results.data FROM results JOIN units USING (logic, unit)
+                                      WHERE results.logic = ? ORDER BY units.seq, results.part""", (logic,))
+        for (data,) in cursor:
+            yield pickle.loads(data)
+
+    def close(self):
+        self.conn.close()
+
+
+def unit_key(snclId, starttime, seen):
+    """
+    Name a unit of work.
+    :param snclId: SNCL of the unit, None for all SNCLs of an event.
+    :param starttime: Start time of the unit, UTCDateTime.
+    :param seen: Dictionary counting the names already given in this run.
+    :return: String identifying the unit.
+    """
+    key = "%s|%s" % (snclId or '', starttime.strftime("%Y-%m-%dT%H:%M:%S.%f"))
+    seen[key] = seen.get(key, -1) + 1
+    return "%s|%d" % (key, seen[key])
+
+
+class QueueSink(object):
+    """
+    Collect the metrics of the unit a worker has claimed and store them with the unit.
+
+    Takes the place of a :class:`~ispaq.metric_sink.MetricSink` in the worker and its
+    claim() method takes the place of Concierge.assigned(). A unit is complete when
+    the business logic moves on to the next unit or returns.
+    """
+    def __init__(self, queue, logic, worker, logger):
+        self.queue = queue
+        self.logic = logic
+        self.worker = worker
+        self.logger = logger
+        self.transform = None
+        self.seen = {}
+        self.unit = None
+        self.dataframes = []
+        self.count = 0
+        self.claimed = 0
+
+    def start(self, transform=None):
+        self.transform = transform
+        return self
+
+    def append(self, df):
+        if isinstance(df, CompletedUnit):
+            self.dataframes.append(df)
+            return
+        self.count += 1
+        if df is None or df.empty:
+            return
+        if self.transform is not None:
+            df = self.transform(df)
+        if df is not None and not df.empty:
+            self.dataframes.append(df)
+
+    def __len__(self):
+        return self.count
+
+    def store(self, message):
+        # Database rows of the unit, see QueueWriter
+        self.dataframes.append(message)
+
+    def claim(self, snclId, starttime):
+        self.commit()
+        unit = unit_key(snclId, starttime, self.seen)
+        if not self.queue.claim(self.logic, unit, self.worker):
+            return False
+        self.unit = unit
+        self.claimed += 1
+        return True
+
+    def commit(self):
+        if self.unit is not None and not self.queue.complete(self.logic, self.unit, self.worker, self.dataframes):
+            self.logger.warning("Lease of %s unit %s expired, its metrics are left to the worker that claimed it again"
+                                % (self.logic, self.unit))
+        self.unit = None
+        self.dataframes = []
+
+    def release(self):
+        if self.unit is not None:
+            self.queue.release(self.logic, self.unit, self.worker)
+        self.unit = None
+        self.dataframes = []
+
+
+class QueueWriter(object):
+    """
+    Store the database rows written by the business logic with the unit a worker has claimed.
+
+    :type dbname: str
+    :param dbname: SQLite output database of the request.
+
+    Has the interface of :class:`~ispaq.database.DatabaseWriter` and takes its place
+    in a worker, see database.redirect(). Rows such as the corrected PSDs and their
+    histograms are stored in the work queue together with the metrics of their unit
+    and written to the output database by the coordinator in write_results(), so
+    workers on other nodes never write to it and the rows of a unit whose lease
+    was lost are dropped with its metrics.
+    """
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.sink = None
+
+    @contextmanager
+    def transaction(self):
+        # The coordinator writes the rows of each unit in its own transactions
+        yield self
+
+    def create_table(self, tablename, kind=None):
+        self.sink.store(('create', self.dbname, (tablename, kind), None))
+
+    def upsert(self, tablename, rows, kind=None):
+        rows = list(rows)
+        if rows:
+            self.sink.store(('upsert', self.dbname, (tablename, kind), rows))
+
+    def replace_psd_histogram(self, target, day, rows):
+        self.sink.store(('psd_histogram', self.dbname, (target, day), list(rows)))
+
+    def close(self):
+        pass
+
+
+def _write_rows(message):
+    """
+    Write database rows stored by a QueueWriter.
+    """
+    (kind, dbname, key, rows) = message
+    writer = database.get_writer(dbname)
+    if kind == 'create':
+        writer.create_table(*key)
+    elif kind == 'upsert':
+        writer.upsert(key[0], rows, key[1])
+    elif kind == 'psd_histogram':
+        writer.replace_psd_histogram(key[0], key[1], rows)
+
+
+def _heartbeat(dbname, worker, stop):
+    """
+    Renew the leases of a worker until it stops or dies.
+    """
+    parent = os.getppid()
+    queue = WorkQueue(dbname)
+    while not stop.wait(HEARTBEAT_SECONDS) and os.getppid() == parent:
+        try:
+            queue.renew(worker)
+        except sqlite3.Error:
+            continue
+
+
+def _copy_concierge(concierge, setup):
+    logic_concierge = copy.copy(concierge)
+    logic_concierge.worker = None
+    logic_concierge.unit_counter = 0
+    if setup is not None:
+        setup(logic_concierge)
+    return logic_concierge
+
+
+def distribute(concierge, dbname, request, logic_functions, setups=None):
+    """
+    Queue the units of work of a request.
+    :param concierge: Data access expediter.
+    :param dbname: SQLite database file of the work queue.
+    :param request: JSON serializable description of the request, loaded by the workers.
+    :param logic_functions: Dictionary of business logic functions by name, e.g. {'simple': simple_metrics}.
+    :param setups: Dictionary of functions called with the Concierge before a group is run, by name.
+
+    Each business logic function is run without calculating anything, recording
+    the units of work it passes to Concierge.assigned(). Units already in the
+    queue are kept, so a coordinator can be restarted with the same queue.
+    """
+    logger = concierge.logger
+    queue = WorkQueue(dbname)
+    try:
+        if not queue.store_request(request):
+            logger.critical("Work queue %s holds a different request" % dbname)
+            raise SystemExit
+
+        for (logic, logic_function) in logic_functions.items():
+            units = []
+            seen = {}
+            def record(snclId, starttime):
+                units.append(unit_key(snclId, starttime, seen))
+                return False
+
+            plan_concierge = _copy_concierge(concierge, (setups or {}).get(logic))
+            plan_concierge.claim = record
+            # Warnings are repeated by the workers, which run the same code
+            disabled = logging.root.manager.disable
+            logging.disable(logging.WARNING)
+            try:
+                logic_function(plan_concierge, sink=None)
+            finally:
+                logging.disable(disabled)
+
+            queue.add_units(logic, units)
+            logger.info("Queued %d %s units of work in %s" % (len(units), logic, dbname))
+    finally:
+        queue.close()
+
+
+def _work(concierge, dbname, logic_functions, setups):
+    """
+    Claim and calculate units of work until all units are finished.
+    """
+    logger = concierge.logger
+    worker = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    queue = WorkQueue(dbname)
+
+    ctx = multiprocessing.get_context('fork')
+    stop = ctx.Event()
+    heartbeat = ctx.Process(target=_heartbeat, args=(dbname, worker, stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    # Rows for the output database are stored with the units, see QueueWriter
+    writer = None
+    if concierge.output == 'db':
+        writer = QueueWriter(concierge.db_name)
+        database.redirect(concierge.db_name, writer)
+
+    errors = dict((logic, 0) for logic in logic_functions)
+    try:
+        while True:
+            active = [logic for logic in logic_functions if errors[logic] < MAX_ATTEMPTS and queue.unfinished(logic) > 0]
+            if not active:
+                break
+            # The business logic reads the whole request, so it is only run again
+            # once there are units to claim
+            claimable = [logic for logic in active if queue.claimable(logic) > 0]
+            claimed = 0
+            for logic in claimable:
+                logic_concierge = _copy_concierge(concierge, setups.get(logic))
+                sink = QueueSink(queue, logic, worker, logger)
+                logic_concierge.claim = sink.claim
+                if writer is not None:
+                    writer.sink = sink
+                try:
+                    logic_functions[logic](logic_concierge, sink=sink)
+                    sink.commit()
+                except Exception as e:
+                    sink.release()
+                    errors[logic] += 1
+                    logger.debug(e)
+                    logger.error("Error calculating '%s' metrics" % logic)
+                claimed += sink.claimed
+            if claimed == 0:
+                # Wait for the units of other workers, or for their leases to expire
+                time.sleep(POLL_SECONDS)
+    finally:
+        if writer is not None:
+            database.redirect(concierge.db_name, None)
+        stop.set()
+        heartbeat.join()
+        queue.close()
+
+
+def run_workers(concierge, dbname, logic_functions, setups=None):
+    """
+    Calculate queued units of work in concierge.processes worker processes.
+    :param concierge: Data access expediter.
+    :param dbname: SQLite database file of the work queue.
+    :param logic_functions: Dictionary of business logic functions by name, e.g. {'simple': simple_metrics}.
+    :param setups: Dictionary of functions called with the Concierge before a group is run, by name.
+
+    Returns once every unit is done or failed, including the units claimed by
+    workers on other nodes.
+    """
+    setups = setups or {}
+    if concierge.processes <= 1:
+        return _work(concierge, dbname, logic_functions, setups)
+
+    ctx = multiprocessing.get_context('fork')
+    workers = [ctx.Process(target=_work, args=(concierge, dbname, logic_functions, setups))
+               for index in range(concierge.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def write_results(dbname, logic, sink):
+    """
+    Write the metrics calculated by the workers of a distributed run.
+    :param dbname: SQLite database file of the work queue.
+    :param logic: Business logic name, e.g. 'simple'.
+    :param sink: MetricSink receiving the metrics, in the order of a serial run.
+
+    Database rows stored by the workers' QueueWriters are written here as well.
+    """
+    queue = WorkQueue(dbname)
+    try:
+        failed = queue.failed(logic)
+        if failed:
+            sink.logger.warning("%d %s units of work were not calculated, e.g. %s" % (len(failed), logic, failed[0]))
+        for data in queue.results(logic):
+            if isinstance(data, tuple):
+                _write_rows(data)
+            else:
+                sink.append(data)
+    finally:
+        queue.close()
+
+
+def worker_args(args):
+    """
+    Return the arguments of the request stored in a work queue by its coordinator.
+    :param args: Arguments of the worker, with args.worker naming the queue.
+    :return: argparse.Namespace of the coordinator, with the worker's own logging and processes.
+
+    Changes to the directory of the coordinator, so that relative paths in the
+    request and its preference file refer to the same files.
+    """
+    queue = WorkQueue(args.worker)
+    try:
+        request = queue.load_request()
+    finally:
+        queue.close()
+    if request is None:
+        raise ValueError("no request has been queued in %s" % args.worker)
+
+    values = dict(request['args'])
+    for name in ('worker', 'log_level', 'append', 'processes'):
+        values[name] = getattr(args, name)
+    values['queue'] = None
+    if os.path.isdir(request['cwd']):
+        os.chdir(request['cwd'])
+    return type(args)(**values)
@@ -0,0 +1,354 @@
+"""
+ISPAQ parallel calculation of metrics in worker processes.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import sys
+import copy
+import queue
+import logging
+import heapq
+import pickle
+import multiprocessing
+
+from obspy import UTCDateTime
+
+try:
+    from completed_units import CompletedUnit
+except:
+    from .completed_units import CompletedUnit
+
+
+class UnitAssignment(object):
+    """
+    Numbering of the units of work of a request and their assignment to worker processes.
+
+    Mixed into :class:`~ispaq.concierge.Concierge`, which sets the attributes used here:
+    worker, shard, requested_starttime, unit_counter, current_unit, on_assigned and claim.
+    """
+    def assigned(self, snclId, starttime):
+        """
+        Check whether this process calculates the metrics of a SNCL-day or event.
+        :param snclId: SNCL of the unit of work, None for all SNCLs of an event.
+        :param starttime: Start time of the unit of work, UTCDateTime.
+        :return: True unless this is a worker process and the unit belongs to another worker.
+
+        Business logic calls this once for every unit, in the same order in every
+        process. Units are numbered in that order and dealt out to the workers in turn,
+        so each worker calculates every n-th unit and results can be put back in order.
+        When shard is set, SNCL-days are numbered by their time shard instead, so that
+        each worker calculates every n-th day or week for all SNCLs. A worker index of
+        None calculates no units. In a distributed run, a unit is calculated by the
+        process that claims it from the work queue.
+        """
+        unit = self.unit_counter
+        self.unit_counter += 1
+        if self.claim is not None:
+            return self.claim(snclId, starttime)
+        if self.worker is None:
+            return True
+        (index, count) = self.worker
+        if self.shard is not None and snclId is not None:
+            unit = self.shard_index(starttime)
+        if index is None or unit % count != index:
+            return False
+        self.current_unit = unit
+        if self.on_assigned is not None:
+            self.on_assigned(unit)
+        return True
+
+    def shard_index(self, starttime):
+        """
+        Number the day or week of the requested time span that a time falls in.
+        :param starttime: UTCDateTime.
+        :return: 0 for the first day or week.
+        """
+        seconds = 7 * 86400 if self.shard == 'week' else 86400
+        return int((starttime - UTCDateTime(self.requested_starttime.date)) // seconds)
+
+    def in_shard(self, starttime):
+        """
+        Check whether this process calculates the SNCL-days of a day.
+        :param starttime: Start time of the day, UTCDateTime.
+        :return: False if days are sharded over worker processes and the day belongs to another worker.
+
+        Lets business logic skip the days of other workers before requesting their availability.
+        """
+        if self.worker is None or self.shard is None:
+            return True
+        (index, count) = self.worker
+        return index is not None and self.shard_index(starttime) % count == index
+
+
+class WorkerSink(object):
+    """
+    Send the metrics calculated by a worker process to the parent process.
+
+    Takes the place of a :class:`~ispaq.metric_sink.MetricSink` in the worker. Each
+    dataframe is tagged with the SNCL-day or event it belongs to, so that the parent can
+    write the results of all workers in the order of a serial run.
+    """
+    def __init__(self, concierge, results, index):
+        self.concierge = concierge
+        self.results = results
+        self.index = index
+        self.transform = None
+        self.count = 0
+        self.sequence = 0    # orders the dataframes and markers of a unit
+
+    def start(self, transform=None):
+        self.transform = transform
+        return self
+
+    def append(self, df):
+        self.sequence += 1
+        if isinstance(df, CompletedUnit):
+            self.results.put(('result', self.index, (self.concierge.current_unit, self.sequence, df)))
+            return
+        self.count += 1
+        if df is None or df.empty:
+            return
+        if self.transform is not None:
+            df = self.transform(df)
+        df = self.concierge.drop_completed(df)
+        if df is not None and not df.empty:
+            self.results.put(('result', self.index, (self.concierge.current_unit, self.sequence, df)))
+
+    def __len__(self):
+        return self.count
+
+
+def _run_worker(concierge, logic_function, index, count, results, setup):
+    """
+    Calculate one worker's share of the units of work in a forked process.
+    """
+    concierge.worker = (index, count)
+    concierge.on_assigned = lambda unit: results.put(('start', index, unit))
+    if setup is not None:
+        setup(concierge)
+
+    error = None
+    try:
+        logic_function(concierge, sink=WorkerSink(concierge, results, index))
+    except BaseException as e:
+        error = e
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = RuntimeError(str(e))
+
+    hits = concierge.result_cache.hits if concierge.result_cache is not None else 0
+    results.put(('done', index, (error, hits)))
+
+
+def _load_R():
+    # Forked processes inherit the R namespaces and functions loaded here. Nothing
+    # is loaded when this process does not use R.
+    if 'rpy2' in sys.modules:
+        try:
+            from irismustangmetrics import load_R
+        except:
+            from .irismustangmetrics import load_R
+        load_R()
+
+
+def run_metrics(concierge, logic_function, sink, setup=None, plan=False):
+    """
+    Calculate business logic metrics in concierge.processes worker processes.
+    :param concierge: Data access expediter.
+    :param logic_function: Business logic function such as simple_metrics.
+    :param sink: MetricSink receiving the metrics, in the order of a serial run.
+    :param setup: Function called with the worker's Concierge before it starts, or None.
+    :param plan: Run logic_function here first without calculating any unit, so that
+        inputs the Concierge stores, such as the event catalog, are requested once
+        and every worker numbers the same units.
+
+    Workers are forked from this process after load_R(), so each starts with a warm R session and
+    its own copy of the Concierge. Every worker runs logic_function over the whole
+    request and calculates the SNCL-days or events that Concierge.assigned() gives it. The
+    metrics are written here, in unit order, as soon as all earlier units are done.
+    Exceptions raised by the business logic are re-raised once all workers finish.
+    """
+    logger = concierge.logger
+    count = concierge.processes
+    if count <= 1:
+        return logic_function(concierge, sink=sink)
+
+    if plan:
+        # Warnings are repeated by the workers, which run the same code
+        disabled = logging.root.manager.disable
+        concierge.worker = (None, count)
+        logging.disable(logging.WARNING)
+        try:
+            logic_function(concierge, sink=None)
+        finally:
+            logging.disable(disabled)
+            concierge.worker = None
+
+    _load_R()
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_run_worker, args=(concierge, logic_function, index, count, results, setup))
+               for index in range(count)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    # Unit each worker is working on; all of its earlier units are finished
+    started = [-1] * count
+    running = set(range(count))
+    pending = []
+    errors = []
+
+    def handle(message):
+        (kind, index, value) = message
+        if kind == 'start':
+            started[index] = value
+        elif kind == 'result':
+            heapq.heappush(pending, value)
+        elif kind == 'done':
+            (error, hits) = value
+            running.discard(index)
+            if error is not None:
+                errors.append(error)
+            if concierge.result_cache is not None:
+                concierge.result_cache.hits += hits
+
+    while running:
+        try:
+            handle(results.get(timeout=5))
+        except queue.Empty:
+            # Look for workers that died without reporting
+            for index in list(running):
+                if not workers[index].is_alive():
+                    while True:
+                        try:
+                            handle(results.get_nowait())
+                        except queue.Empty:
+                            break
+                    if index in running:
+                        running.discard(index)
+                        errors.append(RuntimeError("Worker process %d exited with code %s" % (index, workers[index].exitcode)))
+
+        # Write the results of every unit that precedes the units still being worked on
+        finished = min(started[index] for index in running) if running else float('inf')
+        while pending and pending[0][0] < finished:
+            sink.append(heapq.heappop(pending)[2])
+
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        logger.debug("%d of %d worker processes failed" % (len(errors), count))
+        raise errors[0]
+
+
+def _run_group(concierge, run_group, name, processes, results):
+    """
+    Calculate the metrics of one business logic group in a forked process.
+    """
+    concierge.processes = processes
+    hits = concierge.result_cache.hits if concierge.result_cache is not None else 0
+
+    error = None
+    try:
+        run_group(concierge, name)
+    except BaseException as e:
+        error = str(e) or e.__class__.__name__
+
+    if concierge.result_cache is not None:
+        hits = concierge.result_cache.hits - hits
+    results.put(('done', name, (error, hits)))
+
+
+def run_groups(concierge, names, run_group):
+    """
+    Calculate business logic groups concurrently within concierge.processes processes.
+    :param concierge: Data access expediter.
+    :param names: Business logic names, e.g. ['simple', 'PSD'], in the order they are started.
+    :param run_group: Function called with a Concierge and a business logic name that
+        calculates and writes the metrics of that group.
+
+    Each group runs in its own forked process and writes its own output file or
+    database tables, as it would in a serial run. Groups are started while processes
+    are left in the budget; each is given an equal share of the free processes for
+    its own workers (see run_metrics), so that no more than concierge.processes
+    processes calculate metrics at any time. Groups waiting to start receive the
+    processes of the groups that finish.
+    """
+    logger = concierge.logger
+    budget = concierge.processes
+    if budget <= 1 or len(names) <= 1:
+        for name in names:
+            run_group(concierge, name)
+        return
+
+    _load_R()
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    waiting = list(names)
+    running = {}    # name -> (process, share of the budget)
+
+    def finish(name, error, hits):
+        (process, share) = running.pop(name)
+        process.join()
+        if error is not None:
+            logger.debug(error)
+            logger.error("Error calculating '%s' metrics" % name)
+        if concierge.result_cache is not None:
+            concierge.result_cache.hits += hits
+
+    while waiting or running:
+        free = budget - sum(share for (process, share) in running.values())
+        while waiting and free > 0:
+            name = waiting.pop(0)
+            share = max(1, free // min(len(waiting) + 1, free))
+            # Not a daemon, so that the group can fork its own workers
+            process = ctx.Process(target=_run_group, args=(concierge, run_group, name, share, results))
+            process.start()
+            logger.debug("Calculating %s metrics in process %d with %d worker process(es)" % (name, process.pid, share))
+            running[name] = (process, share)
+            free -= share
+
+        try:
+            (kind, name, (error, hits)) = results.get(timeout=5)
+            finish(name, error, hits)
+        except queue.Empty:
+            # Look for groups that died without reporting
+            for name in list(running):
+                process = running[name][0]
+                if not process.is_alive():
+                    while True:
+                        try:
+                            (kind, done, (error, hits)) = results.get_nowait()
+                        except queue.Empty:
+                            break
+                        finish(done, error, hits)
+                    if name in running:
+                        finish(name, "Process exited with code %s" % process.exitcode, 0)
+
+
+def skip_pdfs(concierge):
+    """
+    Worker setup for PSD_metrics: only calculate PSDs, PDFs need the PSDs of all workers.
+    """
+    concierge.pdf_interval = ''
+
+
+def pdfs_only(concierge):
+    """
+    Return a Concierge for PSD_metrics that only calculates PDFs from the stored PSDs.
+    :param concierge: Data access expediter.
+    :return: Copy of the concierge, or None if no PDFs were requested.
+    """
+    if 'pdf' not in concierge.metric_names or 'PDF' not in concierge.function_by_logic['PSD']:
+        return None
+    pdf_concierge = copy.copy(concierge)
+    pdf_concierge.function_by_logic = dict(concierge.function_by_logic)
+    pdf_concierge.function_by_logic['PSD'] = {'PDF': concierge.function_by_logic['PSD']['PDF']}
+    return pdf_concierge
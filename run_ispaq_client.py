@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Convenience wrapper for sending requests to an ispaq daemon directly from source tree."""
+
+from __future__ import (absolute_import, division, print_function)
+
+import warnings
+warnings.simplefilter(action = "ignore", category = FutureWarning)
+
+from ispaq.daemon import client_main
+
+if __name__ == '__main__':
+    client_main()
@@ -23,7 +23,8 @@ setup(
     name = "cmdline-ispaq",
     packages = ["ispaq"],
     entry_points = {
-        "console_scripts": ['ispaq = ispaq.ispaq:main']
+        "console_scripts": ['ispaq = ispaq.ispaq:main',
+                            'ispaq-client = ispaq.daemon:client_main']
         },
     version = version,
     description = "IRIS System for Portable Assessment of Quality (ISPAQ)",
@@ -0,0 +1,189 @@
+"""
+Tests of the PSD-derived metrics calculated from stored corrected PSDs.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("rpy2")
+
+from obspy import UTCDateTime
+
+from ispaq import noise_models
+from ispaq import PSD_derived
+from ispaq import PSD_metrics
+from ispaq.concierge import Concierge
+from ispaq.metric_sink import MetricSink
+
+
+STARTTIME = UTCDateTime("2020-01-01")
+ENDTIME = UTCDateTime("2020-01-02")
+
+
+def mcnamara_freqs(sampling_rate, loFreq, alignFreq=0.1):
+    # 1/8 octave bins aligned on alignFreq up to the Nyquist frequency, as IRISSeismic::McNamaraBins
+    octaves = np.arange(np.ceil(8 * np.log2(loFreq / alignFreq)),
+                        np.floor(8 * np.log2(sampling_rate / 2 / alignFreq)) + 1)
+    return alignFreq * 2**(octaves / 8)
+
+
+def psd_metric(freq, noiseMatrix, sampling_rate, channel):
+    # Line by line port of IRISMustangMetrics::PSDMetric, with R's 1-based index arithmetic
+    nhnm, nlnm = noise_models.get_model_powers(freq)
+    with np.errstate(invalid='ignore'):
+        pct_above = np.where(np.isnan(nhnm), np.nan, 100 * (noiseMatrix > nhnm).sum(axis=0) / noiseMatrix.shape[0])
+        pct_below = np.where(np.isnan(nlnm), np.nan, 100 * (noiseMatrix < nlnm).sum(axis=0) / noiseMatrix.shape[0])
+    metrics = {}
+
+    nyquist = sampling_rate / 2
+    metrics['pct_above_nhnm'] = np.nanmean(pct_above[freq < nyquist / 1.5])
+    metrics['pct_below_nlnm'] = np.nanmean(pct_below[freq < nyquist / 1.5])
+
+    period = 1 / freq
+    which = lambda x: np.where(x)[0] + 1
+    first = max(which(period >= 100)) + 1
+    last = min(which(period <= 4 / sampling_rate)) - 1
+    x = np.log10(period[first - 1:last])
+    y = noiseMatrix.mean(axis=0)[first - 1:last]
+    residuals = y - np.polyval(np.polyfit(x, y, 1), x)
+    if any(band in channel for band in ['BH','HH','CH','DH','FH','BX','HX']):
+        metrics['dead_channel_lin'] = np.std(residuals, ddof=1)
+
+    if sampling_rate > 0.999:
+        first = max(which(period >= 4)) + 1
+        last = min(which(period <= 8)) - 1
+        lo, hi = sorted([first, last])
+        psdMedian_v = np.median(noiseMatrix[:, lo - 1:hi], axis=0)
+        averageDiff = np.mean(nlnm[lo - 1:hi] - psdMedian_v)
+        if any(band in channel for band in ['BH','HH','CH','DH','FH','LH','MH','BX','HX']):
+            metrics['dead_channel_gsn'] = 1.0 if averageDiff > 5.0 else 0.0
+
+    return metrics
+
+
+def stored_psds(target, freq, noiseMatrix):
+    starttimes = pd.date_range("2020-01-01", periods=noiseMatrix.shape[0], freq="30min")
+    return pd.DataFrame({'target': target,
+                         'starttime': np.repeat(starttimes, len(freq)),
+                         'frequency': np.tile(freq, noiseMatrix.shape[0]),
+                         'power': noiseMatrix.ravel()})
+
+
+def noise_matrix(freq, offset, seed):
+    # PSDs scattered around the middle of the noise models
+    rng = np.random.default_rng(seed)
+    nhnm, nlnm = noise_models.get_model_powers(freq)
+    middle = np.where(np.isnan(nlnm), -150.0, (nhnm + nlnm) / 2)
+    return middle + offset + rng.normal(0, 25, (47, len(freq)))
+
+
+CHANNELS = [
+    ('IU.ANMO.00.BHZ.M', 40.0, 0.005, 0.0),
+    ('IU.ANMO.00.BH1.M', 40.0, 0.005, -60.0),
+    ('IU.ANMO.10.HHZ.M', 100.0, 0.005, 0.0),
+    ('IU.ANMO.00.LHZ.M', 1.0, 0.001, 0.0),
+    ('IU.ANMO.00.LH2.M', 1.0, 0.001, -60.0),
+    ('IU.ANMO.00.VHZ.M', 0.1, 0.0001, 0.0),
+]
+
+
+def test_derived_metrics_match_psd_metric():
+    psds = []
+    expected = {}
+    for (seed, (target, sampling_rate, loFreq, offset)) in enumerate(CHANNELS):
+        freq = mcnamara_freqs(sampling_rate, loFreq, 0.025 if target.split('.')[3][0] == 'V' else 0.1)
+        noiseMatrix = noise_matrix(freq, offset, seed)
+        psds.append(stored_psds(target, freq, noiseMatrix))
+        expected[target] = psd_metric(freq, noiseMatrix, sampling_rate, target.split('.')[3])
+
+    df = PSD_derived.calculate_derived_metrics(pd.concat(psds, ignore_index=True), STARTTIME, ENDTIME)
+
+    for (target, metrics) in expected.items():
+        result = df[df['snclq'] == target].set_index('metricName')['value']
+        assert sorted(result.index) == sorted(metrics)
+        for (metricName, value) in metrics.items():
+            assert result[metricName] == pytest.approx(value, rel=1e-9, abs=1e-9), (target, metricName)
+
+    # The synthetic dead channels are flagged, the live ones are not
+    gsn = df[df['metricName'] == 'dead_channel_gsn'].set_index('snclq')['value']
+    assert gsn.to_dict() == {'IU.ANMO.00.BHZ.M': 0, 'IU.ANMO.00.BH1.M': 1, 'IU.ANMO.10.HHZ.M': 0,
+                             'IU.ANMO.00.LHZ.M': 0, 'IU.ANMO.00.LH2.M': 1}
+
+
+@pytest.mark.parametrize("sampling_rate,loFreq", [(1.0, 0.001), (20.0, 0.005), (40.0, 0.005),
+                                                  (100.0, 0.005), (200.0, 0.005)])
+def test_infer_sampling_rate(sampling_rate, loFreq):
+    freq = mcnamara_freqs(sampling_rate, loFreq)
+    assert PSD_derived.infer_sampling_rate(float("%.6g" % freq.max())) == sampling_rate
+
+
+def test_sampling_rates_override_inference():
+    freq = mcnamara_freqs(1.0, 0.001)
+    psd = stored_psds('IU.ANMO.00.LHZ.M', freq, noise_matrix(freq, 0.0, 0))
+    df = PSD_derived.calculate_derived_metrics(psd, STARTTIME, ENDTIME, {'IU.ANMO.00.LHZ.M': 0.9})
+    assert 'dead_channel_gsn' not in set(df['metricName'])
+
+
+def stored_psd_concierge(tmp_path, resume):
+    # Only the attributes used by PSD_metrics with stored PSDs, resuming and MetricSink
+    concierge = object.__new__(Concierge)
+    concierge.logger = logging.getLogger("ispaq-test")
+    concierge.function_by_logic = {'PSD': {'PSD': {'metrics': ['pct_above_nhnm', 'dead_channel_gsn']}}}
+    concierge.metric_names = ['pct_above_nhnm', 'dead_channel_gsn']
+    concierge.stored_psds = True
+    concierge.station_client = None
+    concierge.output = 'csv'
+    concierge.csv_dir = str(tmp_path)
+    concierge.psd_dir = str(tmp_path / "PSDs")
+    concierge.db_name = str(tmp_path / "ispaq.db")
+    concierge.sigfigs = 6
+    concierge.requested_starttime = STARTTIME
+    concierge.requested_endtime = ENDTIME
+    concierge.worker = None
+    concierge.shard = None
+    concierge.unit_counter = 0
+    concierge.current_unit = None
+    concierge.on_assigned = None
+    concierge.claim = None
+    concierge.resume = resume
+    concierge.completed = set()
+    concierge.completed_starts = set()
+    concierge.completed_units = set()
+    if resume:
+        concierge.load_completed()
+    return concierge
+
+
+def test_stored_psds_are_not_recalculated_when_resuming(tmp_path, monkeypatch):
+    psds = []
+    for (seed, (target, sampling_rate, loFreq, offset)) in enumerate(CHANNELS[:2]):
+        freq = mcnamara_freqs(sampling_rate, loFreq)
+        psds.append(stored_psds(target, freq, noise_matrix(freq, offset, seed)))
+    monkeypatch.setattr(PSD_derived, 'load_stored_PSDs', lambda *args: pd.concat(psds, ignore_index=True))
+    monkeypatch.setattr(PSD_derived, 'metadata_sampling_rates', lambda *args: {})
+    calculated = []
+    calculate = PSD_derived.calculate_derived_metrics
+    def counting_calculate(psd, *args):
+        calculated.extend(psd['target'].unique())
+        return calculate(psd, *args)
+    monkeypatch.setattr(PSD_derived, 'calculate_derived_metrics', counting_calculate)
+
+    for resume in [False, True]:
+        concierge = stored_psd_concierge(tmp_path, resume)
+        with MetricSink(concierge, 'PSD', str(tmp_path / "example_PSDMetrics.csv")) as sink:
+            PSD_metrics.PSD_metrics(concierge, sink=sink)
+        if not resume:
+            assert sorted(calculated) == ['IU.ANMO.00.BH1.M', 'IU.ANMO.00.BHZ.M']
+            assert sink.rows == 4
+        else:
+            assert sink.rows == 0
+    assert len(calculated) == 2
@@ -0,0 +1,70 @@
+"""
+Tests of the ISPAQ database writers.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+import sqlite3
+
+from ispaq import database
+
+
+def count_rows(dbname, tablename):
+    conn = sqlite3.connect(dbname)
+    try:
+        return conn.execute("SELECT count(*) FROM %s" % tablename).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_writer_process_keeps_the_rows_it_can_write(tmp_path):
+    dbname = str(tmp_path / "ispaq.db")
+    database.start_writer(dbname, logging.getLogger("ispaq-test"))
+    try:
+        writer = database.get_writer(dbname)
+        assert writer.sync() == 0
+
+        # One bad message in a batch with good rows of the same and other tables
+        writer.upsert('psd_corrected', [('IU.ANMO.00.BHZ.M', 1.0, -120.0, '2020-01-01', '2020-01-01')])
+        writer.upsert('psd_corrected', [('IU.ANMO.00.BHZ.M', 2.0)])
+        writer.upsert('psd_corrected', [('IU.ANMO.00.BHZ.M', 2.0, -120.0, '2020-01-01', '2020-01-01')])
+        writer.replace_psd_histogram('IU.ANMO.00.BHZ.M', '2020-01-01', [(1.0, -120, 1)])
+        writer.upsert('completed_units', [('PSD', 'IU.ANMO.00.BHZ', '2020-01-01')])
+
+        assert writer.sync() == 1
+        assert count_rows(dbname, 'psd_corrected') == 2
+        assert count_rows(dbname, 'psd_histogram') == 1
+        assert count_rows(dbname, 'completed_units') == 1
+
+        # Failures are counted once
+        writer.upsert('completed_units', [('PSD', 'IU.ANMO.00.BHZ', '2020-01-02')])
+        assert database.sync(dbname) == 1
+        assert count_rows(dbname, 'completed_units') == 2
+    finally:
+        database.stop_writers()
+
+
+def index_names(dbname):
+    conn = sqlite3.connect(dbname)
+    try:
+        return set(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';"))
+    finally:
+        conn.close()
+
+
+def test_opening_a_database_indexes_existing_tables(tmp_path):
+    # psd_corrected as written by versions without the index
+    dbname = str(tmp_path / "ispaq.db")
+    conn = sqlite3.connect(dbname)
+    conn.execute("CREATE TABLE psd_corrected (target text, frequency float, power float, start datetime, end datetime)")
+    conn.commit()
+    conn.close()
+    assert 'psd_corrected_target_start' not in index_names(dbname)
+
+    database.DatabaseWriter(dbname).close()
+    assert 'psd_corrected_target_start' in index_names(dbname)
@@ -0,0 +1,60 @@
+"""
+Tests of the IRISSeismic wrappers.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+import sys
+import subprocess
+import textwrap
+
+import pytest
+
+pytest.importorskip("rpy2")
+
+from rpy2.robjects.packages import isinstalled
+
+
+pytestmark = pytest.mark.skipif(not (isinstalled("IRISSeismic") and isinstalled("IRISMustangMetrics")),
+                                reason="IRISSeismic and IRISMustangMetrics R packages are not installed")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(script, cache_home):
+    env = dict(os.environ, XDG_CACHE_HOME=str(cache_home), PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, "-c", textwrap.dedent(script)], env=env, cwd=ROOT,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+
+def test_R_Stream_with_warm_package_cache(tmp_path):
+    # Fill the package cache, so that nothing reads the R packages in the next interpreter
+    result = run_python("""
+        from ispaq import irismustangmetrics
+        irismustangmetrics.function_metadata()
+    """, tmp_path)
+    assert result.returncode == 0, result.stdout
+
+    result = run_python("""
+        import numpy as np
+        import rpy2.robjects as ro
+        from obspy import Stream, Trace, UTCDateTime
+        from ispaq import package_cache, irisseismic
+
+        assert package_cache.load() is not None
+        header = {'network': 'IU', 'station': 'ANMO', 'location': '00', 'channel': 'BHZ',
+                  'sampling_rate': 40.0, 'mseed': {'dataquality': 'M'}}
+        stream = Stream([Trace(np.arange(400, dtype=np.int32), dict(header, starttime=UTCDateTime(2020, 1, 1))),
+                         Trace(np.arange(400, dtype=np.int32), dict(header, starttime=UTCDateTime(2020, 1, 1, 0, 1)))])
+        r_stream = irisseismic.R_Stream(stream)
+        assert ro.r('class')(r_stream)[0] == 'Stream'
+        assert ro.r('function(x) length(x@traces)')(r_stream)[0] == 2
+        r_trace = irisseismic.R_Trace(stream[0])
+        assert ro.r('class')(r_trace)[0] == 'Trace'
+    """, tmp_path)
+    assert result.returncode == 0, result.stdout
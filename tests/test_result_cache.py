@@ -0,0 +1,91 @@
+"""
+Tests of the ISPAQ cache of metric results.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import os
+
+import pandas as pd
+import pytest
+from obspy import UTCDateTime
+
+from ispaq import result_cache
+from ispaq.result_cache import ResultCache
+
+
+def test_file_hashes_are_kept_across_runs(tmp_path):
+    datafile = tmp_path / "IU.ANMO.00.BHZ.2020.001"
+    datafile.write_bytes(b"miniSEED records")
+    cache_dir = str(tmp_path / "cache")
+
+    digest = ResultCache(cache_dir).file_hash(str(datafile))
+
+    # Same size and modification time: a later run uses the stored hash without reading the file
+    stat = os.stat(str(datafile))
+    datafile.write_bytes(b"miniSEED RECORDS")
+    os.utime(str(datafile), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert ResultCache(cache_dir).file_hash(str(datafile)) == digest
+
+    # A new modification time makes it read the file again
+    os.utime(str(datafile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert ResultCache(cache_dir).file_hash(str(datafile)) != digest
+
+
+def test_touching_a_file_keeps_the_key(tmp_path):
+    datafile = tmp_path / "IU.ANMO.00.BHZ.2020.001"
+    datafile.write_bytes(b"miniSEED records")
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    key = cache.key('simple', cache.file_fingerprint([str(datafile)], str(tmp_path)))
+    stat = os.stat(str(datafile))
+    os.utime(str(datafile), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert ResultCache(str(tmp_path / "cache")).key('simple', cache.file_fingerprint([str(datafile)], str(tmp_path))) == key
+
+    datafile.write_bytes(b"miniSEED RECORDS")
+    assert cache.key('simple', cache.file_fingerprint([str(datafile)], str(tmp_path))) != key
+
+
+def test_version_covers_the_calculation_modules_only():
+    names = [os.path.basename(filepath) for filepath in result_cache.calculation_modules()]
+    assert 'simple_metrics.py' in names
+    assert 'PSD_derived.py' in names
+    assert 'database.py' not in names
+    assert 'ispaq.py' not in names
+
+
+def test_response_metrics_are_cached_with_local_RESP_files_only(tmp_path):
+    pytest.importorskip("rpy2")
+    from ispaq.concierge import Concierge
+
+    datafile = tmp_path / "IU.ANMO.00.BHZ.2020.001"
+    datafile.write_bytes(b"miniSEED records")
+    concierge = object.__new__(Concierge)
+    concierge.result_cache = ResultCache(str(tmp_path / "cache"))
+    concierge.dataselect_url = str(tmp_path)
+    concierge.station_url = str(tmp_path / "IU.xml")
+    concierge.local_data_files = lambda *args: [str(datafile)]
+    av = pd.Series({'network': 'IU', 'station': 'ANMO', 'location': '00', 'channel': 'BHZ',
+                    'snclId': 'IU.ANMO.00.BHZ'})
+    window = (UTCDateTime("2020-01-01"), UTCDateTime("2020-01-02"))
+
+    # The response comes from the evalresp web service
+    concierge.resp_dir = None
+    assert concierge.result_key('PSD', av, *window) is not None
+    assert concierge.result_key('PSD', av, *window, response=True) is None
+
+    concierge.resp_dir = str(tmp_path / "RESP")
+    os.mkdir(concierge.resp_dir)
+    assert concierge.result_key('PSD', av, *window, response=True) is None
+
+    respfile = tmp_path / "RESP" / "RESP.IU.ANMO.00.BHZ"
+    respfile.write_bytes(b"B053F03 Transfer function type: A")
+    key = concierge.result_key('PSD', av, *window, response=True)
+    assert key == concierge.result_key('PSD', av, *window)
+
+    respfile.write_bytes(b"B053F03 Transfer function type: B")
+    assert concierge.result_key('PSD', av, *window, response=True) != key
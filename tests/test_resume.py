@@ -0,0 +1,117 @@
+"""
+Tests of resuming a run with --resume.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+
+import pandas as pd
+import pytest
+from obspy import UTCDateTime
+
+pytest.importorskip("rpy2")
+
+from ispaq.concierge import Concierge
+from ispaq.metric_sink import MetricSink
+from ispaq import completed_units
+
+
+DAYS = [UTCDateTime("2020-01-01"), UTCDateTime("2020-01-02")]
+SNCLS = ['IU.ANMO.00.BHZ', 'IU.ANMO.00.LHZ']
+FUNCTIONS = {'basicStats': {'metrics': ['sample_mean']},
+             'numSpikes': {'metrics': ['num_spikes']},
+             'PSD': {'metrics': ['pct_above_nhnm']}}
+
+
+def make_concierge(tmp_path, output, resume):
+    # Only the attributes used by resuming and by MetricSink
+    concierge = object.__new__(Concierge)
+    concierge.logger = logging.getLogger("ispaq-test")
+    concierge.output = output
+    concierge.resume = resume
+    concierge.csv_dir = str(tmp_path)
+    concierge.psd_dir = str(tmp_path / "PSDs")
+    concierge.db_name = str(tmp_path / "ispaq.db")
+    concierge.sigfigs = 6
+    concierge.completed = set()
+    concierge.completed_starts = set()
+    concierge.completed_units = set()
+    if resume:
+        concierge.load_completed()
+    return concierge
+
+
+def logic(concierge, sink, calculated, end):
+    # Mimics simple_metrics: numSpikes produces nothing for LH channels. Mimics PSD_metrics:
+    # metrics start at the first sample rather than at midnight, and end at the requested end
+    for starttime in DAYS:
+        for snclId in SNCLS:
+            for function in concierge.remaining_functions(FUNCTIONS, snclId, starttime):
+                calculated.append((function, snclId, str(starttime.date)))
+                endtime = min(end, starttime + 86400) if function == 'PSD' else starttime + 86400
+                if not (function == 'numSpikes' and snclId.endswith('LHZ')):
+                    start = starttime + 12.5 if function == 'PSD' else starttime
+                    sink.append(pd.DataFrame({'metricName': FUNCTIONS[function]['metrics'],
+                                              'value': [1.0], 'snclq': [snclId + '.M'],
+                                              'starttime': [start], 'endtime': [endtime],
+                                              'qualityFlag': [-9]}))
+                if completed_units.covers_day(starttime, endtime):
+                    sink.append(concierge.completed_unit(function, snclId, starttime))
+
+
+def run(tmp_path, output, resume, end=DAYS[-1] + 86400):
+    concierge = make_concierge(tmp_path, output, resume)
+    calculated = []
+    with MetricSink(concierge, 'simple', str(tmp_path / "example_simpleMetrics.csv")) as sink:
+        logic(concierge, sink.start(), calculated, end)
+    return (calculated, sink.rows)
+
+
+@pytest.mark.parametrize("output", ['csv', 'db'])
+def test_resume_twice_calculates_nothing(tmp_path, output):
+    (calculated, rows) = run(tmp_path, output, resume=False)
+    assert len(calculated) == len(DAYS) * len(SNCLS) * len(FUNCTIONS)
+    assert rows == len(calculated) - len(DAYS)
+
+    for attempt in range(2):
+        (calculated, rows) = run(tmp_path, output, resume=True)
+        assert calculated == []
+        assert rows == 0
+
+
+def test_resume_calculates_units_that_were_not_recorded(tmp_path):
+    run(tmp_path, 'csv', resume=False)
+
+    # Drop the record of one unit, as if the run was interrupted before it was written
+    unitpath = tmp_path / "example_simpleMetrics_completedUnits.csv"
+    units = pd.read_csv(unitpath, dtype=str)
+    units = units[~((units.function == 'numSpikes') & (units.target == 'IU.ANMO.00.LHZ') & (units.day == '2020-01-02'))]
+    units.to_csv(unitpath, index=False)
+
+    (calculated, rows) = run(tmp_path, 'csv', resume=True)
+    assert calculated == [('numSpikes', 'IU.ANMO.00.LHZ', '2020-01-02')]
+
+
+@pytest.mark.parametrize("output", ['csv', 'db'])
+def test_resume_extends_a_partial_day(tmp_path, output):
+    # The first run ends at noon of the last day
+    run(tmp_path, output, resume=False, end=DAYS[-1] + 43200)
+
+    (calculated, rows) = run(tmp_path, output, resume=True)
+    assert calculated == [('PSD', snclId, '2020-01-02') for snclId in SNCLS]
+    assert rows == len(SNCLS)
+
+    (calculated, rows) = run(tmp_path, output, resume=True)
+    assert calculated == []
+
+
+def test_covers_day():
+    assert completed_units.covers_day(DAYS[0], DAYS[0] + 86400)
+    assert completed_units.covers_day(DAYS[0], DAYS[0] + 2 * 86400)
+    assert not completed_units.covers_day(DAYS[0], DAYS[0] + 43200)
+    assert not completed_units.covers_day(DAYS[0] + 3600, DAYS[0] + 86400)
@@ -0,0 +1,55 @@
+"""
+Tests of the ISPAQ formatting utilities.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+import sqlite3
+
+import numpy as np
+import pytest
+
+pytest.importorskip("rpy2")
+
+from ispaq import utils
+
+
+@pytest.mark.parametrize("sigfigs", range(1, 16))
+def test_format_sigfigs_matches_percent_g(sigfigs):
+    rng = np.random.default_rng(sigfigs)
+    values = np.concatenate([
+        rng.standard_normal(5000) * 10.0 ** rng.integers(-310, 300, 5000),
+        rng.standard_normal(5000) * 20 - 150,
+        (rng.integers(-10**6, 10**6, 5000) + 0.5) / 10.0 ** rng.integers(0, 8, 5000),
+        rng.integers(-10**7, 10**7, 1000).astype(float),
+        [0.0, -0.0, np.nan, np.inf, -np.inf, 5e-324, 1e308, 0.5, 2.5, 0.95, 9.9999996,
+         99999.95, 1e-4, 1e-5, 123456.0, 1234567.0, 1e15, 1e16],
+    ])
+    expected = ["%.*g" % (sigfigs, x) for x in values]
+    assert list(utils.format_sigfigs(values, sigfigs)) == expected
+
+
+def test_format_sigfigs_empty():
+    assert len(utils.format_sigfigs(np.array([]), 6)) == 0
+
+
+def test_retrieve_psd_unique_targets_only_reads(tmp_path):
+    dbname = str(tmp_path / "ispaq.db")
+    conn = sqlite3.connect(dbname)
+    conn.execute("CREATE TABLE psd_corrected (target text, frequency float, power float, start datetime, end datetime)")
+    conn.execute("INSERT INTO psd_corrected VALUES ('IU.ANMO.00.BHZ.M', 1.0, -120.0, '2020-01-01T00:00:00', '2020-01-01T01:00:00')")
+    conn.commit()
+
+    targets = utils.retrieve_psd_unique_targets(dbname, 'IU.ANMO.00.BH%', "", "", logging.getLogger("ispaq-test"))
+    assert targets == ['IU.ANMO.00.BHZ.M']
+    assert conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'index';").fetchone()[0] == 0
+    conn.close()
+
+
+def test_like_to_glob_ignores_case():
+    assert utils.like_to_glob('iu.anmo.0_.bh%') == 'IU.ANMO.0?.BH*'
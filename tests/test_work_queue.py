@@ -0,0 +1,134 @@
+"""
+Tests of the ISPAQ work queue for distributed runs.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+import sqlite3
+import time
+import types
+
+import pandas as pd
+from obspy import UTCDateTime
+
+from ispaq import database
+from ispaq import work_queue
+
+
+DAYS = [UTCDateTime("2020-01-01"), UTCDateTime("2020-01-02")]
+
+
+def make_concierge(output_db):
+    return types.SimpleNamespace(logger=logging.getLogger("ispaq-test"), output='db', db_name=str(output_db),
+                                 processes=1, worker=None, unit_counter=0, claim=None)
+
+
+def psd_logic(concierge, sink=None):
+    # Writes PSD rows and a histogram to the output database, like PSD_metrics
+    for starttime in DAYS:
+        if not concierge.claim('IU.ANMO.00.BHZ', starttime):
+            continue
+        day = str(starttime.date)
+        writer = database.get_writer(concierge.db_name)
+        writer.upsert('psd_corrected', [('IU.ANMO.00.BHZ.M', 1.0, -120.0, day, day)])
+        writer.replace_psd_histogram('IU.ANMO.00.BHZ.M', day, [(1.0, -120, 1)])
+        sink.append(pd.DataFrame({'metricName': ['sample_mean'], 'value': [1.0]}))
+
+
+def count_rows(dbname, tablename):
+    conn = sqlite3.connect(dbname)
+    try:
+        return conn.execute("SELECT count(*) FROM %s" % tablename).fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+def test_worker_rows_are_written_by_the_coordinator(tmp_path):
+    queue_db = str(tmp_path / "queue.sqlite")
+    output_db = str(tmp_path / "output.sqlite")
+    concierge = make_concierge(output_db)
+
+    work_queue.distribute(concierge, queue_db, {'args': {}}, {'PSD': psd_logic})
+    work_queue.run_workers(concierge, queue_db, {'PSD': psd_logic})
+
+    # Workers store the rows in the work queue only
+    assert count_rows(output_db, 'psd_corrected') == 0
+    assert database.get_writer(output_db).__class__ is database.DatabaseWriter
+
+    metrics = []
+    sink = types.SimpleNamespace(logger=concierge.logger, append=metrics.append)
+    work_queue.write_results(queue_db, 'PSD', sink)
+
+    assert len(metrics) == 2
+    assert count_rows(output_db, 'psd_corrected') == 2
+    assert count_rows(output_db, 'psd_histogram') == 2
+
+
+def test_idle_worker_waits_without_running_the_logic(tmp_path, monkeypatch):
+    queue_db = str(tmp_path / "queue.sqlite")
+    concierge = make_concierge(tmp_path / "output.sqlite")
+    work_queue.distribute(concierge, queue_db, {'args': {}}, {'PSD': psd_logic})
+
+    # Another worker holds the lease of every unit
+    queue = work_queue.WorkQueue(queue_db)
+    units = queue.failed('PSD')
+    for unit in units:
+        assert queue.claim('PSD', unit, 'other')
+    assert queue.claimable('PSD') == 0
+
+    calls = []
+    def counting_logic(concierge, sink=None):
+        calls.append(1)
+        psd_logic(concierge, sink)
+
+    def sleep(seconds):
+        # The other worker finishes while this one waits
+        for unit in units:
+            queue.complete('PSD', unit, 'other', [])
+    monkeypatch.setattr(work_queue.time, 'sleep', sleep)
+
+    work_queue.run_workers(concierge, queue_db, {'PSD': counting_logic})
+    queue.close()
+
+    assert calls == []
+
+
+def test_unit_of_a_lost_worker_is_written_once(tmp_path, caplog):
+    queue_db = str(tmp_path / "queue.sqlite")
+    logger = logging.getLogger("ispaq-test")
+    queue = work_queue.WorkQueue(queue_db)
+    queue.add_units('simple', [work_queue.unit_key('IU.ANMO.00.BHZ', DAYS[0], {})])
+
+    def metrics(worker):
+        return pd.DataFrame({'metricName': ['sample_mean'], 'value': [1.0], 'worker': [worker]})
+
+    stale = work_queue.QueueSink(queue, 'simple', 'stale', logger)
+    assert stale.claim('IU.ANMO.00.BHZ', DAYS[0])
+    stale.append(metrics('stale'))
+
+    # The stale worker stops renewing its lease, e.g. its node was lost
+    queue.conn.execute("UPDATE units SET expires = ?", (time.time() - 1,))
+    assert queue.claimable('simple') == 1
+
+    other = work_queue.QueueSink(queue, 'simple', 'other', logger)
+    assert other.claim('IU.ANMO.00.BHZ', DAYS[0])
+    other.append(metrics('other'))
+    other.commit()
+
+    assert not queue.complete('simple', stale.unit, 'stale', stale.dataframes)
+    with caplog.at_level(logging.WARNING, logger="ispaq-test"):
+        stale.commit()
+    assert "expired" in caplog.text
+    queue.close()
+
+    written = []
+    sink = types.SimpleNamespace(logger=logger, append=written.append)
+    work_queue.write_results(queue_db, 'simple', sink)
+    assert [df['worker'].tolist() for df in written] == [['other']]
@@ -0,0 +1,85 @@
+"""
+Tests of the parallel calculation of metrics in worker processes.
+
+:copyright:
+    Mazama Science
+:license:
+    GNU Lesser General Public License, Version 3
+    (https://www.gnu.org/copyleft/lesser.html)
+"""
+
+import logging
+import time
+
+import pandas as pd
+import pytest
+from obspy import UTCDateTime
+
+from ispaq import worker_pool
+from ispaq.completed_units import CompletedUnit
+
+
+STARTTIME = UTCDateTime("2020-01-01")
+DAYS = [STARTTIME + day * 86400 for day in range(5)]
+SNCLS = ['IU.ANMO.00.BHZ', 'IU.ANMO.00.LHZ', 'IU.COLA.00.BHZ']
+
+
+class FakeConcierge(worker_pool.UnitAssignment):
+    # The attributes of Concierge that worker processes use, with its unit assignment, without R
+
+    def __init__(self, processes, shard):
+        self.logger = logging.getLogger("ispaq-test")
+        self.processes = processes
+        self.shard = shard
+        self.requested_starttime = STARTTIME
+        self.result_cache = None
+        self.worker = None
+        self.unit_counter = 0
+        self.current_unit = None
+        self.on_assigned = None
+        self.claim = None
+
+    def drop_completed(self, df):
+        return df
+
+
+def logic(concierge, sink=None):
+    # Mimics simple_metrics: two dataframes and a marker per SNCL-day, none for LH channels
+    # on odd days, and units that take longer than the units after them
+    for (day, starttime) in enumerate(DAYS):
+        if not concierge.in_shard(starttime):
+            continue
+        for snclId in SNCLS:
+            if not concierge.assigned(snclId, starttime):
+                continue
+            time.sleep(0.02 * ((day + len(snclId)) % 3))
+            if not (snclId.endswith('LHZ') and day % 2):
+                for metric in ['sample_mean', 'sample_max']:
+                    sink.append(pd.DataFrame({'metricName': [metric], 'value': [float(day)],
+                                              'snclq': [snclId + '.M'], 'starttime': [starttime]}))
+            sink.append(CompletedUnit('basicStats', snclId, starttime))
+
+
+class ListSink(object):
+
+    def __init__(self):
+        self.output = []
+
+    def append(self, df):
+        if isinstance(df, CompletedUnit):
+            self.output.append(df.key)
+        else:
+            self.output.append(tuple(df.itertuples(index=False)))
+
+
+def run(processes, shard=None):
+    sink = ListSink()
+    worker_pool.run_metrics(FakeConcierge(processes, shard), logic, sink)
+    return sink.output
+
+
+@pytest.mark.parametrize("processes,shard", [(4, None), (4, 'day'), (2, 'day')])
+def test_workers_write_the_output_of_a_serial_run(processes, shard):
+    serial = run(1)
+    assert len(serial) == len(DAYS) * len(SNCLS) * 3 - 2 * 2
+    assert run(processes, shard) == serial